@@ -0,0 +1,39 @@
+# Time to compare synthetic follower snapshots with /audience/overlap's
+# engine: pairwise intersections, Jaccard and followers common to all.
+#   python benchmarks/audience_overlap.py [targets] [followers per target]
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import AUDIENCE_MUTUALS_LIMIT, audience_overlap, write_snapshot  # noqa: E402
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    with tempfile.TemporaryDirectory() as folder:
+        targets = []
+        started = time.perf_counter()
+        for index in range(count):
+            # each audience is shifted by a quarter, so neighbours share 75%
+            offset = index * size // 4
+            users = ({"pk": 10 ** 9 + (offset + n) * 2, "username": f"user{offset + n}"} for n in range(size))
+            base_path = os.path.join(folder, str(index), "followers_bench")
+            write_snapshot(users, base_path)
+            targets.append((f"target{index}", index, base_path))
+        print(f"wrote {count} snapshots of {size} followers in {time.perf_counter() - started:.1f} s")
+
+        started = time.perf_counter()
+        result = audience_overlap(targets, AUDIENCE_MUTUALS_LIMIT)
+        elapsed = time.perf_counter() - started
+        print(f"overlap: {elapsed:.2f} s for {len(result['pairs'])} pairs, "
+              f"{result['common_to_all']} common to all")
+        print(f"max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# Runs several service nodes as local gunicorn processes in cluster mode
+# against the fake Instagram upstream, then grows and shrinks the cluster.
+#   python benchmarks/cluster.py --nodes 3 --accounts 60
+# Checks that every token answers through every node after logins, after a
+# node joins and after one leaves, and reports how many tokens changed
+# owner, how many sessions were handed off or pulled, and the latency of
+# requests served by the owner vs forwarded to it.
+import argparse
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+from load import free_port, wait_for_port  # noqa: E402
+from main import HashRing, shard_key  # noqa: E402
+
+SECRET = "cluster-benchmark"
+
+
+def start_node(url, seeds, upstream_url, workdir, workers):
+    env = dict(os.environ)
+    env.update({
+        "INSTAGRAM_API_URL": upstream_url,
+        "CLUSTER_SELF": url,
+        "CLUSTER_NODES": ",".join(seeds),
+        "CLUSTER_SECRET": SECRET,
+        "CLUSTER_SYNC_INTERVAL": "1",
+        "CLUSTER_DEAD_AFTER": "5",
+        "JOBS_ENABLED": "0",
+        "SESSION_MAINTAINER_ENABLED": "0",
+        "WEB_WORKERS": str(workers),
+        "PYTHONPATH": ROOT,
+    })
+    for endpoint_class in ("PROFILE", "FOLLOWERS"):
+        for setting in ("PER_SECOND", "BURST", "GLOBAL_PER_SECOND", "GLOBAL_BURST"):
+            env[f"RATE_{endpoint_class}_{setting}"] = "1000000"
+    # its own working directory, so each node has its own session store
+    os.makedirs(workdir, exist_ok=True)
+    command = ["gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+               "--bind", url[len("http://"):], "main:create_app()"]
+    node = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(int(url.rsplit(":", 1)[1]))
+    return node
+
+
+def cluster_stats(url):
+    return requests.get(f"{url}/stats/cluster", timeout=5).json()["cluster"]
+
+
+def wait_for_view(urls, nodes, timeout=30):
+    # every worker of every node has to see it, so ask each one a few times
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if all(sorted(cluster_stats(url)["nodes"]) == sorted(nodes) for url in urls for _ in range(4)):
+            return time.time()
+        time.sleep(0.2)
+    raise RuntimeError(f"Nodes did not agree on {nodes}")
+
+
+def check_tokens(urls, tokens, ring):
+    # every token through every node, timed by whether the node owns it
+    direct, forwarded, failures = [], [], 0
+    for token in tokens:
+        owner = ring.owner(shard_key(token))
+        for url in urls:
+            started = time.perf_counter()
+            response = requests.post(f"{url}/get_own_bio", json={"token": token}, timeout=30)
+            elapsed = (time.perf_counter() - started) * 1e3
+            if response.status_code != 200 or response.json().get("status") != "success":
+                failures += 1
+            (direct if url == owner else forwarded).append(elapsed)
+    return direct, forwarded, failures
+
+
+def report(label, urls, tokens, ring):
+    direct, forwarded, failures = check_tokens(urls, tokens, ring)
+    stats = [cluster_stats(url) for url in urls]
+    print(f"{label}: {len(tokens) * len(urls)} requests, {failures} failed, "
+          f"median direct {statistics.median(direct):.1f} ms, forwarded {statistics.median(forwarded):.1f} ms, "
+          f"epoch {stats[0]['epoch']}")
+    return failures
+
+
+def session_counts(workdirs):
+    counts = {}
+    for url, workdir in workdirs.items():
+        folder = os.path.join(workdir, "sessions")
+        names = os.listdir(folder) if os.path.isdir(folder) else []
+        counts[url] = sum(1 for name in names if name.startswith("settings_"))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--accounts", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+    processes = {}
+    upstream_port = free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_instagram.py"), "--port", str(upstream_port),
+         "--latency-ms", str(args.latency_ms), "--jitter-ms", "0"], stdout=subprocess.DEVNULL)
+    upstream_url = f"http://127.0.0.1:{upstream_port}/api/{{version!s}}/"
+    try:
+        wait_for_port(upstream_port)
+        urls = [f"http://127.0.0.1:{free_port()}" for _ in range(args.nodes)]
+        workdirs = {url: os.path.join(scratch, str(index)) for index, url in enumerate(urls)}
+        for url in urls:
+            processes[url] = start_node(url, urls, upstream_url, workdirs[url], args.workers)
+
+        tokens = []
+        for index in range(args.accounts):
+            response = requests.post(f"{random.choice(urls)}/login",
+                                     json={"username": f"account{index}", "password": "secret"}, timeout=30)
+            tokens.append(response.json()["token"])
+        ring = HashRing(urls)
+        failures = report("initial", urls, tokens, ring)
+        print("  sessions per node:", list(session_counts(workdirs).values()))
+
+        # a new node starts outside the view and joins through the seeds
+        joined = f"http://127.0.0.1:{free_port()}"
+        workdirs[joined] = os.path.join(scratch, str(len(urls)))
+        started = time.time()
+        processes[joined] = start_node(joined, urls, upstream_url, workdirs[joined], args.workers)
+        urls.append(joined)
+        print(f"join: view agreed after {wait_for_view(urls, urls) - started:.1f} s")
+        new_ring = HashRing(urls)
+        moved = sum(1 for token in tokens if ring.owner(shard_key(token)) != new_ring.owner(shard_key(token)))
+        print(f"  {moved} of {len(tokens)} tokens changed owner")
+        ring = new_ring
+        failures += report("after join", urls, tokens, ring)
+        time.sleep(3)  # one sync interval or two, for the handoffs
+        print("  sessions per node:", list(session_counts(workdirs).values()))
+
+        # the first node leaves, handing its sessions to the others
+        leaving = urls[0]
+        started = time.time()
+        requests.post(f"{leaving}/cluster/leave", json={"node": leaving},
+                      headers={"X-Cluster-Secret": SECRET}, timeout=30).raise_for_status()
+        urls.remove(leaving)
+        print(f"leave: view agreed after {wait_for_view(urls, urls) - started:.1f} s")
+        time.sleep(3)
+        print("  sessions on the node that left:", session_counts({leaving: workdirs[leaving]})[leaving])
+        processes.pop(leaving).terminate()
+        ring = HashRing(urls)
+        failures += report("after leave", urls, tokens, ring)
+        totals = [cluster_stats(url) for url in urls]
+        print("  handed off / received / pulled on the remaining nodes' answering workers:",
+              [(stats["handed_off"], stats["received"], stats["pulled"]) for stats in totals])
+        print("  sessions per node:", list(session_counts({url: workdirs[url] for url in urls}).values()))
+        sys.exit(1 if failures else 0)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        upstream.terminate()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
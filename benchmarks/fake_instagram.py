@@ -0,0 +1,166 @@
+# Local stand-in for the parts of the Instagram private API that main.py
+# uses: login (si/fetch_headers + accounts/login), accounts/current_user,
+# users/<name>/usernameinfo and paginated friendships/<id>/followers.
+#   python benchmarks/fake_instagram.py --port 8900 --latency-ms 50 --error-rate 0.01
+# Point the service at it with INSTAGRAM_API_URL=http://127.0.0.1:8900/api/{version!s}/
+# GET /__stats reports how many calls it served and the most it had in
+# flight at once.
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+COOKIE_LIFETIME = 90 * 24 * 3600
+
+
+def user_pk(username):
+    # 36 bits, so follower pks derived from it stay within int64 like real ones
+    return int(hashlib.md5(username.encode()).hexdigest()[:9], 16)
+
+
+def user_payload(username, pk=None):
+    pk = pk or user_pk(username)
+    return {
+        "pk": pk,
+        "username": username,
+        "full_name": username.replace("_", " ").title(),
+        "biography": f"Bio of {username}",
+        "profile_pic_url": f"https://cdn.example.invalid/{pk}.jpg",
+        "follower_count": pk % 1000000,
+        "following_count": pk % 7500,
+        "media_count": pk % 900,
+        "is_verified": pk % 17 == 0,
+        "is_private": pk % 5 == 0,
+    }
+
+
+class FakeInstagramHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+    followers = 1000
+    page_size = 200
+    stats = None  # {"calls", "in_flight", "in_flight_peak"}, one dict per server
+    stats_lock = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload, cookies=()):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for cookie in cookies:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def login_cookies(self, username="bench"):
+        expires = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + COOKIE_LIFETIME))
+        values = {"csrftoken": "fakecsrf", "ds_user_id": str(user_pk(username)), "ds_user": username,
+                  "sessionid": f"fake{user_pk(username)}"}
+        return [f"{name}={value}; expires={expires}; Path=/" for name, value in values.items()]
+
+    def handle_call(self):
+        if self.path == "/__stats":
+            with self.stats_lock:
+                return self.send_json(200, dict(self.stats))
+        with self.stats_lock:
+            self.stats["calls"] += 1
+            self.stats["in_flight"] += 1
+            self.stats["in_flight_peak"] = max(self.stats["in_flight_peak"], self.stats["in_flight"])
+        try:
+            self.answer()
+        finally:
+            with self.stats_lock:
+                self.stats["in_flight"] -= 1
+
+    def answer(self):
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        url = urllib.parse.urlparse(self.path)
+        path = url.path.split("/api/v1/", 1)[-1]
+        query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if path == "si/fetch_headers/":
+            return self.send_json(200, {"status": "ok"}, self.login_cookies())
+        if path == "accounts/login/":
+            form = urllib.parse.parse_qs(body.decode())
+            signed = form.get("signed_body", ["."])[0].split(".", 1)[1]
+            username = json.loads(signed).get("username", "bench")
+            return self.send_json(200, {"status": "ok", "logged_in_user": user_payload(username)},
+                                  self.login_cookies(username))
+
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return self.send_json(429, {"status": "fail", "message": "Please wait a few minutes before you try again."})
+        if roll < self.throttle_rate + self.error_rate:
+            return self.send_json(500, {"status": "fail", "message": "Internal error"})
+
+        if path == "accounts/current_user/":
+            cookies = self.headers.get("Cookie", "")
+            username = "bench"
+            for part in cookies.split(";"):
+                name, _, value = part.strip().partition("=")
+                if name == "ds_user":
+                    username = value
+            return self.send_json(200, {"status": "ok", "user": user_payload(username)})
+        if path.startswith("users/") and path.endswith("/usernameinfo/"):
+            username = path[len("users/"):-len("/usernameinfo/")]
+            return self.send_json(200, {"status": "ok", "user": user_payload(username)})
+        if path.startswith("friendships/") and path.endswith("/followers/"):
+            user_id = int(path.split("/")[1])
+            offset = int(query.get("max_id", ["0"])[0])
+            end = min(self.followers, offset + self.page_size)
+            users = [{"pk": user_id * 10000000 + index, "username": f"follower_{user_id}_{index}",
+                      "full_name": "", "profile_pic_url": f"https://cdn.example.invalid/f{index}.jpg"}
+                     for index in range(offset, end)]
+            payload = {"status": "ok", "users": users, "big_list": end < self.followers}
+            if end < self.followers:
+                payload["next_max_id"] = str(end)
+            return self.send_json(200, payload)
+        return self.send_json(404, {"status": "fail", "message": f"Unknown endpoint {path}"})
+
+    do_GET = handle_call
+    do_POST = handle_call
+
+
+def make_server(host="127.0.0.1", port=0, **settings):
+    settings.update(stats={"calls": 0, "in_flight": 0, "in_flight_peak": 0}, stats_lock=threading.Lock())
+    handler = type("ConfiguredFakeInstagramHandler", (FakeInstagramHandler,), settings)
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--followers", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=200)
+    args = parser.parse_args()
+    server = make_server(
+        args.host, args.port, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        followers=args.followers, page_size=args.page_size)
+    print(f"fake instagram listening on http://{args.host}:{server.server_port}/api/{{version!s}}/", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Serialization time and bytes on the wire for a follower list in each
+# wire format, with the stdlib encoder vs orjson and gzip vs brotli.
+#   python benchmarks/json_encoding.py [users] [rounds]
+import json
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import brotli, compress_bytes, orjson  # noqa: E402
+
+
+def make_users(count):
+    rng = random.Random(7)
+    alphabet = string.ascii_lowercase + string.digits + "._"
+    return [{"pk": rng.randrange(10 ** 9, 10 ** 11),
+             "username": "".join(rng.choice(alphabet) for _ in range(rng.randint(6, 18)))}
+            for _ in range(count)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    users = make_users(count)
+    payloads = [
+        ("objects", {"users": users}),
+        ("usernames", {"followers": [user["username"] for user in users]}),
+        ("pk", {"pk": [user["pk"] for user in users]}),
+        ("columnar", {"pk": [user["pk"] for user in users], "username": [user["username"] for user in users]}),
+    ]
+    encoders = [("stdlib", lambda obj: json.dumps(obj, separators=(",", ":")).encode())]
+    if orjson is not None:
+        encoders.append(("orjson", orjson.dumps))
+    encodings = ["gzip"] + (["br"] if brotli is not None else [])
+
+    print(f"{count} users")
+    header = f"{'format':<12}" + "".join(f"{name + ' ms':>12}" for name, _ in encoders)
+    header += f"{'raw bytes':>12}" + "".join(f"{name + ' bytes':>12}" for name in encodings)
+    header += "".join(f"{name + ' ms':>10}" for name in encodings)
+    print(header)
+    for name, payload in payloads:
+        row = f"{name:<12}"
+        for _, encode in encoders:
+            seconds = min(timeit.repeat(lambda: encode(payload), number=rounds, repeat=3))
+            row += f"{seconds / rounds * 1e3:>12.2f}"
+        body = encoders[-1][1](payload)
+        row += f"{len(body):>12}"
+        row += "".join(f"{len(compress_bytes(body, encoding)):>12}" for encoding in encodings)
+        for encoding in encodings:
+            seconds = min(timeit.repeat(lambda: compress_bytes(body, encoding), number=1, repeat=3))
+            row += f"{seconds * 1e3:>10.1f}"
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
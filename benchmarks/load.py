@@ -0,0 +1,288 @@
+# Load test main.py against the local fake Instagram upstream.
+#   python benchmarks/load.py --duration 20 --concurrency 32
+#   python benchmarks/load.py --server gunicorn --save-baseline gthread
+#   python benchmarks/load.py --server gunicorn --compare gthread
+#   python benchmarks/load.py --server gunicorn --worker-class gevent --workers 1 --concurrency 400 \
+#       --latency-ms 2000 --usernames 100000 --routes /profile,/get_bio --save-baseline gevent-400
+# Reports throughput, p50/p90/p99 latency per route, errors, server RSS and
+# how many requests were in flight at once (mean, by Little's law, and peak).
+# Baselines are saved to benchmarks/baselines/<name>.json. --compare exits
+# with status 1 when throughput or p99 regresses past --tolerance.
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BASELINE_FOLDER = os.path.join(HERE, "baselines")
+
+# route -> weight, roughly what dashboards send
+MIX = {
+    "/get_number_of_followers": 25,
+    "/get_bio": 10,
+    "/get_full_name": 10,
+    "/profile": 20,
+    "/get_own_number_of_followers": 10,
+    "/get_own_bio": 5,
+    "/get_followers": 10,
+    "/batch/profile": 2,
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+def rss_kb(pid):
+    # resident memory of pid and its children (gunicorn workers), Linux only
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            pids.extend(int(child) for child in children.read().split())
+    except OSError:
+        pass
+    for each in pids:
+        try:
+            with open(f"/proc/{each}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def start_processes(args, workdir):
+    upstream_port = free_port()
+    app_port = free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_instagram.py"), "--port", str(upstream_port),
+         "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+         "--error-rate", str(args.error_rate), "--throttle-rate", str(args.throttle_rate),
+         "--followers", str(args.followers)],
+        stdout=subprocess.DEVNULL)
+    env = dict(os.environ)
+    env.update({
+        "INSTAGRAM_API_URL": f"http://127.0.0.1:{upstream_port}/api/{{version!s}}/",
+        "JOBS_ENABLED": "0",
+        "PYTHONPATH": ROOT,
+    })
+    if not args.rate_limits:
+        for endpoint_class in ("PROFILE", "FOLLOWERS"):
+            env[f"RATE_{endpoint_class}_PER_SECOND"] = "1000000"
+            env[f"RATE_{endpoint_class}_BURST"] = "1000000"
+            env[f"RATE_{endpoint_class}_GLOBAL_PER_SECOND"] = "1000000"
+            env[f"RATE_{endpoint_class}_GLOBAL_BURST"] = "1000000"
+    if args.server == "gunicorn":
+        env.update({"WEB_WORKERS": str(args.workers), "WEB_THREADS": str(args.threads),
+                    "WEB_WORKER_CLASS": args.worker_class})
+        command = ["gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+                   "--bind", f"127.0.0.1:{app_port}", "main:create_app()"]
+    else:
+        command = [sys.executable, "-c",
+                   "import main; main.app.run(host='127.0.0.1', port=%d, threaded=True)" % app_port]
+    app = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(upstream_port)
+    wait_for_port(app_port)
+    return upstream, app, f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{upstream_port}"
+
+
+def make_body(route, token, usernames, weights):
+    target = random.choices(usernames, weights)[0]
+    if route == "/profile":
+        return {"token": token, "target_username": target, "fields": "follower_count,bio,full_name"}
+    if route == "/batch/profile":
+        return {"token": token, "target_usernames": random.choices(usernames, weights, k=50), "fields": "follower_count"}
+    if route.startswith("/get_own_"):
+        return {"token": token}
+    return {"token": token, "target_username": target}
+
+
+def drive(base_url, tokens, args):
+    # zipf-like popularity so a few targets are requested much more often
+    usernames = [f"user_{index}" for index in range(args.usernames)]
+    weights = [1 / (index + 1) for index in range(args.usernames)]
+    routes = args.routes.split(",") if args.routes else list(MIX)
+    route_weights = [MIX[route] for route in routes]
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker():
+        session = requests.Session()
+        local = []
+        while time.perf_counter() < deadline:
+            route = random.choices(routes, route_weights)[0]
+            body = make_body(route, random.choice(tokens), usernames, weights)
+            started = time.perf_counter()
+            try:
+                response = session.post(base_url + route, json=body, timeout=60)
+                status = response.status_code
+            except requests.RequestException:
+                status = 0
+            local.append((route, status, time.perf_counter() - started, started))
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def peak_in_flight(results):
+    events = sorted([(started, 1) for _, _, _, started in results]
+                    + [(started + seconds, -1) for _, _, seconds, started in results])
+    peak = current = 0
+    for _, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def summarize(results, elapsed, rss, upstream_stats):
+    routes = {}
+    for route, status, seconds, _ in results:
+        routes.setdefault(route, []).append((status, seconds))
+    summary = {
+        "requests": len(results),
+        "throughput": len(results) / elapsed,
+        "p50_ms": percentile([r[2] for r in results], 0.50) * 1000,
+        "p90_ms": percentile([r[2] for r in results], 0.90) * 1000,
+        "p99_ms": percentile([r[2] for r in results], 0.99) * 1000,
+        "errors": sum(1 for r in results if not 200 <= r[1] < 300),
+        # a request is in flight from send to answer; with latency close to
+        # the upstream's, the server is working on them, not queueing them
+        "in_flight_mean": sum(r[2] for r in results) / elapsed,
+        "in_flight_peak": peak_in_flight(results),
+        # upstream calls the server had open at once, seen from the fake upstream
+        "upstream_in_flight_peak": upstream_stats["in_flight_peak"],
+        "rss_mb": rss / 1024,
+        "routes": {},
+    }
+    for route, samples in sorted(routes.items()):
+        latencies = [seconds for _, seconds in samples]
+        summary["routes"][route] = {
+            "requests": len(samples),
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "errors": sum(1 for status, _ in samples if not 200 <= status < 300),
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'route':<32}{'requests':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for route, stats in summary["routes"].items():
+        print(f"{route:<32}{stats['requests']:>10}{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['errors']:>8}")
+    print(f"{'total':<32}{summary['requests']:>10}{summary['p50_ms']:>10.1f}{summary['p99_ms']:>10.1f}{summary['errors']:>8}")
+    print(f"throughput: {summary['throughput']:.1f} req/s   p90: {summary['p90_ms']:.1f} ms   "
+          f"server rss: {summary['rss_mb']:.1f} MB")
+    print(f"in flight: {summary['in_flight_mean']:.0f} mean, {summary['in_flight_peak']} peak   "
+          f"upstream calls in flight: {summary.get('upstream_in_flight_peak', 0)} peak")
+
+
+def compare(summary, name, tolerance):
+    with open(os.path.join(BASELINE_FOLDER, f"{name}.json")) as baseline_file:
+        baseline = json.load(baseline_file)["summary"]
+    regressions = []
+    throughput_change = (summary["throughput"] - baseline["throughput"]) / baseline["throughput"]
+    p99_change = (summary["p99_ms"] - baseline["p99_ms"]) / max(baseline["p99_ms"], 1e-9)
+    print(f"vs baseline '{name}': throughput {throughput_change:+.1%}, p99 {p99_change:+.1%}")
+    if throughput_change < -tolerance:
+        regressions.append("throughput")
+    if p99_change > tolerance:
+        regressions.append("p99")
+    if regressions:
+        print(f"REGRESSION: {', '.join(regressions)} beyond {tolerance:.0%}")
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", choices=["dev", "gunicorn"], default="dev")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--tokens", type=int, default=4)
+    parser.add_argument("--usernames", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--followers", type=int, default=1000)
+    parser.add_argument("--routes", help="comma-separated routes to send, all of MIX by default")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the service's default rate governor limits")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="igapi-bench-")
+    upstream, app, base_url, upstream_url = start_processes(args, workdir)
+    try:
+        tokens = []
+        for index in range(args.tokens):
+            response = requests.post(base_url + "/login", json={"username": f"bench_{index}", "password": "x"})
+            tokens.append(response.json()["token"])
+        results, elapsed = drive(base_url, tokens, args)
+        upstream_stats = requests.get(upstream_url + "/__stats").json()
+        summary = summarize(results, elapsed, rss_kb(app.pid), upstream_stats)
+    finally:
+        app.terminate()
+        upstream.terminate()
+        app.wait()
+        upstream.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_summary(summary)
+    if args.save_baseline:
+        os.makedirs(BASELINE_FOLDER, exist_ok=True)
+        with open(os.path.join(BASELINE_FOLDER, f"{args.save_baseline}.json"), "w") as baseline_file:
+            # numbers only compare on the same machine: the load generator, the
+            # fake upstream and the server all share its cpus
+            json.dump({"args": vars(args), "cpus": os.cpu_count(), "summary": summary}, baseline_file, indent=2)
+        print(f"saved baseline '{args.save_baseline}'")
+    if args.compare and not compare(summary, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# Encode/decode time and size of cached Client settings: legacy
+# base64-in-JSON files vs the binary session format.
+#   python benchmarks/settings_codec.py [settings.json] [rounds]
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import decode_settings, encode_settings, from_json, to_json  # noqa: E402
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "settings.json"
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    with open(path) as file_data:
+        settings = json.load(file_data, object_hook=from_json)
+
+    json_blob = json.dumps(settings, default=to_json)
+    binary_blob = encode_settings(settings)
+    assert decode_settings(binary_blob) == settings
+
+    cases = [
+        ("json encode", lambda: json.dumps(settings, default=to_json)),
+        ("json decode", lambda: json.loads(json_blob, object_hook=from_json)),
+        ("binary encode", lambda: encode_settings(settings)),
+        ("binary decode", lambda: decode_settings(binary_blob)),
+    ]
+    print(f"{'case':<16}{'us/op':>10}")
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=rounds, repeat=3))
+        print(f"{name:<16}{seconds / rounds * 1e6:>10.2f}")
+    print(f"json size:   {len(json_blob.encode())} bytes")
+    print(f"binary size: {len(binary_blob)} bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Cold start of the service: wall and CPU time of fresh interpreters
+# importing main, building the app and serving a first request, plus the
+# slowest imports from `python -X importtime`. CPU time is the steadier
+# number on a busy machine.
+#   python benchmarks/startup.py [runs] [top]
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRELUDE = f"import sys; sys.path.insert(0, {ROOT!r}); "
+CASES = [
+    ("interpreter", "pass"),
+    ("import main", PRELUDE + "import main"),
+    ("create_app", PRELUDE + "import main; main.create_app()"),
+    ("first request", PRELUDE + "import main; main.create_app().test_client().get('/stats/session_pool')"),
+]
+
+
+def run(code, cwd, *flags):
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=cwd, check=True,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+    # a scratch working directory so nothing the service writes on startup
+    # (session folders, databases) is left behind or reused between runs
+    with tempfile.TemporaryDirectory() as cwd:
+        # precompiled like the Docker image, otherwise every run recompiles
+        # main.py when PYTHONDONTWRITEBYTECODE is set
+        subprocess.run([sys.executable, "-m", "compileall", "-q", os.path.join(ROOT, "main.py")], check=True)
+        print(f"{'case':<16}{'wall min ms':>12}{'wall median ms':>16}{'cpu median ms':>15}")
+        for name, code in CASES:
+            timings = []
+            cpu_timings = []
+            for _ in range(runs):
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                started = time.perf_counter()
+                run(code, cwd)
+                timings.append((time.perf_counter() - started) * 1e3)
+                after = resource.getrusage(resource.RUSAGE_CHILDREN)
+                cpu_timings.append((after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime) * 1e3)
+            print(f"{name:<16}{min(timings):>12.1f}{statistics.median(timings):>16.1f}"
+                  f"{statistics.median(cpu_timings):>15.1f}")
+        print("leftover files:", sorted(os.listdir(cwd)) or "none")
+
+        # -X importtime lines: "import time: self [us] | cumulative | name",
+        # nested imports indented by two spaces per level and printed
+        # before the module that imported them
+        stderr = run(PRELUDE + "import main", cwd, "-X", "importtime").stderr
+        imports = children = []
+        for line in stderr.splitlines()[1:]:
+            _, cumulative_us, name = line.split("|")
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            if depth == 0:
+                if name.strip() == "main":
+                    imports = children
+                children = []
+            elif depth == 1:
+                children.append((int(cumulative_us), name.strip()))
+        print(f"\n{'top-level import':<32}{'cumulative ms':>14}")
+        for cumulative_us, name in sorted(imports, reverse=True)[:top]:
+            print(f"{name:<32}{cumulative_us / 1e3:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Per-request cost of a fresh TLS connection (what Client does by default)
+# vs the shared pooled transport, against a local TLS stand-in server.
+#   python benchmarks/transport.py [requests]
+import http.server
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import PooledHTTPHandler, SharedTransport  # noqa: E402
+
+BODY = b'{"status": "ok", "user": {"pk": 1, "username": "bench"}}'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        Handler.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        if self.headers.get("Connection", "").lower() == "close":
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_certificate(folder):
+    cert = os.path.join(folder, "cert.pem")
+    key = os.path.join(folder, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+         "-keyout", key, "-out", cert],
+        check=True, capture_output=True)
+    return cert, key
+
+
+def run(name, opener, url, count):
+    Handler.connections = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        request = urllib.request.Request(url, headers={"Connection": "close"})
+        with opener.open(request, timeout=10) as response:
+            response.read()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<10}{count / elapsed:>10.0f} req/s{elapsed / count * 1000:>10.2f} ms/req"
+          f"{Handler.connections:>8} handshakes")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.TemporaryDirectory() as folder:
+        cert, key = make_certificate(folder)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        server.socket = server_context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"https://localhost:{server.server_port}/api/v1/users/bench/usernameinfo/"
+
+        client_context = ssl.create_default_context(cafile=cert)
+        fresh = urllib.request.build_opener(urllib.request.HTTPSHandler(context=client_context))
+        pooled = urllib.request.build_opener(PooledHTTPHandler(SharedTransport(ca_certs=cert)))
+
+        run("fresh", fresh, url, count)
+        run("pooled", pooled, url, count)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import json
 import codecs
 import uuid
-import requests
 import os
 from flask import Flask, jsonify
 from datetime import datetime
@@ -41,43 +40,49 @@ password = 'Babakzeini1378@'
 # --------------------------
 settings_file = 'ig_settings.json'
 
-device_id = None
 api = None
 
-try:
-    if not os.path.isfile(settings_file):
-        print(f"Settings file not found. Logging in as {username}...")
-        api = Client(username, password, on_login=lambda x: on_login_callback(x, settings_file))
-    else:
-        with open(settings_file) as file_data:
-            cached_settings = json.load(file_data, object_hook=from_json)
-        print(f"Using cached settings from {settings_file}")
-        device_id = cached_settings.get('device_id')
-        api = Client(username, password, settings=cached_settings)
-except (ClientCookieExpiredError, ClientLoginRequiredError) as e:
-    print(f"Session expired. Re-logging in... ({e})")
-    api = Client(username, password, device_id=device_id, on_login=lambda x: on_login_callback(x, settings_file))
-except ClientLoginError as e:
-    print(f"Login error: {e}")
-    exit(9)
-except ClientError as e:
-    print(f"Client error: {e.msg} (Code: {e.code}, Response: {e.error_response})")
-    exit(9)
-except Exception as e:
-    print(f"Unexpected error: {e}")
-    exit(99)
-
-cookie_expiry = api.cookie_jar.auth_expires
-print('Cookie Expiry:', datetime.fromtimestamp(cookie_expiry).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+def login():
+    # logs in (or reuses ig_settings.json) when called, not at import time
+    global api
+    device_id = None
+    try:
+        if not os.path.isfile(settings_file):
+            print(f"Settings file not found. Logging in as {username}...")
+            api = Client(username, password, on_login=lambda x: on_login_callback(x, settings_file))
+        else:
+            with open(settings_file) as file_data:
+                cached_settings = json.load(file_data, object_hook=from_json)
+            print(f"Using cached settings from {settings_file}")
+            device_id = cached_settings.get('device_id')
+            api = Client(username, password, settings=cached_settings)
+    except (ClientCookieExpiredError, ClientLoginRequiredError) as e:
+        print(f"Session expired. Re-logging in... ({e})")
+        api = Client(username, password, device_id=device_id, on_login=lambda x: on_login_callback(x, settings_file))
+    except ClientLoginError as e:
+        print(f"Login error: {e}")
+        exit(9)
+    except ClientError as e:
+        print(f"Client error: {e.msg} (Code: {e.code}, Response: {e.error_response})")
+        exit(9)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        exit(99)
+
+    cookie_expiry = api.cookie_jar.auth_expires
+    print('Cookie Expiry:', datetime.fromtimestamp(cookie_expiry).strftime('%Y-%m-%dT%H:%M:%SZ'))
+    return api
 # -----------------------Avoid re-login----------------------
 
 
 # -----------------------set up private API-------------------
-results = api.feed_timeline()
-items = [item for item in results.get('feed_items', []) if item.get('media_or_ad')]
-for item in items:
-    ClientCompatPatch.media(item['media_or_ad'])
-    print(item['media_or_ad']['code'])
+def print_timeline():
+    results = api.feed_timeline()
+    items = [item for item in results.get('feed_items', []) if item.get('media_or_ad')]
+    for item in items:
+        ClientCompatPatch.media(item['media_or_ad'])
+        print(item['media_or_ad']['code'])
 
 
 # -----------------------set up private API-------------------
@@ -232,6 +237,7 @@ def is_user_private(target_username):
 
 
 def download_profile_picture(url, filename='profile_pic.jpg'):
+    import requests  # only needed here, keeps it off the import path
     try:
         response = requests.get(url, stream=True)
         if response.status_code == 200:
@@ -281,13 +287,6 @@ def compare_followers(snapshot1_path, snapshot2_path):
         return {}
 
 
-# Testing the methods-------------------------------------------
-my_followers = get_followers(username)
-# for user in my_followers['users']:
-#   print(user['username'], '-', user['full_name'])
-print(is_user_private("og.byg"))
-
-
 # --------------------------------------------------------------
 # Connecting backend to front
 @app.route('/call_server', methods=['POST'])
@@ -296,4 +295,13 @@ def call_server():
 
 
 if __name__ == '__main__':
+    login()
+    print_timeline()
+
+    # Testing the methods-------------------------------------------
+    my_followers = get_followers(username)
+    # for user in my_followers['users']:
+    #   print(user['username'], '-', user['full_name'])
+    print(is_user_private("og.byg"))
+
     app.run(host='127.0.0.1', port=8020)
@@ -0,0 +1,50 @@
+# Production server settings, run with:
+#   gunicorn -c gunicorn.conf.py "main:create_app()"
+# Send SIGHUP to the master for a graceful reload of all workers.
+import os
+
+if os.environ.get("WEB_WORKER_CLASS") == "gevent":
+    # patch before gunicorn and the app pull in ssl/socket
+    from gevent import monkey
+    monkey.patch_all()
+
+import multiprocessing  # noqa: E402
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# "gthread" gives each worker WEB_THREADS OS threads. "gevent" monkeypatches
+# sockets so a blocked upstream call yields, letting one worker hold up to
+# WEB_WORKER_CONNECTIONS in-flight requests without touching the handlers.
+worker_class = os.environ.get("WEB_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("WEB_THREADS", "8"))
+worker_connections = int(os.environ.get("WEB_WORKER_CONNECTIONS", "500"))
+timeout = int(os.environ.get("WEB_TIMEOUT", "120"))  # long enough for streamed follower exports
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("WEB_KEEPALIVE", "5"))
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.environ.get("WEB_MAX_REQUESTS_JITTER", "0"))
+# keep preload off with gevent, the app must be imported after monkeypatching
+preload_app = os.environ.get("WEB_PRELOAD", "0") == "1"
+reload = os.environ.get("WEB_RELOAD", "0") == "1"
+accesslog = os.environ.get("WEB_ACCESS_LOG") or None
+errorlog = "-"
+
+
+def on_starting(server):
+    # per-worker metric files of an earlier run, see METRICS_DIR in main.py
+    import shutil
+    shutil.rmtree(os.environ.get("METRICS_DIR", "metrics"), ignore_errors=True)
+
+
+def post_fork(server, worker):
+    import main
+    main.init_worker_state()
+    main.start_background_workers()
+
+
+def worker_exit(server, worker):
+    # write out the username pairs this worker still has buffered, and fold
+    # its metrics into the retired totals
+    import main
+    main.flush_username_index()
+    main.retire_metrics()
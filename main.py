@@ -1,16 +1,449 @@
+import base64
+import bisect
 import json
 import codecs
+import contextlib
+import fcntl
+import hashlib
+import heapq
+import hmac
+import http.client
+import io
+import ipaddress
+import mmap
 import uuid
-import requests
 import os
-from flask import Flask, jsonify, request
+import random
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import urllib.response
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, Flask, Response, g, jsonify, redirect, request, send_file
+from flask.json.provider import DefaultJSONProvider
 from datetime import datetime
+from urllib.parse import quote, urlparse
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used instead
+    orjson = None
+try:
+    import brotli
+except ImportError:  # optional, responses fall back to gzip
+    brotli = None
 from instagram_private_api import (
-    Client, ClientError, ClientLoginError,
+    Client, ClientError, ClientLoginError, ClientThrottledError,
     ClientCookieExpiredError, ClientLoginRequiredError, ClientCompatPatch)
+from instagram_private_api.http import ClientCookieJar
 
 
-app = Flask(__name__)
+bp = Blueprint("api", __name__)
+
+
+# -----------------------Metrics-----------------------
+# Minimal Prometheus-style counters and histograms, rendered in the text
+# exposition format on GET /metrics. Observing a value costs one bisect and
+# one lock. Each server worker keeps its own numbers and, in the spirit of
+# the Prometheus client's multiprocess mode, writes them to
+# METRICS_DIR/<pid>.json every METRICS_WRITE_INTERVAL seconds. /metrics adds
+# up every live worker's file, so any worker answers for the whole node. A
+# worker that exits folds its counts into retired.json so totals never go
+# back; gunicorn.conf.py empties the folder when the server starts. Gauges
+# (pool and cache state) are not summed but reported per worker, with a pid
+# label.
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+METRICS_WRITE_INTERVAL = float(os.environ.get("METRICS_WRITE_INTERVAL", "5"))  # seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SERIALIZATION_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+PIPELINE_BUCKETS = SERIALIZATION_BUCKETS + (2.5, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labels, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    def render(self, values=None):
+        # values: [labels, value] pairs, e.g. summed over workers
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.snapshot() if values is None else values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), list(counts)] for labels, counts in self._values.items()]
+
+    def render(self, values=None):
+        # values: [labels, bucket counts + sum] pairs, e.g. summed over workers
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, counts in self.snapshot() if values is None else values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+http_requests_total = Counter(
+    "igapi_http_requests_total", "HTTP requests by route and status.", ("route", "method", "status"))
+http_request_errors_total = Counter(
+    "igapi_http_request_errors_total", "Failed HTTP requests by route and error class.", ("route", "error"))
+http_request_seconds = Histogram(
+    "igapi_http_request_seconds", "Time to build the HTTP response by route.", ("route",))
+upstream_request_seconds = Histogram(
+    "igapi_upstream_request_seconds", "Instagram API call latency by call.", ("call",))
+upstream_errors_total = Counter(
+    "igapi_upstream_errors_total", "Failed Instagram API calls by call and error class.", ("call", "error"))
+session_hydration_seconds = Histogram(
+    "igapi_session_hydration_seconds", "Time to load stored settings and build a Client.")
+json_serialization_seconds = Histogram(
+    "igapi_json_serialization_seconds", "Time spent encoding JSON responses.", buckets=SERIALIZATION_BUCKETS)
+timeline_stage_seconds = Histogram(
+    "igapi_timeline_stage_seconds", "Timeline pipeline time per page by stage.", ("stage",),
+    buckets=PIPELINE_BUCKETS)
+METRICS = [http_requests_total, http_request_errors_total, http_request_seconds, upstream_request_seconds,
+           upstream_errors_total, session_hydration_seconds, json_serialization_seconds, timeline_stage_seconds]
+
+
+def worker_gauges():
+    # current state of the in-process pools and caches
+    gauges = {}
+    sections = [("session_pool", session_pool.stats()), ("response_cache", response_cache.stats()),
+                ("transport", get_transport().stats_dict()), ("cluster", cluster.stats())]
+    if media_transport is not None:
+        sections.append(("media_transport", media_transport.stats_dict()))
+    for prefix, stats in sections:
+        for name, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges[f"igapi_{prefix}_{name}"] = value
+    return gauges
+
+
+def metrics_snapshot(gauges=True):
+    return {
+        "metrics": {metric.name: metric.snapshot() for metric in METRICS},
+        "rate_governor": rate_governor.counters(),
+        "gauges": {str(os.getpid()): worker_gauges()} if gauges else {}
+    }
+
+
+def merge_metrics(snapshots):
+    # counters, histograms and rate governor counts add up, gauges are kept per worker
+    values = {}
+    rate_counts = {}
+    gauges = {}
+    for snapshot in snapshots:
+        for name, pairs in snapshot.get("metrics", {}).items():
+            merged = values.setdefault(name, {})
+            for labels, value in pairs:
+                key = tuple(labels)
+                if isinstance(value, list):
+                    merged[key] = [a + b for a, b in zip(merged.get(key, [0] * len(value)), value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        for endpoint_class, counts in snapshot.get("rate_governor", {}).items():
+            merged = rate_counts.setdefault(endpoint_class, {})
+            for name, value in counts.items():
+                merged[name] = merged.get(name, 0) + value
+        gauges.update(snapshot.get("gauges", {}))
+    return {
+        "metrics": {name: [[list(key), value] for key, value in merged.items()] for name, merged in values.items()},
+        "rate_governor": rate_counts,
+        "gauges": gauges
+    }
+
+
+def read_metrics_file(path):
+    try:
+        with open(path) as metrics_file:
+            return json.load(metrics_file)
+    except (OSError, ValueError):
+        return {}  # gone or being replaced
+
+
+def write_metrics_file(path, snapshot):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as metrics_file:
+        json.dump(snapshot, metrics_file)
+    os.replace(tmp_path, path)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def wait_flock(lock_file, operation, timeout=None):
+    # polls instead of blocking in flock, which would stall every greenlet
+    # of a gevent worker; False when timeout runs out first
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        try:
+            fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+@contextlib.contextmanager
+def metrics_dir_lock(operation):
+    # retiring a worker holds it exclusively, so a reader never counts the
+    # worker both in its own file and in retired.json
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, ".lock"), 'w') as lock_file:
+        wait_flock(lock_file, operation)
+        yield
+
+
+def write_metrics():
+    with metrics_dir_lock(fcntl.LOCK_SH):
+        write_metrics_file(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), metrics_snapshot())
+
+
+def metrics_writer(stop):
+    while not stop.wait(METRICS_WRITE_INTERVAL):
+        try:
+            write_metrics()
+        except Exception as e:
+            print(f"Error writing metrics: {e}")
+
+
+def retire_metrics():
+    with metrics_dir_lock(fcntl.LOCK_EX):
+        retired_path = os.path.join(METRICS_DIR, "retired.json")
+        write_metrics_file(retired_path, merge_metrics([read_metrics_file(retired_path),
+                                                        metrics_snapshot(gauges=False)]))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+
+
+def collect_metrics():
+    # this worker's numbers as they are now, the others' as last written;
+    # files of workers that died without retiring are left out
+    snapshots = [metrics_snapshot()]
+    with metrics_dir_lock(fcntl.LOCK_SH):
+        for name in os.listdir(METRICS_DIR):
+            stem, extension = os.path.splitext(name)
+            if extension != ".json" or stem == str(os.getpid()):
+                continue
+            if stem.isdigit() and not process_alive(int(stem)):
+                continue
+            snapshots.append(read_metrics_file(os.path.join(METRICS_DIR, name)))
+    return merge_metrics(snapshots)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            json_serialization_seconds.observe(time.perf_counter() - started)
+
+
+# JSON_PROVIDER=orjson (default) encodes responses and NDJSON lines with
+# orjson when it is installed; JSON_PROVIDER=stdlib keeps Flask's encoder.
+JSON_PROVIDER = os.environ.get("JSON_PROVIDER", "orjson")
+USE_ORJSON = JSON_PROVIDER == "orjson" and orjson is not None
+
+
+class FastJSONProvider(TimedJSONProvider):
+    # Same output as the default provider (sorted keys, Flask's handling of
+    # dates, decimals and the like through default) but encoded by orjson
+    # straight to bytes. Anything orjson refuses, e.g. ints wider than
+    # 64 bits, goes through the stdlib encoder.
+
+    def _option(self, indent=False):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumpb(self, obj, indent=False):
+        started = time.perf_counter()
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._option(indent))
+        except TypeError:
+            layout = {"indent": 2} if indent else {"separators": (",", ":")}
+            return DefaultJSONProvider.dumps(self, obj, **layout).encode()
+        finally:
+            json_serialization_seconds.observe(time.perf_counter() - started)
+
+    def dumps(self, obj, **kwargs):
+        if set(kwargs) - {"indent", "separators"}:
+            return super().dumps(obj, **kwargs)
+        return self.dumpb(obj, indent=bool(kwargs.get("indent"))).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.dumpb(obj, indent=indent) + b"\n", mimetype=self.mimetype)
+
+
+def ndjson_line(obj):
+    if USE_ORJSON:
+        try:
+            return orjson.dumps(obj) + b"\n"
+        except TypeError:
+            pass  # e.g. ints wider than 64 bits
+    return json.dumps(obj, separators=(",", ":")).encode() + b"\n"
+
+
+# -----------------------Response compression-----------------------
+# compress_response() gzips or brotli-compresses a response when the client
+# asks for it in Accept-Encoding (brotli preferred when installed). Streamed
+# bodies are compressed chunk by chunk and flushed after every chunk, so a
+# page of followers still reaches the client as soon as it is fetched.
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))  # bytes
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+
+
+def negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"] > 0:
+        return "br"
+    if accepted["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+def compress_bytes(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_chunks(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None or response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress_bytes(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def timed_upstream_call(func, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        upstream_errors_total.inc(func.__name__, type(e).__name__)
+        raise
+    finally:
+        upstream_request_seconds.observe(time.perf_counter() - started, func.__name__)
+
+
+def note_error(e):
+    g.error_class = type(e).__name__
+
+
+def route_label():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        route = route_label()
+        http_request_seconds.observe(time.perf_counter() - started, route)
+        http_requests_total.inc(route, request.method, str(response.status_code))
+        if response.status_code >= 400:
+            http_request_errors_total.inc(route, g.get("error_class") or f"http_{response.status_code}")
+    return response
 
 
 # -----------------------Set up private API and Avoid re-login----------------------
@@ -29,521 +462,4380 @@ def from_json(json_object):
     return json_object
 
 
-def on_login_callback(api, new_settings_file):
-    cache_settings = api.settings
-    with open(new_settings_file, 'w') as outfile:
-        json.dump(cache_settings, outfile, default=to_json)
-        print('SAVED: {0!s}'.format(new_settings_file))
+SESSION_FOLDER = "sessions"  # folder to store session files
+UPSTREAM_API_URL = os.environ.get("INSTAGRAM_API_URL") or None  # point at a stand-in upstream
 
 
-SESSION_FOLDER = "sessions"  # folder to store session files
+# -----------------------Session store-----------------------
+# Settings are stored per token by one of three backends, picked with
+# SESSION_STORE: "file" (one file per token), "sqlite" (single WAL database)
+# or "redis" (any Redis-protocol server). All of them keep settings in the
+# versioned binary encoding below: a b"IGS" magic, a format version byte,
+# then tagged values with raw bytes stored as-is (no base64).
+SESSION_STORE = os.environ.get("SESSION_STORE", "file")
+SESSION_STORE_URL = os.environ.get("SESSION_STORE_URL", "")
+
+LOGIN_LOCK_POLL = 0.05  # seconds between tries for a login lock held by another worker
+
+SETTINGS_MAGIC = b"IGS"
+SETTINGS_FORMAT_VERSION = 1
+INT64 = struct.Struct(">q")
+FLOAT64 = struct.Struct(">d")
+LENGTH = struct.Struct(">I")
+
+
+def _encode_value(value, out):
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        out += b"i"
+        out += INT64.pack(value)
+    elif isinstance(value, float):
+        out += b"d"
+        out += FLOAT64.pack(value)
+    elif isinstance(value, (bytes, bytearray)):
+        out += b"b"
+        out += LENGTH.pack(len(value))
+        out += value
+    elif isinstance(value, str):
+        raw = value.encode()
+        out += b"s"
+        out += LENGTH.pack(len(raw))
+        out += raw
+    elif isinstance(value, (list, tuple)):
+        out += b"l"
+        out += LENGTH.pack(len(value))
+        for item in value:
+            _encode_value(item, out)
+    elif isinstance(value, dict):
+        out += b"m"
+        out += LENGTH.pack(len(value))
+        for key, item in value.items():
+            _encode_value(str(key), out)
+            _encode_value(item, out)
+    else:
+        raise TypeError(repr(value) + ' is not serializable')
+
+
+def _decode_value(buffer, offset):
+    tag = buffer[offset]
+    offset += 1
+    if tag == 115:  # s
+        length = LENGTH.unpack_from(buffer, offset)[0]
+        offset += 4
+        return buffer[offset:offset + length].decode(), offset + length
+    if tag == 105:  # i
+        return INT64.unpack_from(buffer, offset)[0], offset + 8
+    if tag == 109:  # m
+        length = LENGTH.unpack_from(buffer, offset)[0]
+        offset += 4
+        items = {}
+        for _ in range(length):
+            key, offset = _decode_value(buffer, offset)
+            items[key], offset = _decode_value(buffer, offset)
+        return items, offset
+    if tag == 98:  # b
+        length = LENGTH.unpack_from(buffer, offset)[0]
+        offset += 4
+        return buffer[offset:offset + length], offset + length
+    if tag == 108:  # l
+        length = LENGTH.unpack_from(buffer, offset)[0]
+        offset += 4
+        items = []
+        for _ in range(length):
+            item, offset = _decode_value(buffer, offset)
+            items.append(item)
+        return items, offset
+    if tag == 78:  # N
+        return None, offset
+    if tag == 84:  # T
+        return True, offset
+    if tag == 70:  # F
+        return False, offset
+    if tag == 100:  # d
+        return FLOAT64.unpack_from(buffer, offset)[0], offset + 8
+    raise ValueError(f"Unknown settings tag {tag!r}")
+
+
+def encode_settings(settings):
+    out = bytearray(SETTINGS_MAGIC)
+    out.append(SETTINGS_FORMAT_VERSION)
+    _encode_value(settings, out)
+    return bytes(out)
+
+
+def decode_settings(blob):
+    blob = bytes(blob)
+    if blob[:3] != SETTINGS_MAGIC:
+        raise ValueError("Not an encoded settings blob")
+    if blob[3] != SETTINGS_FORMAT_VERSION:
+        raise ValueError(f"Unsupported settings format version {blob[3]}")
+    settings, _ = _decode_value(blob, 4)
+    return settings
+
+
+class FileSessionStore:
+    # One settings_{token}.bin per token in the binary encoding above. Legacy
+    # settings_{token}.json files are still read and rewritten as .bin the
+    # first time they are loaded.
+
+    def __init__(self, folder):
+        self.folder = folder  # created by the first save, not at startup
+
+    def path(self, token, suffix=".bin"):
+        return os.path.join(self.folder, f"settings_{token}{suffix}")
+
+    def version(self, token):
+        for suffix in (".bin", ".json"):
+            try:
+                return os.stat(self.path(token, suffix)).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return None
+
+    def load(self, token):
+        try:
+            with open(self.path(token), 'rb') as file_data:
+                return decode_settings(file_data.read())
+        except FileNotFoundError:
+            pass
+        legacy_file = self.path(token, ".json")
+        try:
+            with open(legacy_file) as file_data:
+                settings = json.load(file_data, object_hook=from_json)
+        except FileNotFoundError:
+            return None
+        self.save(token, settings)
+        try:
+            os.remove(legacy_file)
+        except FileNotFoundError:  # another worker migrated it first
+            pass
+        print('MIGRATED: {0!s}'.format(legacy_file))
+        return settings
+
+    def _write(self, path, data):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, path)
+
+    def save(self, token, settings):
+        self._write(self.path(token), encode_settings(settings))
+
+    def delete(self, token):
+        for suffix in (".bin", ".json"):
+            try:
+                os.remove(self.path(token, suffix))
+            except FileNotFoundError:
+                pass
+
+    def login_path(self, username):
+        return os.path.join(self.folder, f"login_{hashlib.sha256(username.encode()).hexdigest()}.bin")
+
+    def load_login(self, username):
+        try:
+            with open(self.login_path(username), 'rb') as file_data:
+                return decode_settings(file_data.read())
+        except FileNotFoundError:
+            return None
+
+    def save_login(self, username, record):
+        self._write(self.login_path(username), encode_settings(record))
+
+    def delete_login(self, username):
+        try:
+            os.remove(self.login_path(username))
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def lock_login(self, username, timeout):
+        # flock is dropped by the kernel if the worker dies
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.login_path(username)[:-len(".bin")] + ".lock", 'w') as lock_file:
+            if not wait_flock(lock_file, fcntl.LOCK_EX, timeout):
+                raise LoginInProgress("Another login for this account is still running")
+            yield
+
+    def logins(self):
+        # file names only carry a hash, so records written before they kept
+        # their username cannot be listed
+        if not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            if name.startswith("login_") and name.endswith(".bin"):
+                try:
+                    with open(os.path.join(self.folder, name), 'rb') as file_data:
+                        record = decode_settings(file_data.read())
+                except FileNotFoundError:
+                    continue
+                if record.get("username"):
+                    yield record["username"], record
+
+    def tokens(self):
+        if not os.path.isdir(self.folder):
+            return
+        seen = set()
+        for name in os.listdir(self.folder):
+            root, suffix = os.path.splitext(name)
+            if root.startswith("settings_") and suffix in (".bin", ".json"):
+                token = root[len("settings_"):]
+                if token not in seen:
+                    seen.add(token)
+                    yield token
+
+
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "4"))
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "30"))  # seconds
+SQLITE_BUSY_CODES = (5, 261)  # SQLITE_BUSY, SQLITE_BUSY_RECOVERY; SQLITE_BUSY_SNAPSHOT never clears
+
+
+def retry_busy(call, *args):
+    # SQLite's own busy handler sleeps inside the C library, which stalls
+    # every greenlet of a gevent worker for as long as another process holds
+    # the write lock. Connections are opened with it off and wait here
+    # instead, in time.sleep, which gevent makes cooperative.
+    deadline = time.monotonic() + SQLITE_BUSY_TIMEOUT
+    delay = 0.001
+    while True:
+        try:
+            return call(*args)
+        except sqlite3.OperationalError as e:
+            if getattr(e, "sqlite_errorcode", 5) not in SQLITE_BUSY_CODES or time.monotonic() > deadline:
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+class CooperativeConnection(sqlite3.Connection):
+    # waits for locks through retry_busy; a statement that failed with
+    # SQLITE_BUSY had no effect, so running it again is safe (the scripts
+    # are the stores' CREATE ... IF NOT EXISTS setups)
+    def execute(self, *args):
+        return retry_busy(super().execute, *args)
+
+    def executemany(self, *args):
+        return retry_busy(super().executemany, *args)
+
+    def executescript(self, *args):
+        return retry_busy(super().executescript, *args)
+
+    def commit(self):
+        return retry_busy(super().commit)
+
+    def __exit__(self, exc_type, exc, traceback):
+        # the C version commits without going through commit()
+        if exc_type is None:
+            try:
+                self.commit()
+            except BaseException:
+                self.rollback()
+                raise
+        else:
+            self.rollback()
+        return False
+
+
+class SQLitePool:
+    # A few connections shared by all threads (or greenlets under gevent),
+    # like RedisSessionStore's pool; a per-thread connection would become a
+    # connection per greenlet. Each connection is used by one caller at a
+    # time, opened on first use, not at startup, and set up by setup(conn).
+
+    def __init__(self, path, setup, pool_size=SQLITE_POOL_SIZE, **connect_args):
+        self.path = path
+        self.setup = setup
+        self.connect_args = connect_args
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._slots:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = sqlite3.connect(self.path, timeout=0, check_same_thread=False, factory=CooperativeConnection,
+                                       **self.connect_args)
+                try:
+                    self.setup(conn)
+                except BaseException:
+                    conn.close()
+                    raise
+            try:
+                yield conn
+            finally:
+                # never hand the next caller a transaction left open
+                try:
+                    if conn.in_transaction:
+                        conn.rollback()
+                except sqlite3.Error:
+                    conn.close()
+                else:
+                    with self._lock:
+                        self._idle.append(conn)
+
+
+class SQLiteSessionStore:
+    def __init__(self, path):
+        self.path = path
+        # sqlite3 caches the prepared statements per connection
+        self._pool = SQLitePool(path, self._setup, cached_statements=64)
+
+    @staticmethod
+    def _setup(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "token TEXT PRIMARY KEY, settings BLOB NOT NULL, "
+                "version INTEGER NOT NULL DEFAULT 1, updated_at INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS logins (username TEXT PRIMARY KEY, record BLOB NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS login_locks (username TEXT PRIMARY KEY, owner TEXT NOT NULL,"
+                         " expires REAL NOT NULL)")
+
+    def version(self, token):
+        with self._pool.connection() as conn:
+            row = conn.execute("SELECT version FROM sessions WHERE token = ?", (token,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, token):
+        with self._pool.connection() as conn:
+            row = conn.execute("SELECT settings FROM sessions WHERE token = ?", (token,)).fetchone()
+        return decode_settings(row[0]) if row else None
+
+    def save(self, token, settings):
+        with self._pool.connection() as conn, conn:
+            conn.execute(
+                "INSERT INTO sessions (token, settings, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(token) DO UPDATE SET settings = excluded.settings, "
+                "version = version + 1, updated_at = excluded.updated_at",
+                (token, encode_settings(settings), int(time.time())))
+
+    def delete(self, token):
+        with self._pool.connection() as conn, conn:
+            conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+
+    def load_login(self, username):
+        with self._pool.connection() as conn:
+            row = conn.execute("SELECT record FROM logins WHERE username = ?", (username,)).fetchone()
+        return decode_settings(row[0]) if row else None
+
+    def save_login(self, username, record):
+        with self._pool.connection() as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO logins (username, record) VALUES (?, ?)",
+                (username, encode_settings(record)))
+
+    def delete_login(self, username):
+        with self._pool.connection() as conn, conn:
+            conn.execute("DELETE FROM logins WHERE username = ?", (username,))
+
+    @contextlib.contextmanager
+    def lock_login(self, username, timeout):
+        # a lease row rather than a held write transaction, which would
+        # stall every session save for the length of the upstream login
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._pool.connection() as conn, conn:
+                conn.execute("DELETE FROM login_locks WHERE username = ? AND expires < ?", (username, time.time()))
+                acquired = conn.execute(
+                    "INSERT OR IGNORE INTO login_locks (username, owner, expires) VALUES (?, ?, ?)",
+                    (username, owner, time.time() + timeout)).rowcount == 1
+            if acquired:
+                break
+            if time.monotonic() > deadline:
+                raise LoginInProgress("Another login for this account is still running")
+            time.sleep(LOGIN_LOCK_POLL)
+        try:
+            yield
+        finally:
+            with self._pool.connection() as conn, conn:
+                conn.execute("DELETE FROM login_locks WHERE username = ? AND owner = ?", (username, owner))
+
+    def logins(self):
+        with self._pool.connection() as conn:
+            rows = conn.execute("SELECT username, record FROM logins").fetchall()
+        for username, record in rows:
+            yield username, decode_settings(record)
+
+    def tokens(self):
+        with self._pool.connection() as conn:
+            rows = conn.execute("SELECT token FROM sessions").fetchall()
+        for (token,) in rows:
+            yield token
+
+
+REDIS_POOL_SIZE = int(os.environ.get("REDIS_POOL_SIZE", "16"))
+REDIS_RELEASE_SCRIPT = 'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("DEL", KEYS[1]) end return 0'
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    # Minimal RESP2 client, enough for the session store. Works against
+    # Redis or any server speaking the same protocol.
+
+    def __init__(self, host, port, db=0, password=None, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    def _send(self, *commands):
+        out = bytearray()
+        for args in commands:
+            out += b"*%d\r\n" % len(args)
+            for arg in args:
+                if not isinstance(arg, bytes):
+                    arg = str(arg).encode()
+                out += b"$%d\r\n%s\r\n" % (len(arg), arg)
+        self.sock.sendall(out)
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            # returned, not raised, so the rest of a pipeline or array is
+            # still read off the socket
+            return RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+        raise RedisError(f"Unexpected reply {line!r}")
+
+    def execute(self, *args):
+        return self.pipeline(args)[0]
+
+    def pipeline(self, *commands):
+        self._send(*commands)
+        replies = [self._read() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisSessionStore:
+    # Connections come from a small pool shared by all threads (or
+    # greenlets under gevent), opened on first use, not at startup.
+
+    def __init__(self, url, pool_size=REDIS_POOL_SIZE):
+        parsed = urlparse(url or "redis://127.0.0.1:6379/0")
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _execute(self, *commands):
+        with self._slots:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            try:
+                if conn is None:
+                    conn = RedisConnection(self.host, self.port, self.db, self.password)
+                replies = conn.pipeline(*commands)
+            except Exception:
+                # an error reply, a parse error or a broken socket: never
+                # reuse the connection, its replies may be out of step
+                if conn is not None:
+                    conn.close()
+                raise
+            with self._lock:
+                self._idle.append(conn)
+            return replies
+
+    @staticmethod
+    def key(token):
+        return f"session:{token}"
+
+    def version(self, token):
+        version = self._execute(("HGET", self.key(token), "version"))[0]
+        return int(version) if version is not None else None
+
+    def load(self, token):
+        blob = self._execute(("HGET", self.key(token), "settings"))[0]
+        return decode_settings(blob) if blob is not None else None
+
+    def save(self, token, settings):
+        key = self.key(token)
+        self._execute(
+            ("HSET", key, "settings", encode_settings(settings), "updated_at", int(time.time())),
+            ("HINCRBY", key, "version", 1))
+
+    def delete(self, token):
+        self._execute(("DEL", self.key(token)))
+
+    def load_login(self, username):
+        blob = self._execute(("GET", f"login:{username}"))[0]
+        return decode_settings(blob) if blob is not None else None
+
+    def save_login(self, username, record):
+        self._execute(("SET", f"login:{username}", encode_settings(record)))
+
+    def delete_login(self, username):
+        self._execute(("DEL", f"login:{username}"))
+
+    @contextlib.contextmanager
+    def lock_login(self, username, timeout):
+        key = f"login_lock:{username}"
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while self._execute(("SET", key, owner, "NX", "PX", int(timeout * 1000)))[0] is None:
+            if time.monotonic() > deadline:
+                raise LoginInProgress("Another login for this account is still running")
+            time.sleep(LOGIN_LOCK_POLL)
+        try:
+            yield
+        finally:
+            # only release our own lease, not one taken over after it expired
+            self._execute(("EVAL", REDIS_RELEASE_SCRIPT, 1, key, owner))
+
+    def logins(self):
+        for username in list(self._scan("login:*")):
+            record = self.load_login(username)
+            if record is not None:
+                yield username, record
+
+    def _scan(self, pattern):
+        cursor = "0"
+        while True:
+            cursor, keys = self._execute(("SCAN", cursor, "MATCH", pattern, "COUNT", 1000))[0]
+            cursor = cursor.decode()
+            for key in keys:
+                yield key.decode().split(":", 1)[1]
+            if cursor == "0":
+                return
+
+    def tokens(self):
+        return self._scan("session:*")
+
+
+def create_session_store():
+    if SESSION_STORE == "file":
+        return FileSessionStore(SESSION_STORE_URL or SESSION_FOLDER)
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore(SESSION_STORE_URL or "sessions.db")
+    if SESSION_STORE == "redis":
+        return RedisSessionStore(SESSION_STORE_URL)
+    raise ValueError(f"Unknown SESSION_STORE {SESSION_STORE!r}")
+
+
+# -----------------------Shared HTTP transport-----------------------
+# Every hydrated Client and the media downloader go through one urllib3
+# PoolManager, so TCP/TLS connections are kept alive and reused across
+# requests instead of one handshake per call (Client sends
+# "Connection: close" and opens a fresh connection each time by default).
+# New connections resolve hosts through a small TTL DNS cache.
+# UPSTREAM_HTTP2=1 switches HTTPS to HTTP/2 when the h2 package is
+# installed (urllib3's experimental support, which only offers h2).
+UPSTREAM_POOL_HOSTS = int(os.environ.get("UPSTREAM_POOL_HOSTS", "32"))
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get("UPSTREAM_POOL_MAXSIZE", "32"))  # connections kept per host
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "0") == "1"
+DNS_CACHE_TTL = int(os.environ.get("DNS_CACHE_TTL", "300"))
+
+
+class DNSCache:
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+        with self._lock:
+            self._entries[host] = (address, now + self.ttl)
+        return address
+
+    def forget(self, host):
+        with self._lock:
+            self._entries.pop(host, None)
+
+
+class TransportStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.new_connections = 0
+
+
+def is_public_address(address):
+    address = ipaddress.ip_address(address)
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.is_global
+
+
+class CachedDNSConnectionMixin:
+    dns_cache = None
+    stats = None
+    public_only = False  # refuse loopback, private, link-local and other non-public addresses
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            ipaddress.ip_address(host)
+            cached = False
+        except ValueError:
+            cached = True
+        if cached:
+            try:
+                self._dns_host = self.dns_cache.resolve(host, self.port)
+            except OSError:
+                if self.public_only:
+                    raise
+                cached = False  # let urllib3 resolve and report the error
+        # checked on the address actually connected to, so a redirect or a
+        # DNS answer pointing inside the network is refused as well
+        if self.public_only and not is_public_address(self._dns_host):
+            address = self._dns_host
+            self._dns_host = host
+            raise OSError(f"Refusing to connect to non-public address {address} for {host}")
+        try:
+            conn = super()._new_conn()
+        except Exception:
+            if cached:
+                self.dns_cache.forget(host)
+            raise
+        finally:
+            self._dns_host = host
+        with self.stats.lock:
+            self.stats.new_connections += 1
+        return conn
+
+
+class SharedTransport:
+    def __init__(self, public_only=False, **pool_kw):
+        import urllib3  # loaded on first use, keeps it off the startup path
+        if UPSTREAM_HTTP2:
+            from urllib3.http2 import inject_into_urllib3
+            inject_into_urllib3()
+        # kept for open() and PooledHTTPHandler, which run on every request
+        self.timeout_class = urllib3.Timeout
+        self.exceptions = urllib3.exceptions
+        self.dns_cache = DNSCache()
+        self.stats = TransportStats()
+        attrs = {"dns_cache": self.dns_cache, "stats": self.stats, "public_only": public_only}
+        http_connection = type("PooledHTTPConnection",
+                               (CachedDNSConnectionMixin, urllib3.connection.HTTPConnection), attrs)
+        https_connection = type("PooledHTTPSConnection",
+                                (CachedDNSConnectionMixin, urllib3.connection.HTTPSConnection), attrs)
+        pool_kw.setdefault("maxsize", UPSTREAM_POOL_MAXSIZE)
+        self.pool = urllib3.PoolManager(num_pools=UPSTREAM_POOL_HOSTS, **pool_kw)
+        self.pool.pool_classes_by_scheme = {
+            "http": type("PooledHTTPConnectionPool", (urllib3.HTTPConnectionPool,),
+                         {"ConnectionCls": http_connection}),
+            "https": type("PooledHTTPSConnectionPool", (urllib3.HTTPSConnectionPool,),
+                          {"ConnectionCls": https_connection}),
+        }
+
+    def open(self, method, url, body=None, headers=None, timeout=None, preload_content=True):
+        with self.stats.lock:
+            self.stats.requests += 1
+        try:
+            return self.pool.urlopen(
+                method, url, body=body, headers=headers, redirect=False, retries=False,
+                decode_content=False, preload_content=preload_content, timeout=self.timeout_class(total=timeout))
+        except Exception:
+            with self.stats.lock:
+                self.stats.errors += 1
+            raise
+
+    def stats_dict(self):
+        hosts = {}
+        for key in list(self.pool.pools.keys()):
+            pool = self.pool.pools.get(key)
+            if pool is None:
+                continue
+            hosts[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                # the queue is pre-filled with None placeholders, count real connections
+                "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0
+            }
+        with self.stats.lock:
+            return {
+                "requests": self.stats.requests,
+                "errors": self.stats.errors,
+                "new_connections": self.stats.new_connections,
+                "dns_cache": {"hits": self.dns_cache.hits, "misses": self.dns_cache.misses},
+                "http2": UPSTREAM_HTTP2,
+                "hosts": hosts
+            }
+
+
+class PooledHTTPHandler(urllib.request.BaseHandler):
+    # Sends requests through a SharedTransport. It is added to the Client's
+    # own opener ahead of the stock HTTP(S) handlers, so the library's proxy,
+    # SSL context, cookie and error handling stay in place: requests routed
+    # through a proxy, and https when the Client has its own SSL context,
+    # are declined and fall through to the stock handlers. urllib3 failures
+    # are raised as the errors urllib itself raises, which the library turns
+    # into ClientConnectionError.
+    handler_order = urllib.request.HTTPHandler.handler_order - 10
+
+    def __init__(self, transport, https=True):
+        self.transport = transport
+        self.https = https
+
+    def _open(self, req):
+        if req.host != urlparse(req.full_url).netloc:
+            return None  # ProxyHandler pointed it at a proxy
+        headers = dict(req.header_items())
+        headers.pop("Connection", None)
+        errors = self.transport.exceptions
+        try:
+            response = self.transport.open(
+                req.get_method(), req.full_url, body=req.data, headers=headers, timeout=req.timeout)
+        except errors.ReadTimeoutError as e:
+            raise socket.timeout(str(e)) from e
+        except errors.ProtocolError as e:
+            # "Connection aborted." wraps the socket or http.client error
+            cause = e.args[-1]
+            if isinstance(cause, (OSError, http.client.HTTPException)):
+                raise cause from e
+            raise http.client.HTTPException(str(e)) from e
+        except errors.HTTPError as e:
+            # connect, DNS and TLS failures, reported like urllib does
+            raise urllib.error.URLError(e) from e
+        message = http.client.HTTPMessage()
+        for name, value in response.headers.iteritems():
+            message[name] = value
+        result = urllib.response.addinfourl(io.BytesIO(response.data), message, req.full_url, response.status)
+        result.msg = response.reason
+        return result
+
+    def http_open(self, req):
+        return self._open(req)
+
+    def https_open(self, req):
+        return self._open(req) if self.https else None
+
+
+transport = None
+transport_lock = threading.Lock()
+
+
+def get_transport():
+    global transport
+    with transport_lock:
+        if transport is None:
+            transport = SharedTransport()
+        return transport
+
+
+def use_shared_transport(api):
+    # https stays with the library's handler when it was given an SSL context
+    custom_context = any(getattr(handler, "_context", None) is not None for handler in api.opener.handlers)
+    api.opener.add_handler(PooledHTTPHandler(get_transport(), https=not custom_context))
+    return api
+
+
+@bp.route("/stats/transport", methods=["GET"])
+def transport_stats():
+    return jsonify({
+        "status": "success",
+        "transport": get_transport().stats_dict(),
+        # profile picture downloads, null until the first one
+        "media_transport": media_transport.stats_dict() if media_transport is not None else None
+    })
+
+
+class StandInClient(Client):
+    # Client reads cookies back by matching them against the default API
+    # host, so follow INSTAGRAM_API_URL's host when it points at a stand-in.
+
+    def get_cookie_value(self, key, domain=''):
+        return super().get_cookie_value(key, domain or urlparse(self.api_url).hostname)
+
+
+def new_client(username, password, **kwargs):
+    client_class = StandInClient if UPSTREAM_API_URL else Client
+    return client_class(username, password, **kwargs)
+
+
+session_store = create_session_store()
+
+
+def on_login_callback(api, token):
+    cache_settings = api.settings
+    session_store.save(token, cache_settings)
+    print('SAVED: session {0!s}'.format(token))
 
-if not os.path.exists(SESSION_FOLDER):
-    os.makedirs(SESSION_FOLDER)
 
 api: Client = None
 settings_file = "settings.json"
 
 
-@app.route("/login", methods=["POST"])
+# -----------------------Login manager-----------------------
+# A repeat login for the same username reuses the stored session instead of
+# doing a new upstream login, as long as the password matches the salted
+# hash kept with it. Sessions within LOGIN_REFRESH_MARGIN of their cookie
+# expiry are logged in again under the same token and device id, and
+# concurrent logins for one account wait on a single upstream login.
+LOGIN_REFRESH_MARGIN = int(os.environ.get("LOGIN_REFRESH_MARGIN", str(24 * 3600)))  # seconds
+LOGIN_LOCK_TIMEOUT = float(os.environ.get("LOGIN_LOCK_TIMEOUT", "120"))  # seconds
+LOGIN_BUSY_RETRY_AFTER = int(os.environ.get("LOGIN_BUSY_RETRY_AFTER", "5"))  # seconds
+
+
+class LoginInProgress(TimeoutError):
+    # the login lock was still held by another worker when the wait ran out
+    pass
+
+
+class KeyedLocks:
+    # one lock per key, dropped again once nobody holds or waits on it, so
+    # the table only ever has as many entries as keys in use
+    def __init__(self):
+        self._entries = {}  # key -> [lock, holders and waiters]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._entries[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def hash_password(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=2 ** 14, r=8, p=1)
+
+
+def account_shard(username):
+    return hashlib.sha256(username.encode()).hexdigest()[:16]
+
+
+def new_token(username):
+    # "<account shard>.<uuid>": in a cluster the token is routed by the
+    # account shard, so it lands on the node holding the login record
+    return f"{account_shard(username)}.{uuid.uuid4()}"
+
+
+class LoginManager:
+    def __init__(self):
+        self._locks = KeyedLocks()
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.refreshed = 0
+        self.fresh = 0
+
+    def login(self, username, password):
+        key = username.strip().lower()
+        # the thread lock queues this worker's logins, the store lock the
+        # other workers' (and nodes' on a shared store); the record is only
+        # read once both are held, so a waiter reuses the session just made
+        with self._locks.hold(key), session_store.lock_login(key, LOGIN_LOCK_TIMEOUT):
+            record = session_store.load_login(key)
+            if record is not None and not hmac.compare_digest(
+                    hash_password(password, record["salt"]), record["password_hash"]):
+                record = None  # wrong or changed password, never hand out the stored session
+
+            token = None
+            device_id = None
+            if record is not None:
+                token = record["token"]
+                try:
+                    api = session_pool.get(token)
+                    expires = api.cookie_jar.auth_expires or 0
+                    if expires - time.time() > LOGIN_REFRESH_MARGIN:
+                        self.reused += 1
+                        return token, api, True
+                    device_id = api.device_id
+                except Exception:
+                    pass  # missing or unusable session, log in again under the same token
+                self.refreshed += 1
+            else:
+                token = new_token(key)
+                self.fresh += 1
+
+            kwargs = {"device_id": device_id} if device_id else {}
+            api = new_client(
+                username,
+                password,
+                api_url=UPSTREAM_API_URL,
+                on_login=lambda x: on_login_callback(x, token),
+                **kwargs
+            )
+            salt = os.urandom(16)
+            session_store.save_login(key, {"username": key, "token": token, "salt": salt,
+                                           "password_hash": hash_password(password, salt)})
+            return token, api, False
+
+    def stats(self):
+        with self._lock:
+            return {"reused": self.reused, "refreshed": self.refreshed, "fresh": self.fresh}
+
+
+login_manager = LoginManager()
+
+
+@bp.route("/login", methods=["POST"])
 def login():
     data = request.json
     username = data.get("username", "")
     password = data.get("password", "")
 
-    if not username or not password:
+    if not is_username(username) or not isinstance(password, str) or not password:
         return jsonify({"status": "error", "message": "Username and password required"}), 400
 
-    # generate token
-    token = str(uuid.uuid4())
-    settings_file = os.path.join(SESSION_FOLDER, f"settings_{token}.json")
-
-    device_id = None
-
     try:
-        api = Client(
-            username,
-            password,
-            on_login=lambda x: on_login_callback(x, settings_file)
-        )
+        token, api, reused = login_manager.login(username, password)
+    except LoginInProgress as e:
+        # nothing is wrong with the request, the other login just has not finished
+        note_error(e)
+        response = jsonify({"status": "error", "message": str(e), "retry_after": LOGIN_BUSY_RETRY_AFTER})
+        response.headers["Retry-After"] = str(LOGIN_BUSY_RETRY_AFTER)
+        return response, 503
     except (ClientLoginError, ClientCookieExpiredError, ClientLoginRequiredError) as e:
+        note_error(e)
         return jsonify({"status": "error", "message": str(e)}), 400
     except ClientError as e:
+        note_error(e)
         return jsonify({"status": "error", "message": e.msg}), 400
     except Exception as e:
+        note_error(e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
-    # success
-    cookie_expiry = api.cookie_jar.auth_expires
-    expiry_str = datetime.fromtimestamp(cookie_expiry).strftime('%Y-%m-%dT%H:%M:%SZ')
+    # success
+    cookie_expiry = api.cookie_jar.auth_expires
+    expiry_str = datetime.fromtimestamp(cookie_expiry).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    return jsonify({
+        "status": "success",
+        "message": f"Logged in as {username}",
+        "token": token,
+        "cookie_expiry": expiry_str,
+        "reused_session": reused
+    })
+
+
+@bp.route("/stats/logins", methods=["GET"])
+def login_stats():
+    return jsonify({
+        "status": "success",
+        "logins": login_manager.stats()
+    })
+
+
+# -----------------------Set up private API and Avoid re-login----------------------
+
+
+# -----------------------UTILITY: Get API from token-----------------------
+SESSION_POOL_MAX_SIZE = int(os.environ.get("SESSION_POOL_MAX_SIZE", "1024"))
+SESSION_POOL_TTL = int(os.environ.get("SESSION_POOL_TTL", "3600"))  # seconds
+
+
+def load_api_from_settings(cached_settings):
+    # username = cached_settings.get('username_id')  # optional log
+    # device_id = cached_settings.get('device_id')
+
+    api = new_client(
+        None, None,  # username/password not needed
+        settings=cached_settings,
+        api_url=UPSTREAM_API_URL
+    )
+    return use_shared_transport(api)
+
+
+class SessionPool:
+    # Keeps hydrated Clients in memory so a request only pays for a cheap
+    # version check instead of loading, decoding and rebuilding the Client
+    # every time. Entries are evicted LRU when the pool is full, after
+    # SESSION_POOL_TTL seconds, or when the stored settings change.
+
+    def __init__(self, max_size=SESSION_POOL_MAX_SIZE, ttl=SESSION_POOL_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token -> (api, store version, loaded_at)
+        self._lock = threading.Lock()
+        self._token_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _token_lock(self, token):
+        with self._lock:
+            lock = self._token_locks.get(token)
+            if lock is None:
+                lock = self._token_locks[token] = threading.Lock()
+            return lock
+
+    def _lookup(self, token, version):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            api, loaded_version, loaded_at = entry
+            if loaded_version != version or time.monotonic() - loaded_at > self.ttl:
+                del self._entries[token]
+                self.invalidations += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return api
+
+    def get(self, token):
+        version = session_store.version(token)
+        if version is None and cluster.pull_session(token):
+            version = session_store.version(token)
+        if version is None:
+            self.invalidate(token)
+            raise Exception("Invalid or expired token")
+
+        api = self._lookup(token, version)
+        if api is not None:
+            return api
+
+        # only one thread hydrates a given token, the others wait and reuse it
+        with self._token_lock(token):
+            api = self._lookup(token, version)
+            if api is not None:
+                return api
+            started = time.perf_counter()
+            cached_settings = session_store.load(token)
+            if cached_settings is None:
+                raise Exception("Invalid or expired token")
+            api = load_api_from_settings(cached_settings)
+            session_hydration_seconds.observe(time.perf_counter() - started)
+            with self._lock:
+                self.misses += 1
+                self._entries[token] = (api, version, time.monotonic())
+                self._entries.move_to_end(token)
+                while len(self._entries) > self.max_size:
+                    evicted, _ = self._entries.popitem(last=False)
+                    self._token_locks.pop(evicted, None)
+                    self.evictions += 1
+        return api
+
+    def invalidate(self, token):
+        with self._lock:
+            if self._entries.pop(token, None) is not None:
+                self.invalidations += 1
+            self._token_locks.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._token_locks.clear()
+
+    def drop_expired(self):
+        # the store scan runs in one worker; each worker prunes its own pool
+        now = time.time()
+        with self._lock:
+            expired = [token for token, (api, _, _) in self._entries.items()
+                       if api.cookie_jar.auth_expires and api.cookie_jar.auth_expires <= now]
+        for token in expired:
+            self.invalidate(token)
+        return len(expired)
+
+    def hot_tokens(self, limit):
+        # most recently used first
+        with self._lock:
+            return list(reversed(self._entries))[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+session_pool = SessionPool()
+
+
+def get_api_from_token(token):
+    return session_pool.get(token)
+
+
+@bp.route("/stats/session_pool", methods=["GET"])
+def session_pool_stats():
+    return jsonify({
+        "status": "success",
+        "session_pool": session_pool.stats()
+    })
+
+
+# -----------------------Session maintainer-----------------------
+# Background thread that walks the session store every SESSION_SCAN_INTERVAL
+# seconds. Sessions whose cookie expires within SESSION_REFRESH_MARGIN get a
+# cheap authenticated call so Instagram can extend the cookie, and the new
+# settings are written back; sessions it cannot extend are flagged, and
+# expired ones are dropped from the pool so they fail at hydration instead
+# of on an upstream call. On startup it first prehydrates the most recently
+# used tokens recorded by the previous run in SESSION_WARMUP_FILE.
+# Every worker warms up and prunes its own pool, but only the worker holding
+# SESSION_MAINTAINER_LOCK scans the store, and with a cluster only for the
+# tokens this node owns. Each refresh also holds a store lock on the token,
+# for nodes sharing one store.
+SESSION_MAINTAINER_ENABLED = os.environ.get("SESSION_MAINTAINER_ENABLED", "1") == "1"
+SESSION_SCAN_INTERVAL = int(os.environ.get("SESSION_SCAN_INTERVAL", "600"))  # seconds
+SESSION_REFRESH_MARGIN = int(os.environ.get("SESSION_REFRESH_MARGIN", str(LOGIN_REFRESH_MARGIN)))  # seconds
+SESSION_WARMUP_COUNT = int(os.environ.get("SESSION_WARMUP_COUNT", "64"))
+SESSION_WARMUP_FILE = os.environ.get("SESSION_WARMUP_FILE", os.path.join(SESSION_FOLDER, "hot_tokens.json"))
+SESSION_MAINTAINER_LOCK = os.environ.get("SESSION_MAINTAINER_LOCK", os.path.join(SESSION_FOLDER, "maintainer.lock"))
+
+
+def settings_auth_expires(cached_settings):
+    cookie = cached_settings.get("cookie")
+    if not cookie:
+        return None
+    return ClientCookieJar(cookie_string=cookie).auth_expires
+
+
+class SessionMaintainer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leader_file = None
+        self.flagged = {}  # token -> "expiring" | "expired"
+        self.warmed = 0
+        self.refreshed = 0
+        self.scans = 0
+        self.last_scan = None
+
+    def _flag(self, token, state):
+        with self._lock:
+            self.flagged[token] = state
+
+    def load_hot_tokens(self):
+        try:
+            with open(SESSION_WARMUP_FILE) as hot_file:
+                return json.load(hot_file)
+        except (OSError, ValueError):
+            return []
+
+    def save_hot_tokens(self):
+        # this worker's tokens first, then whatever other workers recorded
+        tokens = session_pool.hot_tokens(SESSION_WARMUP_COUNT)
+        tokens += [token for token in self.load_hot_tokens() if token not in tokens]
+        tmp_path = f"{SESSION_WARMUP_FILE}.{os.getpid()}.tmp"
+        os.makedirs(os.path.dirname(SESSION_WARMUP_FILE) or ".", exist_ok=True)
+        with open(tmp_path, 'w') as hot_file:
+            json.dump(tokens[:SESSION_WARMUP_COUNT], hot_file)
+        os.replace(tmp_path, SESSION_WARMUP_FILE)
+
+    def warmup(self):
+        for token in self.load_hot_tokens()[:SESSION_WARMUP_COUNT]:
+            try:
+                session_pool.get(token)
+                with self._lock:
+                    self.warmed += 1
+            except ClientCookieExpiredError:
+                self._flag(token, "expired")
+            except Exception as e:
+                print(f"Warmup skipped session {token}: {e}")
+
+    def lead(self):
+        # the flock is held for the life of the process and dropped by the
+        # kernel when it dies, so another worker takes over on its next pass
+        if self._leader_file is None:
+            os.makedirs(os.path.dirname(SESSION_MAINTAINER_LOCK) or ".", exist_ok=True)
+            lock_file = open(SESSION_MAINTAINER_LOCK, 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._leader_file = lock_file
+        return True
+
+    def refresh(self, token):
+        # the settings are read again under the lock, so whoever waited sees
+        # the extended cookie and stops; the Client is built just for this
+        # call and never put in the session pool
+        with session_store.lock_login(f"refresh:{token}", LOGIN_LOCK_TIMEOUT):
+            cached_settings = session_store.load(token)
+            expires = settings_auth_expires(cached_settings) if cached_settings else None
+            if expires is None or expires - time.time() >= SESSION_REFRESH_MARGIN:
+                return
+            api = load_api_from_settings(cached_settings)
+            rate_governor.call(api, "profile", api.current_user)
+            new_expires = api.cookie_jar.auth_expires
+            if new_expires and new_expires > expires:
+                session_store.save(token, api.settings)
+                with self._lock:
+                    self.refreshed += 1
+                    self.flagged.pop(token, None)
+                print(f"REFRESHED: session {token}")
+            else:
+                self._flag(token, "expiring")
+
+    def scan(self):
+        now = time.time()
+        for token in list(session_store.tokens()):
+            if cluster.enabled and cluster.owner(shard_key(token)) != CLUSTER_SELF:
+                continue  # the owning node maintains it
+            try:
+                cached_settings = session_store.load(token)
+                expires = settings_auth_expires(cached_settings) if cached_settings else None
+                if expires is None:
+                    continue
+                if expires <= now:
+                    session_pool.invalidate(token)
+                    self._flag(token, "expired")
+                elif expires - now < SESSION_REFRESH_MARGIN:
+                    self.refresh(token)
+                else:
+                    with self._lock:
+                        self.flagged.pop(token, None)
+            except ClientCookieExpiredError:
+                session_pool.invalidate(token)
+                self._flag(token, "expired")
+            except Exception as e:
+                print(f"Error maintaining session {token}: {e}")
+                self._flag(token, "expiring")
+        with self._lock:
+            self.scans += 1
+            self.last_scan = now
+
+    def run(self, stop):
+        self.warmup()
+        # spread the workers' scans so they do not all hit the store at once
+        while not stop.wait(SESSION_SCAN_INTERVAL * random.uniform(0.9, 1.1)):
+            try:
+                self.save_hot_tokens()
+                session_pool.drop_expired()
+                if self.lead():
+                    self.scan()
+            except Exception as e:
+                print(f"Error scanning sessions: {e}")
+
+    def stats(self):
+        with self._lock:
+            states = list(self.flagged.values())
+            return {
+                "leader": self._leader_file is not None,
+                "warmed": self.warmed,
+                "refreshed": self.refreshed,
+                "expiring": states.count("expiring"),
+                "expired": states.count("expired"),
+                "scans": self.scans,
+                "last_scan": self.last_scan
+            }
+
+
+session_maintainer = SessionMaintainer()
+
+
+@bp.route("/stats/session_maintainer", methods=["GET"])
+def session_maintainer_stats():
+    return jsonify({
+        "status": "success",
+        "session_maintainer": session_maintainer.stats()
+    })
+
+
+# -----------------------Cluster-----------------------
+# With CLUSTER_SELF set, several nodes split the sessions between them. Each
+# token belongs to one node, picked on a consistent-hash ring with
+# CLUSTER_VNODES points per node, so only that node hydrates the token's
+# Client and keeps its cached responses. A node that gets a request for a
+# token it does not own forwards it to the owner over the shared transport,
+# or answers with a 307 to the owner when CLUSTER_ROUTING=redirect. /login
+# is routed by account, and tokens start with their account's shard, so an
+# account's login record and its sessions always live on the same node.
+#
+# Membership goes through one coordinator, the first node in sorted order.
+# POST /cluster/join and /cluster/leave bump the view's epoch and push the
+# new view to every node. Workers of one node share the view through
+# CLUSTER_STATE_FILE. After a change each node hands the sessions and login
+# records it no longer owns to their new owners, once per change and node:
+# the worker holding SESSION_MAINTAINER_LOCK does it, and records the epoch
+# it finished in CLUSTER_HANDOFF_FILE. It goes along with the tokens' jobs,
+# schedules and the snapshot files those jobs wrote. Until that is done, a
+# new owner asked for a session it does not have yet pulls it from the
+# previous owner. Profile pictures are stored on the node that fetched them;
+# another node asked for one it does not have copies it from a peer. The
+# coordinator drops nodes it cannot reach for CLUSTER_DEAD_AFTER
+# seconds. A node joins through CLUSTER_NODES when it starts outside the view.
+CLUSTER_SELF = os.environ.get("CLUSTER_SELF", "").rstrip("/")  # this node's base url, e.g. http://10.0.0.5:5000
+CLUSTER_NODES = [node.strip().rstrip("/") for node in os.environ.get("CLUSTER_NODES", "").split(",") if node.strip()]
+CLUSTER_SECRET = os.environ.get("CLUSTER_SECRET", "")  # shared by all nodes, required in cluster mode
+CLUSTER_ROUTING = os.environ.get("CLUSTER_ROUTING", "forward")  # forward | redirect
+CLUSTER_VNODES = int(os.environ.get("CLUSTER_VNODES", "64"))
+CLUSTER_STATE_FILE = os.environ.get("CLUSTER_STATE_FILE", os.path.join(SESSION_FOLDER, "cluster.json"))
+CLUSTER_SYNC_INTERVAL = float(os.environ.get("CLUSTER_SYNC_INTERVAL", "10"))  # seconds
+CLUSTER_DEAD_AFTER = float(os.environ.get("CLUSTER_DEAD_AFTER", "60"))  # seconds
+CLUSTER_PULL_WINDOW = float(os.environ.get("CLUSTER_PULL_WINDOW", "600"))  # seconds after a change
+CLUSTER_FORWARD_TIMEOUT = float(os.environ.get("CLUSTER_FORWARD_TIMEOUT", "120"))  # seconds
+CLUSTER_CALL_TIMEOUT = 5  # seconds, for the nodes' own calls
+# a store every node reads (redis) needs no handoff, only the routing
+CLUSTER_HANDOFF = os.environ.get("CLUSTER_HANDOFF", "0" if SESSION_STORE == "redis" else "1") == "1"
+# off when the nodes share JOBS_DB and SNAPSHOT_FOLDER
+CLUSTER_HANDOFF_JOBS = os.environ.get("CLUSTER_HANDOFF_JOBS", "1") == "1"
+CLUSTER_HANDOFF_BATCH = 200
+CLUSTER_HANDOFF_FILE = f"{CLUSTER_STATE_FILE}.handoff"
+CLUSTER_VIEW_CHECK = 1.0  # seconds between checks of the state file
+CLUSTER_HOP_HEADER = "X-Cluster-Hop"
+CLUSTER_SECRET_HEADER = "X-Cluster-Secret"
+FORWARDED_REQUEST_HEADERS = ("Content-Type", "Accept", "Accept-Encoding", "User-Agent")
+FORWARDED_RESPONSE_HEADERS = ("Content-Type", "Content-Encoding", "Content-Length", "Retry-After", "Vary")
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def shard_key(token):
+    # tokens from before sharding are plain uuids and hash as a whole
+    return token.split(".", 1)[0]
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=CLUSTER_VNODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((ring_hash(f"{node}#{index}"), node) for node in self.nodes for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._owners:
+            return None
+        index = bisect.bisect(self._hashes, ring_hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+class Cluster:
+    def __init__(self):
+        self.enabled = bool(CLUSTER_SELF)
+        if self.enabled and not CLUSTER_SECRET:
+            raise ValueError("CLUSTER_SECRET is required when CLUSTER_SELF is set")
+        self._lock = threading.RLock()
+        self._handoff_lock = threading.Lock()
+        self.epoch = 0
+        self.ring = HashRing(CLUSTER_NODES or [CLUSTER_SELF])
+        self.previous = None  # ring before the last change, where sessions are pulled from
+        self.changed_at = 0.0
+        self._state_version = None
+        self._checked_at = 0.0
+        self.last_seen = {}  # node -> when it last answered the coordinator
+        self.forwarded = 0
+        self.redirected = 0
+        self.forward_errors = 0
+        self.handed_off = 0
+        self.received = 0
+        self.pulled = 0
+        self.pulled_media = 0
+
+    def _install(self, state):
+        self.epoch = state["epoch"]
+        self.ring = HashRing(state["nodes"])
+        self.previous = HashRing(state["previous"]) if state.get("previous") else None
+        self.changed_at = state.get("changed_at", 0.0)
+        now = time.monotonic()
+        self.last_seen = {node: self.last_seen.get(node, now) for node in self.ring.nodes}
+        # the pool only keeps Clients for this node's shard
+        for token in session_pool.hot_tokens(session_pool.max_size):
+            if self.ring.owner(shard_key(token)) != CLUSTER_SELF:
+                session_pool.invalidate(token)
+
+    def refresh(self, force=False):
+        # picks up views adopted by the node's other workers
+        if not self.enabled or (not force and time.monotonic() - self._checked_at < CLUSTER_VIEW_CHECK):
+            return
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                version = os.stat(CLUSTER_STATE_FILE).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if version == self._state_version:
+                return
+            try:
+                with open(CLUSTER_STATE_FILE) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                return  # being replaced, read it on the next check
+            self._state_version = version
+            if state["epoch"] != self.epoch or state["nodes"] != self.ring.nodes:
+                self._install(state)
+
+    def adopt(self, view):
+        with self._lock:
+            self.refresh(force=True)
+            if view["epoch"] <= self.epoch:
+                return False
+            state = {"epoch": view["epoch"], "nodes": sorted(view["nodes"]), "previous": self.ring.nodes,
+                     "changed_at": time.time()}
+            os.makedirs(os.path.dirname(CLUSTER_STATE_FILE) or ".", exist_ok=True)
+            tmp_path = f"{CLUSTER_STATE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp_path, CLUSTER_STATE_FILE)
+            self._state_version = os.stat(CLUSTER_STATE_FILE).st_mtime_ns
+            self._install(state)
+        print(f"CLUSTER: adopted epoch {state['epoch']} with nodes {state['nodes']}")
+        return True
+
+    def owner(self, key):
+        self.refresh()
+        return self.ring.owner(key)
+
+    def coordinator(self):
+        self.refresh()
+        return self.ring.nodes[0]
+
+    def view(self):
+        self.refresh()
+        return {"epoch": self.epoch, "nodes": self.ring.nodes, "coordinator": self.ring.nodes[0]}
+
+    def call(self, node, method, path, payload=None, timeout=CLUSTER_CALL_TIMEOUT):
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json", CLUSTER_SECRET_HEADER: CLUSTER_SECRET,
+                   CLUSTER_HOP_HEADER: CLUSTER_SELF}
+        response = get_transport().open(method, node + path, body=body, headers=headers, timeout=timeout)
+        data = json.loads(response.data) if response.data else {}
+        if response.status >= 400:
+            raise Exception(data.get("message") or f"{node}{path} answered {response.status}")
+        return data
+
+    def send_file(self, node, path):
+        # snapshot files go one by one as raw bytes, they can be large
+        relative_path = os.path.relpath(path, SNAPSHOT_FOLDER)
+        with open(path, 'rb') as snapshot_file:
+            headers = {"Content-Type": "application/octet-stream",
+                       "Content-Length": str(os.fstat(snapshot_file.fileno()).st_size),
+                       CLUSTER_SECRET_HEADER: CLUSTER_SECRET, CLUSTER_HOP_HEADER: CLUSTER_SELF}
+            response = get_transport().open("POST", f"{node}/cluster/handoff/file?path={quote(relative_path)}",
+                                            body=snapshot_file, headers=headers, timeout=CLUSTER_FORWARD_TIMEOUT)
+        if response.status >= 400:
+            raise Exception(f"{node} refused {relative_path}: {response.status}")
+
+    def broadcast(self, nodes):
+        view = self.view()
+        for node in nodes:
+            if node != CLUSTER_SELF:
+                try:
+                    self.call(node, "POST", "/cluster/view", view)
+                except Exception as e:
+                    print(f"Error sending cluster view to {node}: {e}")
+
+    def change(self, add=(), remove=()):
+        # coordinator only; the lock file keeps the node's workers from
+        # handing out the same epoch twice
+        os.makedirs(os.path.dirname(CLUSTER_STATE_FILE) or ".", exist_ok=True)
+        with open(f"{CLUSTER_STATE_FILE}.lock", 'w') as lock_file:
+            wait_flock(lock_file, fcntl.LOCK_EX)
+            self.refresh(force=True)
+            old_nodes = set(self.ring.nodes)
+            nodes = (old_nodes | set(add)) - set(remove)
+            if not nodes:
+                raise ValueError("The last node cannot leave the cluster")
+            changed = nodes != old_nodes and self.adopt({"epoch": self.epoch + 1, "nodes": nodes})
+        if changed:
+            # the removed nodes learn it too, and hand their sessions off
+            self.broadcast(old_nodes | nodes)
+        return self.view()
+
+    def membership_request(self, path, node):
+        coordinator = self.coordinator()
+        if coordinator != CLUSTER_SELF:
+            return self.call(coordinator, "POST", path, {"node": node})
+        if path == "/cluster/join":
+            return self.change(add=[node])
+        return self.change(remove=[node])
+
+    def join(self, stop):
+        while not stop.is_set():
+            for seed in CLUSTER_NODES + self.ring.nodes:
+                if seed == CLUSTER_SELF:
+                    continue
+                try:
+                    self.adopt(self.call(seed, "POST", "/cluster/join", {"node": CLUSTER_SELF}))
+                    return
+                except Exception as e:
+                    print(f"Error joining the cluster through {seed}: {e}")
+            stop.wait(CLUSTER_SYNC_INTERVAL)
+
+    def check_nodes(self):
+        view = self.view()
+        now = time.monotonic()
+        dead = []
+        for node in view["nodes"]:
+            if node == CLUSTER_SELF:
+                continue
+            try:
+                if self.call(node, "GET", "/cluster/view")["epoch"] < view["epoch"]:
+                    self.call(node, "POST", "/cluster/view", view)
+                self.last_seen[node] = now
+            except Exception as e:
+                if now - self.last_seen.get(node, now) > CLUSTER_DEAD_AFTER:
+                    print(f"CLUSTER: dropping {node}, unreachable: {e}")
+                    dead.append(node)
+        if dead:
+            self.change(remove=dead)
+
+    def sync(self):
+        self.refresh(force=True)
+        if self.ring.nodes[0] == CLUSTER_SELF:
+            self.check_nodes()
+            return
+        for node in self.ring.nodes:
+            if node == CLUSTER_SELF:
+                continue
+            try:
+                self.adopt(self.call(node, "GET", "/cluster/view"))
+                return
+            except Exception as e:
+                print(f"Error syncing the cluster view from {node}: {e}")
+
+    def _send_handoff(self, owner, batch):
+        self.call(owner, "POST", "/cluster/handoff", batch, timeout=CLUSTER_FORWARD_TIMEOUT)
+        # the new owner has them, drop the local copies
+        for entry in batch["sessions"]:
+            session_pool.invalidate(entry["token"])
+            session_store.delete(entry["token"])
+        for entry in batch["logins"]:
+            session_store.delete_login(entry["username"])
+        for entry in batch["jobs"]:
+            job_queue.drop(entry)
+            for path in job_snapshot_files(entry["jobs"]):
+                os.remove(path)
+        with self._lock:
+            self.handed_off += len(batch["sessions"])
+
+    def handoff(self):
+        if not CLUSTER_HANDOFF:
+            return
+        batches = {}  # owner -> sessions, login records and jobs to send it
+
+        def add(owner, kind, entry):
+            batch = batches.setdefault(owner, {"sessions": [], "logins": [], "jobs": []})
+            batch[kind].append(entry)
+            if len(batch[kind]) >= CLUSTER_HANDOFF_BATCH:
+                self._send_handoff(owner, batches.pop(owner))
+
+        for token in list(session_store.tokens()):
+            owner = self.owner(shard_key(token))
+            if owner == CLUSTER_SELF:
+                continue
+            cached_settings = session_store.load(token)
+            if cached_settings is not None:
+                add(owner, "sessions", {"token": token,
+                                        "settings": base64.b64encode(encode_settings(cached_settings)).decode()})
+        for username, record in list(session_store.logins()):
+            owner = self.owner(account_shard(username))
+            if owner != CLUSTER_SELF:
+                add(owner, "logins", {"username": username,
+                                      "record": base64.b64encode(encode_settings(record)).decode()})
+        if job_queue is not None and CLUSTER_HANDOFF_JOBS:
+            for token in job_queue.tokens():
+                owner = self.owner(shard_key(token))
+                if owner == CLUSTER_SELF:
+                    continue
+                entry = job_queue.export(token)
+                # the files first, so the new owner's rows never point at missing ones
+                for path in job_snapshot_files(entry["jobs"]):
+                    self.send_file(owner, path)
+                add(owner, "jobs", entry)
+        for owner, batch in batches.items():
+            self._send_handoff(owner, batch)
+
+    def handoff_if_changed(self):
+        # a failed handoff leaves the epoch unrecorded and is tried again
+        if not CLUSTER_HANDOFF or not session_maintainer.lead():
+            return
+        with self._handoff_lock:
+            epoch = self.view()["epoch"]
+            try:
+                with open(CLUSTER_HANDOFF_FILE) as handoff_file:
+                    if int(handoff_file.read()) == epoch:
+                        return
+            except (OSError, ValueError):
+                pass
+            self.handoff()
+            tmp_path = f"{CLUSTER_HANDOFF_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as handoff_file:
+                handoff_file.write(str(epoch))
+            os.replace(tmp_path, CLUSTER_HANDOFF_FILE)
+
+    def receive_handoff(self, batch):
+        for entry in batch.get("sessions", []):
+            session_store.save(entry["token"], decode_settings(base64.b64decode(entry["settings"])))
+            session_pool.invalidate(entry["token"])
+        for entry in batch.get("logins", []):
+            session_store.save_login(entry["username"], decode_settings(base64.b64decode(entry["record"])))
+        if batch.get("jobs") and job_queue is None:
+            # fails the whole batch, so the sender keeps its copies
+            raise ValueError("Background jobs are disabled on this node")
+        for entry in batch.get("jobs", []):
+            job_queue.receive(entry)
+        with self._lock:
+            self.received += len(batch.get("sessions", []))
+
+    def pull_session(self, token):
+        # a session asked for right after a change, before its old owner
+        # handed it over
+        if not self.enabled:
+            return False
+        self.refresh()
+        if self.previous is None or time.time() - self.changed_at > CLUSTER_PULL_WINDOW:
+            return False
+        key = shard_key(token)
+        for node in dict.fromkeys((self.previous.owner(key), self.ring.owner(key))):
+            if node in (None, CLUSTER_SELF):
+                continue
+            try:
+                entry = self.call(node, "GET", f"/cluster/handoff?token={quote(token)}")
+            except Exception as e:
+                print(f"Error pulling session {token} from {node}: {e}")
+                continue
+            if entry.get("settings"):
+                session_store.save(token, decode_settings(base64.b64decode(entry["settings"])))
+                with self._lock:
+                    self.pulled += 1
+                return True
+        return False
+
+    def pull_media(self, sha256):
+        # pictures are content-addressed, so any node's copy will do once it
+        # matches its hash
+        for node in self.view()["nodes"]:
+            if node == CLUSTER_SELF:
+                continue
+            headers = {CLUSTER_SECRET_HEADER: CLUSTER_SECRET, CLUSTER_HOP_HEADER: CLUSTER_SELF}
+            try:
+                response = get_transport().open("GET", f"{node}/profile_pics/{sha256}", headers=headers,
+                                                timeout=MEDIA_TIMEOUT)
+            except Exception as e:
+                print(f"Error pulling picture {sha256} from {node}: {e}")
+                continue
+            if response.status != 200 or hashlib.sha256(response.data).hexdigest() != sha256:
+                continue
+            path = media_object_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(response.data)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self.pulled_media += 1
+            return True
+        return False
+
+    def forward(self, owner):
+        path = request.path + (f"?{request.query_string.decode()}" if request.query_string else "")
+        if CLUSTER_ROUTING == "redirect":
+            with self._lock:
+                self.redirected += 1
+            return redirect(owner + path, code=307)
+        headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+        headers[CLUSTER_HOP_HEADER] = CLUSTER_SELF
+        headers[CLUSTER_SECRET_HEADER] = CLUSTER_SECRET
+        try:
+            upstream = get_transport().open(request.method, owner + path, body=request.get_data(), headers=headers,
+                                            timeout=CLUSTER_FORWARD_TIMEOUT, preload_content=False)
+        except Exception as e:
+            note_error(e)
+            with self._lock:
+                self.forward_errors += 1
+            return jsonify({"status": "error", "message": f"Owner node {owner} is unreachable"}), 503
+
+        def generate():
+            # the owner already compressed the body, pass the bytes through
+            completed = False
+            try:
+                yield from upstream.stream(64 * 1024, decode_content=False)
+                completed = True
+            finally:
+                if not completed:
+                    upstream.close()  # never put a half-read connection back
+                upstream.release_conn()
+
+        with self._lock:
+            self.forwarded += 1
+        response = Response(generate(), status=upstream.status)
+        for name in FORWARDED_RESPONSE_HEADERS:
+            if name in upstream.headers:
+                response.headers[name] = upstream.headers[name]
+        return response
+
+    def stats(self):
+        view = self.view() if self.enabled else {"epoch": 0, "nodes": [], "coordinator": None}
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "self": CLUSTER_SELF,
+                "routing": CLUSTER_ROUTING,
+                **view,
+                "forwarded": self.forwarded,
+                "redirected": self.redirected,
+                "forward_errors": self.forward_errors,
+                "handed_off": self.handed_off,
+                "received": self.received,
+                "pulled": self.pulled,
+                "pulled_media": self.pulled_media
+            }
+
+    def run(self, stop):
+        self.sync()
+        if CLUSTER_SELF not in self.view()["nodes"]:
+            self.join(stop)
+        # spread the workers' syncs like the session scans
+        while not stop.wait(CLUSTER_SYNC_INTERVAL * random.uniform(0.9, 1.1)):
+            try:
+                self.sync()
+                self.handoff_if_changed()
+            except Exception as e:
+                print(f"Error syncing the cluster: {e}")
+
+
+cluster = Cluster()
+
+
+@bp.before_app_request
+def route_to_owner():
+    # requests one node forwarded to another are served where they land; the
+    # hop header only counts with the cluster secret, or any client could
+    # use it to skip owner routing
+    if not cluster.enabled or request.method != "POST":
+        return None
+    if CLUSTER_HOP_HEADER in request.headers and cluster_request_allowed():
+        return None
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or request.path.startswith("/cluster/"):
+        return None
+    if request.path == "/login":
+        username = data.get("username")
+        key = account_shard(username.strip().lower()) if isinstance(username, str) and username else None
+    else:
+        token = data.get("token")
+        key = shard_key(token) if isinstance(token, str) and token else None
+    if key is None:
+        return None
+    owner = cluster.owner(key)
+    if owner in (None, CLUSTER_SELF):
+        return None
+    return cluster.forward(owner)
+
+
+def cluster_request_allowed():
+    supplied = request.headers.get(CLUSTER_SECRET_HEADER, "")
+    return cluster.enabled and hmac.compare_digest(supplied.encode(), CLUSTER_SECRET.encode())
+
+
+def cluster_forbidden():
+    return jsonify({"status": "error", "message": "Cluster mode is off or the cluster secret is wrong"}), 403
+
+
+@bp.route("/cluster/view", methods=["GET", "POST"])
+def cluster_view():
+    if not cluster_request_allowed():
+        return cluster_forbidden()
+    if request.method == "POST":
+        if cluster.adopt(request.json):
+            threading.Thread(target=cluster.handoff_if_changed, name="cluster-handoff", daemon=True).start()
+    return jsonify(cluster.view())
+
+
+@bp.route("/cluster/join", methods=["POST"])
+@bp.route("/cluster/leave", methods=["POST"])
+def cluster_membership():
+    if not cluster_request_allowed():
+        return cluster_forbidden()
+    data = request.get_json(silent=True) or {}
+    node = (data.get("node") or CLUSTER_SELF).rstrip("/")
+    try:
+        return jsonify(cluster.membership_request(request.path, node))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        note_error(e)
+        return jsonify({"status": "error", "message": str(e)}), 502
+
+
+@bp.route("/cluster/handoff", methods=["GET", "POST"])
+def cluster_handoff():
+    if not cluster_request_allowed():
+        return cluster_forbidden()
+    if request.method == "POST":
+        cluster.receive_handoff(request.json)
+        return jsonify({"status": "success"})
+    # settings is null when this node does not have the session either
+    cached_settings = session_store.load(request.args.get("token", ""))
+    return jsonify({
+        "status": "success",
+        "settings": base64.b64encode(encode_settings(cached_settings)).decode() if cached_settings else None
+    })
+
+
+@bp.route("/cluster/handoff/file", methods=["POST"])
+def cluster_handoff_file():
+    if not cluster_request_allowed():
+        return cluster_forbidden()
+    path = snapshot_file_path(request.args.get("path", ""))
+    if path is None:
+        return jsonify({"status": "error", "message": "Path must be inside the snapshot folder"}), 400
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as snapshot_file:
+        shutil.copyfileobj(request.stream, snapshot_file, SNAPSHOT_WRITE_BLOCK)
+    os.replace(tmp_path, path)
+    return jsonify({"status": "success"})
+
+
+@bp.route("/stats/cluster", methods=["GET"])
+def cluster_stats():
+    return jsonify({
+        "status": "success",
+        "cluster": cluster.stats()
+    })
+
+
+# -----------------------Rate governor-----------------------
+# Token buckets per (account, endpoint class) plus one global bucket per
+# class. A call that would wait longer than RATE_LIMIT_MAX_WAIT fails fast
+# with RateLimited instead of queueing. A 429 / ClientThrottledError halves
+# the account's rate and blocks it for an exponential backoff window; every
+# successful call then wins back a little of the rate (AIMD).
+#
+# Bucket levels and account backoff live in RATE_STATE_DB, which all server
+# workers of a node share, so the limits hold for the node as a whole and
+# not once per worker. Separate nodes each have their own limits: in
+# cluster mode an account's calls all go to its owner node, so per-account
+# limits still hold, but the global limits apply per node.
+RATE_LIMITS = {  # endpoint class -> (per account calls/second, burst, global calls/second, global burst)
+    "profile": (
+        float(os.environ.get("RATE_PROFILE_PER_SECOND", "1")),
+        int(os.environ.get("RATE_PROFILE_BURST", "10")),
+        float(os.environ.get("RATE_PROFILE_GLOBAL_PER_SECOND", "50")),
+        int(os.environ.get("RATE_PROFILE_GLOBAL_BURST", "100")),
+    ),
+    "followers": (
+        float(os.environ.get("RATE_FOLLOWERS_PER_SECOND", "0.5")),
+        int(os.environ.get("RATE_FOLLOWERS_BURST", "5")),
+        float(os.environ.get("RATE_FOLLOWERS_GLOBAL_PER_SECOND", "20")),
+        int(os.environ.get("RATE_FOLLOWERS_GLOBAL_BURST", "40")),
+    ),
+    "timeline": (
+        float(os.environ.get("RATE_TIMELINE_PER_SECOND", "0.5")),
+        int(os.environ.get("RATE_TIMELINE_BURST", "5")),
+        float(os.environ.get("RATE_TIMELINE_GLOBAL_PER_SECOND", "20")),
+        int(os.environ.get("RATE_TIMELINE_GLOBAL_BURST", "40")),
+    ),
+}
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "10"))  # seconds
+RATE_BACKOFF_INITIAL = float(os.environ.get("RATE_BACKOFF_INITIAL", "5"))
+RATE_BACKOFF_MAX = float(os.environ.get("RATE_BACKOFF_MAX", "300"))
+RATE_MIN_FACTOR = 0.1
+RATE_RECOVERY_STEP = 0.02
+RATE_STATE_DB = os.environ.get("RATE_STATE_DB", "rate_state.db")
+
+
+RATE_GOVERNOR_METRICS = {  # /metrics help text of the per-class call counters
+    "calls": "Calls let through by the rate governor by endpoint class.",
+    "queued": "Calls that waited for the rate governor by endpoint class.",
+    "queued_seconds": "Seconds calls waited for the rate governor by endpoint class.",
+    "rejected": "Calls refused with RateLimited by endpoint class.",
+    "upstream_throttled": "Calls Instagram answered with throttling by endpoint class.",
+}
+
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateState:
+    # One write transaction per reserved call; BEGIN IMMEDIATE makes the
+    # read-refill-take of the buckets atomic across processes.
+
+    def __init__(self, path=RATE_STATE_DB):
+        self.path = path
+        self._pool = SQLitePool(path, self._setup, isolation_level=None)
+
+    @staticmethod
+    def _setup(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL,"
+                     " updated REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS accounts (account TEXT PRIMARY KEY, factor REAL NOT NULL,"
+                     " backoff REAL NOT NULL, blocked_until REAL NOT NULL)")
+
+    @staticmethod
+    def _account(conn, account):
+        row = conn.execute(
+            "SELECT factor, backoff, blocked_until FROM accounts WHERE account = ?", (account,)).fetchone()
+        return row or (1.0, 0.0, 0.0)
+
+    def _write(self, work):
+        with self._pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return result
+
+    def reserve(self, account, endpoint_class, limit, max_wait):
+        # returns the wait before the call may go out; the tokens are only
+        # taken when that wait is within max_wait
+        rate, burst, global_rate, global_burst = limit
+
+        def work(conn):
+            now = time.time()
+            factor, _, blocked_until = self._account(conn, account)
+            wait = blocked_until - now
+            levels = []
+            for key, bucket_rate, bucket_burst in ((f"{account}:{endpoint_class}", rate * factor, burst),
+                                                   (f"*:{endpoint_class}", global_rate, global_burst)):
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = bucket_burst if row is None else min(bucket_burst, row[0] + (now - row[1]) * bucket_rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / bucket_rate)
+                levels.append((key, tokens - 1, now))
+            if wait <= max_wait:
+                # reserve now so concurrent callers queue behind this one
+                conn.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", levels)
+            return max(0.0, wait)
+
+        return self._write(work)
+
+    def record_success(self, account):
+        with self._pool.connection() as conn:
+            factor, backoff, _ = self._account(conn, account)
+            if factor >= 1.0 and not backoff:
+                return  # the common case stays a read
+            conn.execute("UPDATE accounts SET factor = MIN(1.0, factor + ?), backoff = 0 WHERE account = ?",
+                         (RATE_RECOVERY_STEP, account))
+
+    def record_throttled(self, account):
+        def work(conn):
+            factor, backoff, _ = self._account(conn, account)
+            factor = max(RATE_MIN_FACTOR, factor / 2)
+            backoff = min(RATE_BACKOFF_MAX, backoff * 2 or RATE_BACKOFF_INITIAL)
+            conn.execute(
+                "INSERT OR REPLACE INTO accounts (account, factor, backoff, blocked_until) VALUES (?, ?, ?, ?)",
+                (account, factor, backoff, time.time() + backoff))
+            return backoff
+
+        return self._write(work)
+
+    def stats(self):
+        with self._pool.connection() as conn:
+            backing_off, slowed = conn.execute(
+                "SELECT COALESCE(SUM(blocked_until > ?), 0), COALESCE(SUM(factor < 1.0), 0) FROM accounts",
+                (time.time(),)).fetchone()
+            # account buckets are keyed "<account>:<class>", the global ones "*:<class>"
+            accounts = conn.execute(
+                "SELECT COUNT(DISTINCT substr(key, 1, instr(key, ':') - 1)) FROM buckets WHERE key NOT LIKE '*:%'"
+            ).fetchone()[0]
+        return {"accounts": accounts, "accounts_backing_off": backing_off, "accounts_slowed": slowed}
+
+
+def is_throttle_error(e):
+    return isinstance(e, ClientThrottledError) or (isinstance(e, ClientError) and e.code == 429)
+
+
+class RateGovernor:
+    def __init__(self, limits=RATE_LIMITS, max_wait=RATE_LIMIT_MAX_WAIT, state=None):
+        self.limits = limits
+        self.max_wait = max_wait
+        self.state = state or RateState()
+        self._lock = threading.Lock()
+        self._local = threading.local()  # max_wait of calls inside patient()
+        # call counters are this worker's own, like the other metrics
+        self.metrics = {name: {"calls": 0, "queued": 0, "queued_seconds": 0.0, "rejected": 0,
+                               "upstream_throttled": 0} for name in limits}
+
+    @contextlib.contextmanager
+    def patient(self, max_wait):
+        # calls made inside queue for up to max_wait instead of failing fast,
+        # for work nobody is waiting on interactively
+        previous = getattr(self._local, "max_wait", None)
+        self._local.max_wait = max_wait
+        try:
+            yield
+        finally:
+            self._local.max_wait = previous
+
+    def acquire(self, account, endpoint_class):
+        max_wait = getattr(self._local, "max_wait", None) or self.max_wait
+        wait = self.state.reserve(str(account), endpoint_class, self.limits[endpoint_class], max_wait)
+        metrics = self.metrics[endpoint_class]
+        with self._lock:
+            if wait > max_wait:
+                metrics["rejected"] += 1
+                raise RateLimited(f"Rate limit reached for {endpoint_class} calls", round(wait, 1))
+            metrics["calls"] += 1
+            if wait > 0:
+                metrics["queued"] += 1
+                metrics["queued_seconds"] += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def record_success(self, account):
+        self.state.record_success(str(account))
+
+    def record_throttled(self, account, endpoint_class):
+        backoff = self.state.record_throttled(str(account))
+        with self._lock:
+            self.metrics[endpoint_class]["upstream_throttled"] += 1
+        return backoff
+
+    def call(self, api, endpoint_class, func, *args, **kwargs):
+        account = api.authenticated_user_id or id(api)
+        self.acquire(account, endpoint_class)
+        try:
+            result = timed_upstream_call(func, *args, **kwargs)
+        except ClientError as e:
+            if is_throttle_error(e):
+                backoff = self.record_throttled(account, endpoint_class)
+                raise RateLimited("Instagram is throttling this account", backoff) from e
+            raise
+        self.record_success(account)
+        return result
+
+    def counters(self):
+        with self._lock:
+            return {name: dict(metrics) for name, metrics in self.metrics.items()}
+
+    def stats(self):
+        return {"classes": self.counters(), **self.state.stats()}
+
+
+rate_governor = RateGovernor()
+
+
+def error_response(e):
+    print(f"Error: {e}")
+    note_error(e)
+    if isinstance(e, RateLimited):
+        response = jsonify({"status": "error", "message": str(e), "retry_after": e.retry_after})
+        response.headers["Retry-After"] = str(int(e.retry_after + 0.999))
+        return response, 429
+    return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@bp.route("/stats/rate_governor", methods=["GET"])
+def rate_governor_stats():
+    return jsonify({
+        "status": "success",
+        "rate_governor": rate_governor.stats()
+    })
+
+
+# -----------------------Fetch Data Methods-------------------
+# response key -> key inside username_info / current_user ['user']
+PROFILE_FIELDS = {
+    "pk": "pk",
+    "follower_count": "follower_count",
+    "following_count": "following_count",
+    "bio": "biography",
+    "post_count": "media_count",
+    "profile_pic_url": "profile_pic_url",
+    "verified": "is_verified",
+    "private": "is_private",
+    "full_name": "full_name",
+}
+
+
+def fetch_user(api, target_username=None):
+    # one upstream round trip answers every profile field
+    if target_username:
+        user_info = rate_governor.call(api, "profile", api.username_info, target_username)
+    else:
+        user_info = rate_governor.call(api, "profile", api.current_user)
+    record_usernames([user_info['user']], hot=True)
+    return user_info['user']
+
+
+# -----------------------Username index-----------------------
+# Every username/pk pair seen in a username_info, current_user or follower
+# page response goes into a SQLite index (USERNAME_INDEX_DB) with an LRU hot
+# tier in memory, so resolving a target username to its pk usually costs no
+# upstream call. Entries older than USERNAME_INDEX_TTL are looked up again.
+# When a pk shows up under a new username, the old name is dropped (rename).
+# Pairs are buffered and written in batches of USERNAME_INDEX_BATCH_SIZE, or
+# every USERNAME_INDEX_FLUSH_INTERVAL seconds, rather than on every page.
+# Other workers only learn about a rename through the database, so a hot
+# entry is checked against it again after USERNAME_INDEX_HOT_TTL seconds.
+USERNAME_INDEX_DB = os.environ.get("USERNAME_INDEX_DB", "usernames.db")
+USERNAME_INDEX_TTL = int(os.environ.get("USERNAME_INDEX_TTL", str(7 * 86400)))  # seconds
+USERNAME_INDEX_HOT_SIZE = int(os.environ.get("USERNAME_INDEX_HOT_SIZE", "100000"))
+USERNAME_INDEX_HOT_TTL = int(os.environ.get("USERNAME_INDEX_HOT_TTL", "60"))  # seconds
+USERNAME_INDEX_BATCH_SIZE = int(os.environ.get("USERNAME_INDEX_BATCH_SIZE", "2000"))
+USERNAME_INDEX_FLUSH_INTERVAL = float(os.environ.get("USERNAME_INDEX_FLUSH_INTERVAL", "5"))  # seconds
+
+
+def normalize_username(username):
+    return username.strip().lower()
+
+
+def is_username(value):
+    return isinstance(value, str) and bool(value.strip())
+
+
+class UsernameIndex:
+    def __init__(self, path=USERNAME_INDEX_DB, hot_size=USERNAME_INDEX_HOT_SIZE, hot_ttl=USERNAME_INDEX_HOT_TTL,
+                 batch_size=USERNAME_INDEX_BATCH_SIZE):
+        self.path = path
+        self.hot_size = hot_size
+        self.hot_ttl = hot_ttl
+        self.batch_size = batch_size
+        self._hot = OrderedDict()  # username -> (pk, seen_at, checked_at)
+        self._pending = {}  # pk -> (username, seen_at), not written yet
+        self._pending_names = {}  # username -> pk, for the same pairs
+        self._lock = threading.Lock()
+        self._pool = SQLitePool(path, self._setup)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.renames = 0
+        self.flushes = 0
+
+    @staticmethod
+    def _setup(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, pk INTEGER NOT NULL,"
+                         " seen_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS users_pk ON users (pk)")
+
+    def _remember(self, username, pk, seen_at, checked_at):
+        self._hot[username] = (pk, seen_at, checked_at)
+        self._hot.move_to_end(username)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    def lookup(self, username, max_age=USERNAME_INDEX_TTL):
+        username = normalize_username(username)
+        now = time.time()
+        with self._lock:
+            pk = self._pending_names.get(username)
+            if pk is not None:
+                self.hits += 1
+                return pk
+            entry = self._hot.get(username)
+            if entry is not None and now - entry[1] <= max_age and now - entry[2] <= self.hot_ttl:
+                self._hot.move_to_end(username)
+                self.hits += 1
+                return entry[0]
+        with self._pool.connection() as conn:
+            row = conn.execute("SELECT pk, seen_at FROM users WHERE username = ?", (username,)).fetchone()
+        with self._lock:
+            if row is not None and now - row[1] <= max_age:
+                self.disk_hits += 1
+                self._remember(username, row[0], row[1], now)
+                return row[0]
+            self._hot.pop(username, None)  # renamed away, or too old to trust
+            self.misses += 1
+        return None
+
+    def record(self, users, hot=False):
+        # hot=True also puts the pairs in the memory tier (single profile
+        # lookups); follower pages only refresh names that are already there
+        pairs = {}
+        for user in users:
+            username = user.get('username')
+            if isinstance(username, str) and username.strip() and user.get('pk') is not None:
+                pairs[int(user['pk'])] = normalize_username(username)
+        if not pairs:
+            return
+        now = time.time()
+        with self._lock:
+            for pk, username in pairs.items():
+                previous = self._pending.get(pk)
+                if previous is not None and previous[0] != username:
+                    # renamed again before the last name was written
+                    self._pending_names.pop(previous[0], None)
+                    self._hot.pop(previous[0], None)
+                self._pending[pk] = (username, now)
+                self._pending_names[username] = pk
+                if hot or username in self._hot:
+                    self._remember(username, pk, now, now)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pending_names = {}
+        if not pending:
+            return 0
+        pks = list(pending)
+        renamed = []
+        with self._pool.connection() as conn:
+            for start in range(0, len(pks), 500):  # stay under SQLite's bound parameter limit
+                chunk = pks[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT username, pk FROM users WHERE pk IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                renamed.extend(username for username, pk in rows if pending[pk][0] != username)
+            with conn:
+                conn.executemany("DELETE FROM users WHERE username = ?", [(username,) for username in renamed])
+                conn.executemany("INSERT OR REPLACE INTO users (username, pk, seen_at) VALUES (?, ?, ?)",
+                                 [(username, pk, seen_at) for pk, (username, seen_at) in pending.items()])
+        with self._lock:
+            self.renames += len(renamed)
+            self.flushes += 1
+            for username in renamed:
+                self._hot.pop(username, None)
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hot_size": len(self._hot),
+                "hot_max_size": self.hot_size,
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "renames": self.renames,
+                "flushes": self.flushes
+            }
+
+
+username_index = None
+username_index_lock = threading.Lock()
+
+
+def get_username_index():
+    global username_index
+    with username_index_lock:
+        if username_index is None:
+            username_index = UsernameIndex()
+        return username_index
+
+
+def record_usernames(users, hot=False):
+    # the index is an optimisation, never fail the request over it
+    try:
+        get_username_index().record(users, hot=hot)
+    except Exception as e:
+        print(f"Error updating username index: {e}")
+
+
+def flush_username_index():
+    try:
+        if username_index is not None:
+            username_index.flush()
+    except Exception as e:
+        print(f"Error updating username index: {e}")
+
+
+def username_index_flusher(stop):
+    while not stop.wait(USERNAME_INDEX_FLUSH_INTERVAL):
+        flush_username_index()
+
+
+def resolve_user_pk(token, target_username):
+    # an empty name would make get_user answer with the caller's own pk
+    if not is_username(target_username):
+        raise ValueError("target_username required")
+    pk = get_username_index().lookup(target_username)
+    if pk is None:
+        pk = get_user(token, normalize_username(target_username), ["pk"])['pk']  # fetch_user records it
+    return pk
+
+
+@bp.route("/stats/username_index", methods=["GET"])
+def username_index_stats():
+    return jsonify({
+        "status": "success",
+        "username_index": get_username_index().stats()
+    })
+
+
+# -----------------------Response cache-----------------------
+RESPONSE_CACHE_MAX_SIZE = int(os.environ.get("RESPONSE_CACHE_MAX_SIZE", "10000"))
+RESPONSE_CACHE_TTLS = {  # seconds, per field class
+    "counts": int(os.environ.get("RESPONSE_CACHE_TTL_COUNTS", "60")),
+    "profile": int(os.environ.get("RESPONSE_CACHE_TTL_PROFILE", "3600")),
+}
+FIELD_TTL_CLASSES = {
+    "pk": "profile",
+    "follower_count": "counts",
+    "following_count": "counts",
+    "post_count": "counts",
+    "bio": "profile",
+    "profile_pic_url": "profile",
+    "verified": "profile",
+    "private": "profile",
+    "full_name": "profile",
+}
+
+
+class InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    # Caches upstream user payloads keyed by (token, username). Concurrent
+    # misses for the same key wait on a single in-flight fetch instead of
+    # all hitting Instagram. The cache lives in each server worker, so under
+    # gunicorn a payload can still be fetched once per worker, and only
+    # misses within one worker share a fetch.
+
+    def __init__(self, max_size=RESPONSE_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.max_ttl = max(RESPONSE_CACHE_TTLS.values())
+        self._entries = OrderedDict()  # key -> (value, fetched_at)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key, max_age, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = time.monotonic() - entry[1]
+                if age <= max_age:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                if age > self.max_ttl:
+                    del self._entries[key]
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = InFlight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            with self._lock:
+                self._entries[key] = (flight.value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.event.set()
+
+    def invalidate_scope(self, scope):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == scope]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttls": RESPONSE_CACHE_TTLS,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "in_flight": len(self._in_flight)
+            }
+
+
+response_cache = ResponseCache()
+
+
+def get_user(token, target_username=None, fields=PROFILE_FIELDS):
+    api = get_api_from_token(token)
+    max_age = min(RESPONSE_CACHE_TTLS[FIELD_TTL_CLASSES[field]] for field in fields)
+    # the same spelling the username index uses, so " Alice" and "alice" share an entry
+    target_username = normalize_username(target_username) if target_username else None
+    return response_cache.get((token, target_username), max_age, lambda: fetch_user(api, target_username))
+
+
+@bp.route("/stats/response_cache", methods=["GET"])
+def response_cache_stats():
+    return jsonify({
+        "status": "success",
+        "response_cache": response_cache.stats()
+    })
+
+
+def project_profile(user, fields):
+    return {field: user[PROFILE_FIELDS[field]] for field in fields}
+
+
+def parse_profile_fields(fields):
+    if not fields:
+        return list(PROFILE_FIELDS)
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+    if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        raise ValueError("fields must be a comma-separated string or a list of field names")
+    unknown = [field for field in fields if field not in PROFILE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def profile_field_response(field, own=False):
+    data = request.json
+    token = data.get("token", "")
+    target_username = None if own else data.get("target_username", "")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    # without a target get_user would answer with the caller's own profile
+    if not own and not is_username(target_username):
+        return jsonify({"status": "error", "message": "target_username required"}), 400
+
+    try:
+        user = get_user(token, target_username, [field])
+        response = {"status": "success"}
+        response.update(project_profile(user, [field]))
+        return jsonify(response)
+    except Exception as e:
+        return error_response(e)
+
+
+@bp.route("/profile", methods=["POST"])
+def profile():
+    data = request.json
+    token = data.get("token", "")
+    target_username = data.get("target_username")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    # omitted means the caller's own profile, anything sent must name someone
+    if target_username is not None and not is_username(target_username):
+        return jsonify({"status": "error", "message": "target_username must be a non-empty string"}), 400
+
+    try:
+        fields = parse_profile_fields(data.get("fields"))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        user = get_user(token, target_username, fields)
+        return jsonify({
+            "status": "success",
+            "profile": project_profile(user, fields)
+        })
+    except Exception as e:
+        return error_response(e)
+
+
+# -----------------------Batch lookups-----------------------
+BATCH_MAX_USERNAMES = int(os.environ.get("BATCH_MAX_USERNAMES", "10000"))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "32"))
+BATCH_PER_TOKEN_CONCURRENCY = int(os.environ.get("BATCH_PER_TOKEN_CONCURRENCY", "4"))
+BATCH_LIMITERS_MAX_SIZE = int(os.environ.get("BATCH_LIMITERS_MAX_SIZE", "10000"))
+# Batch lookups queue behind the rate governor for up to this long instead
+# of failing after RATE_LIMIT_MAX_WAIT; with BATCH_PER_TOKEN_CONCURRENCY
+# calls in flight a batch goes at the account's rate.
+BATCH_RATE_MAX_WAIT = float(os.environ.get("BATCH_RATE_MAX_WAIT", "600"))  # seconds
+BATCH_READ_AHEAD = 64  # finished lookups kept waiting for an earlier, slower one
+
+batch_executor = None
+token_limiters = OrderedDict()  # token -> [semaphore, batches using it]
+token_limiters_lock = threading.Lock()
+
+
+def get_batch_executor():
+    global batch_executor
+    with token_limiters_lock:
+        if batch_executor is None:
+            batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+        return batch_executor
+
+
+@contextlib.contextmanager
+def token_limiter(token):
+    # caps in-flight upstream calls per account across all batch requests;
+    # past BATCH_LIMITERS_MAX_SIZE tokens the least recently used limiters
+    # no batch is holding are dropped, a held one is never replaced
+    with token_limiters_lock:
+        entry = token_limiters.get(token)
+        if entry is None:
+            entry = token_limiters[token] = [threading.BoundedSemaphore(BATCH_PER_TOKEN_CONCURRENCY), 0]
+        token_limiters.move_to_end(token)
+        entry[1] += 1
+        if len(token_limiters) > BATCH_LIMITERS_MAX_SIZE:
+            idle = [key for key, (_, users) in token_limiters.items() if not users]
+            for key in idle[:len(token_limiters) - BATCH_LIMITERS_MAX_SIZE]:
+                del token_limiters[key]
+    try:
+        yield entry[0]
+    finally:
+        with token_limiters_lock:
+            entry[1] -= 1
+
+
+def fetch_profile_entry(token, target_username, fields):
+    try:
+        with rate_governor.patient(BATCH_RATE_MAX_WAIT):
+            user = get_user(token, target_username, fields)
+        return {
+            "target_username": target_username,
+            "status": "success",
+            "profile": project_profile(user, fields)
+        }
+    except RateLimited as e:
+        return {"target_username": target_username, "status": "error", "message": str(e),
+                "retry_after": e.retry_after}
+    except Exception as e:
+        return {"target_username": target_username, "status": "error", "message": str(e)}
+
+
+def run_batch(token, usernames, fields):
+    # yields the entries in the order of usernames, each as soon as it and
+    # the ones before it are done; closing the generator cancels the rest
+    with token_limiter(token) as limiter:
+        pending = deque()
+        try:
+            for target_username in usernames:
+                while pending and (pending[0].done() or len(pending) >= BATCH_READ_AHEAD):
+                    yield pending.popleft().result()
+                # acquire before submitting so pool threads never sit blocked on a limiter
+                limiter.acquire()
+                try:
+                    future = get_batch_executor().submit(fetch_profile_entry, token, target_username, fields)
+                except Exception:
+                    limiter.release()
+                    raise
+                future.add_done_callback(lambda _: limiter.release())
+                pending.append(future)
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def stream_batch(results):
+    # the same document as a buffered answer, written entry by entry; the
+    # status comes last, after the failed count it depends on
+    failed = 0
+    tail = {"status": "success"}
+    yield b'{"results":['
+    try:
+        for index, result in enumerate(results):
+            failed += result["status"] != "success"
+            yield (b"," if index else b"") + ndjson_line(result)[:-1]
+    except Exception as e:
+        print(f"Error: {e}")
+        tail = {"status": "error", "message": str(e)}
+    # '],"failed":0,"status":"success"}': the object's members without its "{"
+    yield b"]," + ndjson_line({"failed": failed, **tail})[1:-1]
+
+
+@bp.route("/batch/profile", methods=["POST"])
+def batch_profile():
+    data = request.json
+    token = data.get("token", "")
+    usernames = data.get("target_usernames") or []
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    if not isinstance(usernames, list) or not all(isinstance(name, str) and name for name in usernames):
+        return jsonify({"status": "error", "message": "target_usernames must be a list of usernames"}), 400
+    if len(usernames) > BATCH_MAX_USERNAMES:
+        return jsonify({"status": "error", "message": f"At most {BATCH_MAX_USERNAMES} usernames per batch"}), 400
+
+    try:
+        fields = parse_profile_fields(data.get("fields"))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        get_api_from_token(token)
+        # {"results": [...], "failed", "status"}, streamed so a large batch is
+        # never held in memory whole
+        return compress_response(Response(stream_batch(run_batch(token, usernames, fields)),
+                                          mimetype="application/json"))
+    except Exception as e:
+        return error_response(e)
+
+
+@bp.route("/get_own_number_of_followers", methods=["POST"])
+def get_own_number_of_followers():
+    return profile_field_response("follower_count", own=True)
+
+
+@bp.route("/get_number_of_followers", methods=["POST"])
+def get_number_of_followers():
+    return profile_field_response("follower_count")
+
+
+@bp.route("/get_own_number_of_following", methods=["POST"])
+def get_own_number_of_following():
+    return profile_field_response("following_count", own=True)
+
+
+@bp.route("/get_number_of_following", methods=["POST"])
+def get_number_of_following():
+    return profile_field_response("following_count")
+
+
+# -----------------------Followers-----------------------
+FOLLOWERS_PAGE_DELAY = float(os.environ.get("FOLLOWERS_PAGE_DELAY", "0"))  # seconds between pages
+FOLLOWERS_MAX_PAGE_DELAY = float(os.environ.get("FOLLOWERS_MAX_PAGE_DELAY", "10"))  # cap on a client's page_delay
+
+
+def parse_friendship_cursor(cursor):
+    # "<rank_token>:<max_id>"; one rank token has to be used for the whole
+    # walk of a list, so it travels in the cursor the client sends back.
+    # A bare max_id (cursors from before) starts a new rank token.
+    rank_token, _, max_id = (cursor or "").partition(":")
+    try:
+        uuid.UUID(rank_token)
+    except ValueError:
+        return str(uuid.uuid4()), cursor or None
+    return rank_token, max_id or None
+
+
+def iter_friendship_pages(api, call, user_id, cursor=None):
+    # user_followers and user_following page the same way; both are
+    # governed as the "followers" endpoint class. Yields (users, cursor of
+    # the next page).
+    rank_token, max_id = parse_friendship_cursor(cursor)
+    while True:
+        if max_id:
+            results = rate_governor.call(api, "followers", call, user_id, rank_token, max_id=max_id)
+        else:
+            results = rate_governor.call(api, "followers", call, user_id, rank_token)
+        next_max_id = results.get('next_max_id')
+        record_usernames(results.get('users', []))
+        yield results.get('users', []), f"{rank_token}:{next_max_id}" if next_max_id else None
+        if not next_max_id:
+            return
+        max_id = next_max_id
+
+
+def iter_follower_pages(api, user_id, cursor=None):
+    return iter_friendship_pages(api, api.user_followers, user_id, cursor)
+
+
+def iter_following_pages(api, user_id, cursor=None):
+    return iter_friendship_pages(api, api.user_following, user_id, cursor)
+
+
+FOLLOWER_FORMATS = ("users", "pk", "columnar")
+
+
+def stream_options(data):
+    wire_format = data.get("format") or "users"
+    if wire_format not in FOLLOWER_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FOLLOWER_FORMATS)}")
+    cursor = data.get("cursor") or None
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError("cursor must be a string")
+    return {
+        "cursor": cursor,
+        "skip": non_negative_option(data, "skip", 0, int),
+        "max_items": non_negative_option(data, "max_items", 0, int),
+        # seconds may be fractional; capped so one stream cannot hold a
+        # worker for as long as the client likes
+        "page_delay": min(non_negative_option(data, "page_delay", FOLLOWERS_PAGE_DELAY, (int, float)),
+                          FOLLOWERS_MAX_PAGE_DELAY),
+        "wire_format": wire_format
+    }
+
+
+def non_negative_option(data, name, default, types):
+    value = data.get(name)
+    if value is None:
+        return default
+    # bool is an int too, and NaN fails every comparison
+    if isinstance(value, bool) or not isinstance(value, types) or not value >= 0:
+        raise ValueError(f"{name} must be a non-negative {'integer' if types is int else 'number'}")
+    return value
+
+
+def user_lines(users, wire_format):
+    # "users": one {"pk", "username"} line per user; "pk": one {"pk": [...]}
+    # line per page; "columnar": one {"pk": [...], "username": [...]} line
+    if wire_format == "users":
+        return [ndjson_line({"pk": user['pk'], "username": user['username']}) for user in users]
+    if not users:
+        return []
+    page = {"pk": [user['pk'] for user in users]}
+    if wire_format == "columnar":
+        page["username"] = [user['username'] for user in users]
+    return [ndjson_line(page)]
+
+
+def stream_users(pages, cursor=None, skip=0, max_items=0, page_delay=0, wire_format="users"):
+    # NDJSON: the page's users in wire_format, a {"cursor"} line after each
+    # page, and a final status line. Resume with the last cursor (and skip,
+    # when max_items stopped in the middle of a page). Pages are only
+    # fetched as the client reads and each one is written as one chunk, so
+    # memory stays at one page.
+    def generate():
+        count = 0
+        page_cursor = cursor
+        try:
+            for users, next_max_id in pages:
+                start = skip if page_cursor == cursor else 0
+                selected = users[start:]
+                if max_items and count + len(selected) > max_items:
+                    selected = selected[:max_items - count]
+                    count += len(selected)
+                    yield b"".join(user_lines(selected, wire_format) + [ndjson_line(
+                        {"status": "success", "count": count, "cursor": page_cursor,
+                         "skip": start + len(selected)})])
+                    return
+                count += len(selected)
+                yield b"".join(user_lines(selected, wire_format) + [ndjson_line(
+                    {"cursor": next_max_id, "count": count})])
+                page_cursor = next_max_id
+                if max_items and count >= max_items:
+                    break
+                if next_max_id and page_delay:
+                    time.sleep(page_delay)
+            yield ndjson_line({"status": "success", "count": count, "cursor": page_cursor})
+        except Exception as e:
+            print(f"Error: {e}")
+            error = {"status": "error", "message": str(e), "count": count, "cursor": page_cursor}
+            if isinstance(e, RateLimited):
+                error["retry_after"] = e.retry_after
+            yield ndjson_line(error)
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+def follower_list_response(users, wire_format, key="followers"):
+    if wire_format == "users":
+        return jsonify({
+            "status": "success",
+            key: [user['username'] for user in users]
+        })
+    body = {"status": "success", "format": wire_format, "pk": [user['pk'] for user in users]}
+    if wire_format == "columnar":
+        body["username"] = [user['username'] for user in users]
+    return jsonify(body)
+
+
+def stream_followers(api, user_id, options):
+    pages = iter_follower_pages(api, user_id, options["cursor"])
+    return stream_users(pages, **options)
+
+
+def stream_following(api, user_id, options):
+    pages = iter_following_pages(api, user_id, options["cursor"])
+    return stream_users(pages, **options)
+
+
+@bp.route("/get_own_followers", methods=["POST"])
+def get_own_followers():
+    data = request.json
+    token = data.get("token", "")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+
+    try:
+        options = stream_options(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        api = get_api_from_token(token)
+        if data.get("stream"):
+            return compress_response(stream_followers(api, api.authenticated_user_id, options))
+
+        users, _ = next(iter_follower_pages(api, api.authenticated_user_id))
+        return compress_response(follower_list_response(users, options["wire_format"]))
+    except Exception as e:
+        return error_response(e)
+
+
+@bp.route("/get_followers", methods=["POST"])
+def get_followers():
+    data = request.json
+    token = data.get("token", "")
+    target_username = data.get("target_username", "")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    if not is_username(target_username):
+        return jsonify({"status": "error", "message": "target_username required"}), 400
+
+    try:
+        options = stream_options(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        api = get_api_from_token(token)
+        target_user_id = resolve_user_pk(token, target_username)
+        if data.get("stream"):
+            return compress_response(stream_followers(api, target_user_id, options))
+
+        users, _ = next(iter_follower_pages(api, target_user_id))
+        return compress_response(follower_list_response(users, options["wire_format"]))
+    except Exception as e:
+        return error_response(e)
+
+
+@bp.route("/get_own_following", methods=["POST"])
+def get_own_following():
+    data = request.json
+    token = data.get("token", "")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+
+    try:
+        options = stream_options(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        api = get_api_from_token(token)
+        if data.get("stream"):
+            return compress_response(stream_following(api, api.authenticated_user_id, options))
+
+        users, _ = next(iter_following_pages(api, api.authenticated_user_id))
+        return compress_response(follower_list_response(users, options["wire_format"], key="following"))
+    except Exception as e:
+        return error_response(e)
+
+
+@bp.route("/get_following", methods=["POST"])
+def get_following():
+    data = request.json
+    token = data.get("token", "")
+    target_username = data.get("target_username", "")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    if not is_username(target_username):
+        return jsonify({"status": "error", "message": "target_username required"}), 400
+
+    try:
+        options = stream_options(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        api = get_api_from_token(token)
+        target_user_id = resolve_user_pk(token, target_username)
+        if data.get("stream"):
+            return compress_response(stream_following(api, target_user_id, options))
+
+        users, _ = next(iter_following_pages(api, target_user_id))
+        return compress_response(follower_list_response(users, options["wire_format"], key="following"))
+    except Exception as e:
+        return error_response(e)
+
+
+# -----------------------Relationship diff-----------------------
+# followers_only (they follow the account, it does not follow them back)
+# and following_only (the account follows them, they do not follow back).
+# Instagram caps following at 7,500, so the following list is held sorted
+# in memory and the follower side, which can run to millions, is streamed
+# past it page by page (or read from a snapshot younger than max_age, in
+# pk order): followers_only lines go out as each page arrives, and the
+# following entries never matched are written at the end.
+RELATIONSHIP_SNAPSHOT_BATCH = 10000
+RELATIONSHIPS = ("followers_only", "following_only")
+
+
+def iter_snapshot_batches(base_path):
+    batch = []
+    for pk, username in iter_snapshot(base_path):
+        batch.append({"pk": pk, "username": username})
+        if len(batch) >= RELATIONSHIP_SNAPSHOT_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def relationship_diff(following_pages, follower_batches, only=None):
+    def generate():
+        counts = {"followers": 0, "following": 0, "followers_only": 0, "following_only": 0, "mutual": 0}
+        try:
+            following = sorted(((int(user['pk']), user['username'])
+                                for users, _ in following_pages for user in users))
+            following_pks = array('q', (pk for pk, _ in following))
+            matched = bytearray(len(following))
+            counts["following"] = len(following)
+            yield ndjson_line({"following": len(following)})
+
+            for users in follower_batches:
+                lines = []
+                for user in users:
+                    pk = int(user['pk'])
+                    index = bisect.bisect_left(following_pks, pk)
+                    if index < len(following_pks) and following_pks[index] == pk:
+                        if not matched[index]:
+                            matched[index] = 1
+                            counts["mutual"] += 1
+                        continue
+                    counts["followers_only"] += 1
+                    if only in (None, "followers_only"):
+                        lines.append(ndjson_line({"relation": "followers_only", "pk": pk,
+                                                  "username": user['username']}))
+                counts["followers"] += len(users)
+                lines.append(ndjson_line({"followers_seen": counts["followers"]}))
+                yield b"".join(lines)
+
+            lines = []
+            for index, (pk, username) in enumerate(following):
+                if matched[index]:
+                    continue
+                counts["following_only"] += 1
+                if only in (None, "following_only"):
+                    lines.append(ndjson_line({"relation": "following_only", "pk": pk, "username": username}))
+            yield b"".join(lines) + ndjson_line({"status": "success", **counts})
+        except Exception as e:
+            print(f"Error: {e}")
+            error = {"status": "error", "message": str(e), **counts}
+            if isinstance(e, RateLimited):
+                error["retry_after"] = e.retry_after
+            yield ndjson_line(error)
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@bp.route("/relationship_diff", methods=["POST"])
+def relationship_diff_route():
+    data = request.json
+    token = data.get("token", "")
+    target_username = data.get("target_username", "")
+    only = data.get("only") or None
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    if only is not None and only not in RELATIONSHIPS:
+        return jsonify({"status": "error", "message": f"only must be one of {', '.join(RELATIONSHIPS)}"}), 400
+    try:
+        max_age = int(data.get("max_age") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "max_age must be an integer"}), 400
+
+    try:
+        api = get_api_from_token(token)
+        if target_username in (None, ""):
+            user_id = api.authenticated_user_id
+        else:
+            try:
+                user_id = resolve_user_pk(token, target_username)
+            except ValueError as e:  # not a username
+                return jsonify({"status": "error", "message": str(e)}), 400
+        snapshot = latest_snapshot(api.authenticated_user_id, user_id, max_age) if max_age else None
+        if snapshot is not None:
+            follower_batches = iter_snapshot_batches(snapshot)
+        else:
+            follower_batches = (users for users, _ in iter_follower_pages(api, user_id))
+        return compress_response(relationship_diff(iter_following_pages(api, user_id), follower_batches, only))
+    except Exception as e:
+        return error_response(e)
+
+
+@bp.route("/get_own_bio", methods=["POST"])
+def get_own_bio():
+    return profile_field_response("bio", own=True)
+
+
+@bp.route("/get_bio", methods=["POST"])
+def get_bio():
+    return profile_field_response("bio")
+
+
+@bp.route("/get_own_post_count", methods=["POST"])
+def get_own_post_count():
+    return profile_field_response("post_count", own=True)
+
+
+@bp.route("/get_post_count", methods=["POST"])
+def get_post_count():
+    return profile_field_response("post_count")
+
+
+@bp.route("/get_own_profile_pic_url", methods=["POST"])
+def get_own_profile_pic_url():
+    return profile_field_response("profile_pic_url", own=True)
+
+
+@bp.route("/get_profile_pic_url", methods=["POST"])
+def get_profile_pic_url():
+    return profile_field_response("profile_pic_url")
+
+
+@bp.route("/get_own_verified", methods=["POST"])
+def get_own_verified():
+    return profile_field_response("verified", own=True)
+
+
+@bp.route("/get_verified", methods=["POST"])
+def get_verified():
+    return profile_field_response("verified")
+
+
+@bp.route("/get_own_private", methods=["POST"])
+def get_own_private():
+    return profile_field_response("private", own=True)
+
+
+@bp.route("/get_private", methods=["POST"])
+def get_private():
+    return profile_field_response("private")
+
+
+@bp.route("/get_own_full_name", methods=["POST"])
+def get_own_full_name():
+    return profile_field_response("full_name", own=True)
+
+
+@bp.route("/get_full_name", methods=["POST"])
+def get_full_name():
+    return profile_field_response("full_name")
+
+
+# -----------------------Fetch Data Methods-------------------
+
+
+# -----------------------Timeline-----------------------
+# /timeline pages through feed_timeline with max_id and streams one NDJSON
+# line per post. Each page goes through filter (media only, ads dropped
+# unless include_ads) -> ClientCompatPatch.media -> projection; patching
+# and projection run on a worker pool while the next page is fetched, so
+# the upstream round trip and the per-item work overlap. Per-stage times
+# are in the final line and in igapi_timeline_stage_seconds. Resume with
+# the last cursor (and skip, when max_items stopped in the middle of a
+# page; it counts the page's posts left after filtering).
+TIMELINE_WORKERS = int(os.environ.get("TIMELINE_WORKERS", "4"))
+TIMELINE_MAX_PAGES = int(os.environ.get("TIMELINE_MAX_PAGES", "5"))
+TIMELINE_STAGES = ("fetch", "filter", "patch", "project", "encode")
+
+timeline_executor = None
+timeline_lock = threading.Lock()
+
+
+def get_timeline_executor():
+    global timeline_executor
+    with timeline_lock:
+        if timeline_executor is None:
+            timeline_executor = ThreadPoolExecutor(max_workers=TIMELINE_WORKERS, thread_name_prefix="timeline")
+        return timeline_executor
+
+
+def iter_timeline_pages(api, max_id, stages):
+    while True:
+        started = time.perf_counter()
+        if max_id:
+            results = rate_governor.call(api, "timeline", api.feed_timeline, max_id=max_id)
+        else:
+            results = rate_governor.call(api, "timeline", api.feed_timeline)
+        elapsed = time.perf_counter() - started
+        stages["fetch"] += elapsed
+        timeline_stage_seconds.observe(elapsed, "fetch")
+        next_max_id = results.get('next_max_id') if results.get('more_available') else None
+        yield results.get('feed_items', []), next_max_id
+        if not next_max_id:
+            return
+        max_id = next_max_id
+
+
+def project_media(media):
+    images = media.get('images') or {}
+    videos = media.get('videos') or {}
+    caption = media.get('caption') or {}
+    return {
+        "pk": media.get('pk'),
+        "code": media['code'],
+        "link": media['link'],
+        "type": media.get('type'),
+        "taken_at": int(media['created_time']),
+        "username": media['user'].get('username'),
+        "caption": caption.get('text', ''),
+        "like_count": media.get('like_count', 0),
+        "comment_count": media.get('comment_count', 0),
+        "image_url": (images.get('standard_resolution') or {}).get('url'),
+        "video_url": (videos.get('standard_resolution') or {}).get('url')
+    }
+
+
+def patch_and_project(media):
+    started = time.perf_counter()
+    ClientCompatPatch.media(media)
+    patched = time.perf_counter()
+    item = project_media(media)
+    return item, patched - started, time.perf_counter() - patched
+
+
+def stream_timeline(api, cursor=None, max_pages=TIMELINE_MAX_PAGES, max_items=0, include_ads=False, skip=0):
+    def generate():
+        stages = dict.fromkeys(TIMELINE_STAGES, 0.0)
+        count = 0
+        pages = 0
+        page_cursor = cursor
+        resume = {}
+        executor = get_timeline_executor()
+        try:
+            page_iter = iter_timeline_pages(api, cursor, stages)
+            page = next(page_iter)
+            while page is not None:
+                page_stages = dict(stages)
+                feed_items, next_max_id = page
+                started = time.perf_counter()
+                medias = [item['media_or_ad'] for item in feed_items
+                          if item.get('media_or_ad') and (include_ads or not item['media_or_ad'].get('injected'))]
+                start = skip if pages == 0 else 0
+                medias = medias[start:]
+                if max_items and count + len(medias) > max_items:
+                    # stopping inside this page: resume from its own cursor
+                    medias = medias[:max_items - count]
+                    resume = {"skip": start + len(medias)}
+                stages["filter"] += time.perf_counter() - started
+                futures = [executor.submit(patch_and_project, media) for media in medias]
+                pages += 1
+
+                # fetch the next page while the pool works on this one; a
+                # failure is reported after this page has been sent
+                page = None
+                fetch_error = None
+                if next_max_id and pages < max_pages and not (max_items and count + len(medias) >= max_items):
+                    try:
+                        page = next(page_iter)
+                    except Exception as e:
+                        fetch_error = e
+
+                lines = []
+                for future in futures:
+                    item, patch_seconds, project_seconds = future.result()
+                    stages["patch"] += patch_seconds
+                    stages["project"] += project_seconds
+                    started = time.perf_counter()
+                    lines.append(ndjson_line(item))
+                    stages["encode"] += time.perf_counter() - started
+                count += len(medias)
+                if not resume:
+                    page_cursor = next_max_id
+                lines.append(ndjson_line({"cursor": page_cursor, **resume, "count": count}))
+                for stage in TIMELINE_STAGES[1:]:  # fetch is observed per call
+                    timeline_stage_seconds.observe(stages[stage] - page_stages[stage], stage)
+                yield b"".join(lines)
+                if fetch_error is not None:
+                    raise fetch_error
+            yield ndjson_line({"status": "success", "count": count, "pages": pages, "cursor": page_cursor, **resume,
+                               "stage_ms": {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()}})
+        except Exception as e:
+            print(f"Error: {e}")
+            error = {"status": "error", "message": str(e), "count": count, "cursor": page_cursor,
+                     "stage_ms": {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()}}
+            if isinstance(e, RateLimited):
+                error["retry_after"] = e.retry_after
+            yield ndjson_line(error)
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@bp.route("/timeline", methods=["POST"])
+def timeline():
+    data = request.json
+    token = data.get("token", "")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    try:
+        max_pages = int(data.get("max_pages") or TIMELINE_MAX_PAGES)
+        max_items = int(data.get("max_items") or 0)
+        skip = int(data.get("skip") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "max_pages, max_items and skip must be integers"}), 400
+
+    try:
+        api = get_api_from_token(token)
+        return compress_response(stream_timeline(api, data.get("cursor") or None, max_pages, max_items,
+                                                 bool(data.get("include_ads")), skip))
+    except Exception as e:
+        return error_response(e)
+
+
+# -----------------------Profile pictures-----------------------
+# Pictures are stored content-addressed as profile_pics/objects/ab/<sha256>.jpg
+# so the same image is kept once however many URLs point at it. An index
+# of url -> (sha256, ETag, Last-Modified) lets refreshes be conditional.
+# Only https URLs on MEDIA_ALLOWED_HOSTS (and their subdomains) are
+# fetched, never from a non-public address, without following redirects,
+# and only image responses of at most MEDIA_MAX_BYTES that finish within
+# MEDIA_TIMEOUT seconds are kept.
+MEDIA_FOLDER = os.environ.get("MEDIA_FOLDER", "profile_pics")
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "16"))
+MEDIA_CHUNK_SIZE = 256 * 1024
+MEDIA_TIMEOUT = float(os.environ.get("MEDIA_TIMEOUT", "15"))  # seconds for the whole download
+MEDIA_MAX_BYTES = int(os.environ.get("MEDIA_MAX_BYTES", str(8 * 1024 * 1024)))
+MEDIA_ALLOWED_HOSTS = tuple(host.strip().lower() for host in os.environ.get(
+    "MEDIA_ALLOWED_HOSTS", "cdninstagram.com,fbcdn.net").split(",") if host.strip())
+MEDIA_REFRESH_SECONDS = int(os.environ.get("MEDIA_REFRESH_SECONDS", "86400"))
+MEDIA_MAX_URLS = int(os.environ.get("MEDIA_MAX_URLS", "10000"))
+
+media_session = None
+media_transport = None  # the media session's pool, reported next to the upstream one
+media_executor = None
+media_lock = threading.Lock()
+
+
+def get_media_session():
+    global media_session, media_transport
+    with media_lock:
+        if media_session is None:
+            import requests  # loaded on first use, keeps it off the startup path
+            import requests.adapters
+            media_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter()
+            # its own pool, so the non-public address check never applies
+            # to the upstream API (which may be a stand-in on localhost)
+            media_transport = SharedTransport(public_only=True)
+            adapter.poolmanager = media_transport.pool
+            media_session.mount("https://", adapter)
+            media_session.mount("http://", adapter)
+        return media_session
+
+
+def get_media_executor():
+    global media_executor
+    with media_lock:
+        if media_executor is None:
+            media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+        return media_executor
+
+
+class MediaIndex:
+    def __init__(self, folder=MEDIA_FOLDER):
+        os.makedirs(os.path.join(folder, "objects"), exist_ok=True)
+        self.path = os.path.join(folder, "index.db")
+        self._pool = SQLitePool(self.path, self._setup, isolation_level=None)
+
+    @staticmethod
+    def _setup(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL,"
+            " etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL)")
+
+    def get(self, url):
+        with self._pool.connection() as conn:
+            return conn.execute(
+                "SELECT sha256, etag, last_modified, fetched_at FROM urls WHERE url = ?", (url,)).fetchone()
+
+    def put(self, url, sha256, etag, last_modified):
+        with self._pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO urls (url, sha256, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (url, sha256, etag, last_modified, time.time()))
+
+    def touch(self, url):
+        with self._pool.connection() as conn:
+            conn.execute("UPDATE urls SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+
+media_index = None
+
+
+def get_media_index():
+    global media_index
+    with media_lock:
+        if media_index is None:
+            media_index = MediaIndex()
+        return media_index
+
+
+def media_object_path(sha256):
+    return os.path.join(MEDIA_FOLDER, "objects", sha256[:2], f"{sha256}.jpg")
+
+
+def media_url_allowed(url):
+    if not isinstance(url, str):
+        return False
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    if parsed.scheme != "https" or parsed.username or parsed.password or parsed.port not in (None, 443):
+        return False
+    return any(host == allowed or host.endswith("." + allowed) for allowed in MEDIA_ALLOWED_HOSTS)
+
+
+def fetch_profile_picture(url):
+    if not media_url_allowed(url):
+        return {"url": url, "status": "error", "message": "Not an allowed picture URL"}
+    index = get_media_index()
+    known = index.get(url)
+    headers = {}
+    if known is not None and os.path.exists(media_object_path(known[0])):
+        if time.time() - known[3] < MEDIA_REFRESH_SECONDS:
+            return {"url": url, "status": "cached", "sha256": known[0]}
+        if known[1]:
+            headers["If-None-Match"] = known[1]
+        if known[2]:
+            headers["If-Modified-Since"] = known[2]
+
+    started = time.monotonic()
+    session = get_media_session()
+    # requests talks to the pool directly, past SharedTransport.open, so
+    # the downloads are counted here
+    with media_transport.stats.lock:
+        media_transport.stats.requests += 1
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=MEDIA_TIMEOUT,
+                                     allow_redirects=False) as response:
+            if response.status_code == 304 and known is not None:
+                index.touch(url)
+                return {"url": url, "status": "not_modified", "sha256": known[0]}
+            if response.status_code != 200:
+                return {"url": url, "status": "error", "message": f"HTTP {response.status_code}"}
+            if not response.headers.get("Content-Type", "").startswith("image/"):
+                return {"url": url, "status": "error", "message": "Not an image"}
+            if int(response.headers.get("Content-Length") or 0) > MEDIA_MAX_BYTES:
+                return {"url": url, "status": "error", "message": f"Larger than {MEDIA_MAX_BYTES} bytes"}
+
+            digest = hashlib.sha256()
+            size = 0
+            objects_folder = os.path.join(MEDIA_FOLDER, "objects")
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=objects_folder)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    # the requests timeout is per read, so the deadline is
+                    # checked between reads; read1 returns whatever arrived
+                    # instead of waiting for a full chunk
+                    while True:
+                        chunk = response.raw.read1(MEDIA_CHUNK_SIZE, decode_content=True)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if size > MEDIA_MAX_BYTES:
+                            raise ValueError(f"Larger than {MEDIA_MAX_BYTES} bytes")
+                        if time.monotonic() - started > MEDIA_TIMEOUT:
+                            raise TimeoutError(f"Not downloaded within {MEDIA_TIMEOUT} seconds")
+                        digest.update(chunk)
+                        f.write(chunk)
+                sha256 = digest.hexdigest()
+                path = media_object_path(sha256)
+                if os.path.exists(path):
+                    status = "duplicate"
+                else:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(tmp_path, path)
+                    status = "downloaded"
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            index.put(url, sha256, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            return {"url": url, "status": status, "sha256": sha256}
+    except Exception as e:
+        with media_transport.stats.lock:
+            media_transport.stats.errors += 1
+        return {"url": url, "status": "error", "message": str(e)}
+
+
+def fetch_profile_pictures(urls):
+    return list(get_media_executor().map(fetch_profile_picture, urls))
+
+
+def download_profile_picture(url, filename='profile_pic.jpg'):
+    try:
+        result = fetch_profile_picture(url)
+        if result["status"] == "error":
+            print(f"Failed to download image. {result['message']}")
+            return
+        tmp_path = f"{filename}.tmp"
+        shutil.copyfile(media_object_path(result["sha256"]), tmp_path)
+        os.replace(tmp_path, filename)
+        print(f"Profile picture saved as '{filename}'")
+    except Exception as e:
+        print(f"Error downloading profile picture: {e}")
+
+
+@bp.route("/profile_pics/fetch", methods=["POST"])
+def profile_pics_fetch():
+    # urls, target_usernames and followers_of (a username, or "" for your
+    # own followers) can be combined; max_items caps the follower walk
+    data = request.json
+    token = data.get("token", "")
+    urls = data.get("urls") or []
+    target_usernames = data.get("target_usernames") or []
+    followers_of = data.get("followers_of")
+
+    if not token:
+        return jsonify({"status": "error", "message": "Token required"}), 400
+    if not isinstance(urls, list) or not all(media_url_allowed(url) for url in urls):
+        return jsonify({"status": "error", "message": "urls must be https URLs on "
+                        + ", ".join(MEDIA_ALLOWED_HOSTS)}), 400
+    # a string would be walked letter by letter, and an empty name means
+    # the caller's own picture
+    if not isinstance(target_usernames, list) or not all(is_username(name) for name in target_usernames):
+        return jsonify({"status": "error", "message": "target_usernames must be a list of usernames"}), 400
+    try:
+        max_items = int(data.get("max_items") or MEDIA_MAX_URLS)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        get_api_from_token(token)
+        urls = list(urls)
+        for target_username in target_usernames:
+            urls.append(get_user(token, target_username, ["profile_pic_url"])['profile_pic_url'])
+        if followers_of is not None:
+            api = get_api_from_token(token)
+            user_id = resolve_user_pk(token, followers_of) if followers_of else api.authenticated_user_id
+            for count, user in enumerate(iter_followers(api, user_id)):
+                if count >= max_items:
+                    break
+                if user.get('profile_pic_url'):
+                    urls.append(user['profile_pic_url'])
+        urls = list(dict.fromkeys(urls))
+        if len(urls) > MEDIA_MAX_URLS:
+            return jsonify({"status": "error", "message": f"At most {MEDIA_MAX_URLS} pictures per call"}), 400
+
+        results = fetch_profile_pictures(urls)
+        return jsonify({
+            "status": "success",
+            "failed": sum(1 for result in results if result["status"] == "error"),
+            "results": results
+        })
+    except Exception as e:
+        return error_response(e)
+
+
+@bp.route("/profile_pics/<sha256>", methods=["GET"])
+def profile_pic(sha256):
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        return jsonify({"status": "error", "message": "Invalid picture id"}), 400
+    path = media_object_path(sha256)
+    # a peer asking for its own copy is answered from here only
+    from_peer = CLUSTER_HOP_HEADER in request.headers and cluster_request_allowed()
+    if not os.path.exists(path) and (not cluster.enabled or from_peer or not cluster.pull_media(sha256)):
+        return jsonify({"status": "error", "message": "Picture not found"}), 404
+    return send_file(os.path.abspath(path), mimetype="image/jpeg", max_age=MEDIA_REFRESH_SECONDS)
+
+
+# -----------------------Follower snapshots-----------------------
+# A snapshot is two files written in pk order:
+#   followers_{label}.pks   header + sorted native int64 pks (mmap-able)
+#   followers_{label}.names one username per line, aligned with the pks
+# They are built from a full paginated walk with an external merge sort, so
+# memory stays at SNAPSHOT_RUN_SIZE users no matter how big the account is,
+# and two snapshots are diffed with a streaming merge over both files.
+# Snapshots are filed under the logged-in account that walked the list
+# (SNAPSHOT_FOLDER/<owner pk>/<account pk>/) and only that account reads
+# them back: what a session can see of a private account's followers
+# depends on whose session it is.
+SNAPSHOT_FOLDER = os.environ.get("SNAPSHOT_FOLDER", "snapshots")
+SNAPSHOT_RUN_SIZE = int(os.environ.get("SNAPSHOT_RUN_SIZE", "500000"))
+SNAPSHOT_MAGIC = b"IGF"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<3sBQd")  # magic, version, count, taken_at
+SNAPSHOT_WRITE_BLOCK = 65536
+
+
+def snapshot_base_path(owner_id, account_id, label):
+    return os.path.join(SNAPSHOT_FOLDER, str(owner_id), str(account_id), f"followers_{label}")
+
+
+def snapshot_file_path(relative_path):
+    # None for a path that would land outside SNAPSHOT_FOLDER
+    root = os.path.realpath(SNAPSHOT_FOLDER)
+    path = os.path.realpath(os.path.join(root, relative_path))
+    return path if path.startswith(root + os.sep) else None
+
+
+def iter_followers(api, user_id):
+    for users, _ in iter_follower_pages(api, user_id):
+        for user in users:
+            yield user
+
+
+def _write_run(chunk, folder):
+    chunk.sort()
+    fd, path = tempfile.mkstemp(suffix=".run", dir=folder)
+    with os.fdopen(fd, 'w') as run:
+        for pk, username in chunk:
+            run.write(f"{pk}\t{username}\n")
+    return path
+
+
+def _read_run(path):
+    with open(path) as run:
+        for line in run:
+            pk, username = line.rstrip("\n").split("\t", 1)
+            yield int(pk), username
+
+
+def write_snapshot(users, base_path):
+    folder = os.path.dirname(base_path) or "."
+    os.makedirs(folder, exist_ok=True)
+    pks_tmp = f"{base_path}.pks.tmp"
+    names_tmp = f"{base_path}.names.tmp"
+    runs = []
+    chunk = []
+    try:
+        for user in users:
+            chunk.append((int(user['pk']), user['username']))
+            if len(chunk) >= SNAPSHOT_RUN_SIZE:
+                runs.append(_write_run(chunk, folder))
+                chunk = []
+        chunk.sort()
+        merged = heapq.merge(*[_read_run(path) for path in runs], chunk)
+
+        count = 0
+        last_pk = None
+        with open(pks_tmp, 'wb') as pks_file, open(names_tmp, 'w') as names_file:
+            pks_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, 0, time.time()))
+            block = array('q')
+            for pk, username in merged:
+                if pk == last_pk:  # pages can overlap
+                    continue
+                last_pk = pk
+                block.append(pk)
+                names_file.write(username + "\n")
+                count += 1
+                if len(block) >= SNAPSHOT_WRITE_BLOCK:
+                    block.tofile(pks_file)
+                    block = array('q')
+            block.tofile(pks_file)
+            pks_file.seek(0)
+            pks_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, count, time.time()))
+        os.replace(names_tmp, f"{base_path}.names")
+        os.replace(pks_tmp, f"{base_path}.pks")
+        return count
+    finally:
+        # the .tmp files are only still there when the walk or a write failed
+        for path in (*runs, pks_tmp, names_tmp):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def read_snapshot_header(base_path):
+    with open(f"{base_path}.pks", 'rb') as pks_file:
+        magic, version, count, taken_at = SNAPSHOT_HEADER.unpack(pks_file.read(SNAPSHOT_HEADER.size))
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Not a follower snapshot: {base_path}")
+    return {"count": count, "taken_at": datetime.fromtimestamp(taken_at).isoformat()}
+
+
+def iter_snapshot_pks(base_path):
+    read_snapshot_header(base_path)
+    with open(f"{base_path}.pks", 'rb') as pks_file:
+        if os.fstat(pks_file.fileno()).st_size == SNAPSHOT_HEADER.size:
+            return
+        with mmap.mmap(pks_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pks = memoryview(mapped)[SNAPSHOT_HEADER.size:].cast('q')
+            try:
+                yield from pks
+            finally:
+                pks.release()
+
+
+def iter_snapshot(base_path):
+    with open(f"{base_path}.names") as names_file:
+        for pk, line in zip(iter_snapshot_pks(base_path), names_file):
+            yield pk, line.rstrip("\n")
+
+
+def diff_snapshots(old_base_path, new_base_path):
+    # yields ("new" | "lost", pk, username) with one pass over each snapshot
+    old = iter_snapshot(old_base_path)
+    new = iter_snapshot(new_base_path)
+    old_item = next(old, None)
+    new_item = next(new, None)
+    while old_item is not None or new_item is not None:
+        if new_item is None or (old_item is not None and old_item[0] < new_item[0]):
+            yield "lost", old_item[0], old_item[1]
+            old_item = next(old, None)
+        elif old_item is None or new_item[0] < old_item[0]:
+            yield "new", new_item[0], new_item[1]
+            new_item = next(new, None)
+        else:
+            old_item = next(old, None)
+            new_item = next(new, None)
+
+
+def save_followers_snapshot(token, time_interval, user_id=None):
+    try:
+        api = get_api_from_token(token)
+        user_id = user_id or api.authenticated_user_id
+        base_path = snapshot_base_path(api.authenticated_user_id, user_id, time_interval)
+        count = write_snapshot(iter_followers(api, user_id), base_path)
+        print(f"Saved snapshot as '{base_path}' ({count} followers)")
+        return base_path
+    except Exception as e:
+        print(f"Error saving followers snapshot: {e}")
+
+
+def compare_followers(snapshot1_path, snapshot2_path):
+    try:
+        new_followers = []
+        lost_followers = []
+        for change, pk, username in diff_snapshots(snapshot1_path, snapshot2_path):
+            (new_followers if change == "new" else lost_followers).append(username)
+
+        return {
+            'new_followers': new_followers,
+            'lost_followers': lost_followers
+        }
+    except Exception as e:
+        print(f"Error comparing snapshots: {e}")
+        return {}
+
+
+# -----------------------Audience overlap-----------------------
+# /audience/overlap compares the followers of several accounts through their
+# snapshots (sorted, unique int64 pks). Each target reuses the newest
+# snapshot younger than max_age that the caller's own account took,
+# including ones taken by its scheduled jobs, and only missing targets are
+# walked upstream. The set algebra runs in C: a set
+# is built from the smaller pk array of a pair and intersected with the
+# larger array directly, so one set is in memory at a time. Results are
+# cached per caller and combination of snapshots, which never change once
+# written. The snapshots are shared on disk, the result cache is per worker.
+AUDIENCE_MAX_TARGETS = int(os.environ.get("AUDIENCE_MAX_TARGETS", "10"))
+AUDIENCE_SNAPSHOT_MAX_AGE = int(os.environ.get("AUDIENCE_SNAPSHOT_MAX_AGE", "86400"))  # seconds
+AUDIENCE_MUTUALS_LIMIT = int(os.environ.get("AUDIENCE_MUTUALS_LIMIT", "1000"))
+AUDIENCE_CACHE_SIZE = int(os.environ.get("AUDIENCE_CACHE_SIZE", "256"))
+
+audience_cache = OrderedDict()  # (caller pk, snapshot paths, mutuals_limit) -> result
+audience_lock = threading.Lock()
+audience_snapshot_locks = KeyedLocks()  # (caller pk, account id) -> lock while a walk runs
 
-    return jsonify({
-        "status": "success",
-        "message": f"Logged in as {username}",
-        "token": token,
-        "cookie_expiry": expiry_str
-    })
 
+def load_snapshot_pks(base_path):
+    read_snapshot_header(base_path)
+    pks = array('q')
+    with open(f"{base_path}.pks", 'rb') as pks_file:
+        pks_file.seek(SNAPSHOT_HEADER.size)
+        pks.frombytes(pks_file.read())
+    return pks
 
-# -----------------------Set up private API and Avoid re-login----------------------
 
+def latest_snapshot(owner_id, account_id, max_age):
+    # only snapshots owner_id's own sessions took
+    folder = os.path.join(SNAPSHOT_FOLDER, str(owner_id), str(account_id))
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return None
+    newest = None
+    for name in names:
+        if not (name.startswith("followers_") and name.endswith(".pks")):
+            continue
+        base_path = os.path.join(folder, name[:-len(".pks")])
+        try:
+            taken_at = datetime.fromisoformat(read_snapshot_header(base_path)["taken_at"]).timestamp()
+        except (OSError, ValueError):
+            continue
+        if time.time() - taken_at <= max_age and (newest is None or taken_at > newest[0]):
+            newest = (taken_at, base_path)
+    return newest[1] if newest else None
 
-# -----------------------UTILITY: Get API from token-----------------------
-def get_api_from_token(token):
-    settings_file = os.path.join(SESSION_FOLDER, f"settings_{token}.json")
-    if not os.path.isfile(settings_file):
-        raise Exception("Invalid or expired token")
 
-    with open(settings_file) as file_data:
-        cached_settings = json.load(file_data, object_hook=from_json)
+def audience_snapshot(api, account_id, max_age):
+    # one walk per caller and account at a time, concurrent requests wait
+    # and reuse it
+    owner_id = api.authenticated_user_id
+    with audience_snapshot_locks.hold((owner_id, account_id)):
+        base_path = latest_snapshot(owner_id, account_id, max_age)
+        if base_path is None:
+            label = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}_audience"
+            base_path = snapshot_base_path(owner_id, account_id, label)
+            write_snapshot(iter_followers(api, account_id), base_path)
+        return base_path
 
-    # username = cached_settings.get('username_id')  # optional log
-    # device_id = cached_settings.get('device_id')
 
-    api = Client(
-        None, None,  # username/password not needed
-        settings=cached_settings
-    )
-    return api
+def snapshot_usernames(base_path, pks, wanted):
+    # usernames for a sorted list of pks, one pass over the names file
+    indexes = {bisect.bisect_left(pks, pk) for pk in wanted}
+    found = []
+    with open(f"{base_path}.names") as names_file:
+        for index, line in enumerate(names_file):
+            if index in indexes:
+                found.append({"pk": pks[index], "username": line.rstrip("\n")})
+                if len(found) == len(indexes):
+                    break
+    return found
 
 
-# -----------------------Fetch Data Methods-------------------
-@app.route("/get_own_number_of_followers", methods=["POST"])
-def get_own_number_of_followers():
-    data = request.json
-    token = data.get("token", "")
+def audience_overlap(targets, mutuals_limit):
+    # targets: [(username, pk, snapshot base path)]
+    arrays = [load_snapshot_pks(base_path) for _, _, base_path in targets]
+    order = sorted(range(len(targets)), key=lambda i: len(arrays[i]))
+    pairs = {}
+    common_to_all = None
+    for position, i in enumerate(order):
+        smaller = set(arrays[i])
+        for j in order[position + 1:]:
+            common = len(smaller.intersection(arrays[j]))
+            union = len(arrays[i]) + len(arrays[j]) - common
+            pairs[min(i, j), max(i, j)] = (common, union)
+        if position == 0:
+            # the smallest audience's set is done with its pairs, shrink it
+            # to the followers every target has in common
+            for j in order[1:]:
+                smaller.intersection_update(arrays[j])
+            common_to_all = smaller
+        del smaller
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
+    def follows(i, j):
+        # does target i follow target j, i.e. is i's pk among j's followers
+        index = bisect.bisect_left(arrays[j], targets[i][1])
+        return index < len(arrays[j]) and arrays[j][index] == targets[i][1]
 
-    try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        number_of_followers = user_info['user']['follower_count']
-        return jsonify({
-            "status": "success",
-            "follower_count": number_of_followers
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    smallest = order[0]
+    mutuals = snapshot_usernames(targets[smallest][2], arrays[smallest],
+                                 sorted(common_to_all)[:mutuals_limit]) if mutuals_limit else []
 
+    return {
+        "targets": [{"username": username, "pk": pk, "followers": len(arrays[i]),
+                     "snapshot_taken_at": read_snapshot_header(base_path)["taken_at"]}
+                    for i, (username, pk, base_path) in enumerate(targets)],
+        "pairs": [{"a": targets[i][0], "b": targets[j][0], "common": common, "union": union,
+                   "jaccard": round(common / union, 6) if union else 0.0,
+                   "a_follows_b": follows(i, j), "b_follows_a": follows(j, i)}
+                  for (i, j), (common, union) in sorted(pairs.items())],
+        "common_to_all": len(common_to_all),
+        "mutuals": mutuals
+    }
 
-@app.route("/get_number_of_followers", methods=["POST"])
-def get_number_of_followers():
+
+@bp.route("/audience/overlap", methods=["POST"])
+def audience_overlap_route():
     data = request.json
     token = data.get("token", "")
-    target_username = data.get("target_username", "")
+    target_usernames = data.get("target_usernames") or []
 
     if not token:
         return jsonify({"status": "error", "message": "Token required"}), 400
+    if not isinstance(target_usernames, list) or not all(
+            isinstance(username, str) and username.strip() for username in target_usernames):
+        return jsonify({"status": "error", "message": "target_usernames must be a list of usernames"}), 400
+    target_usernames = list(dict.fromkeys(normalize_username(username) for username in target_usernames))
+    if not 2 <= len(target_usernames) <= AUDIENCE_MAX_TARGETS:
+        return jsonify({"status": "error",
+                        "message": f"target_usernames must list 2 to {AUDIENCE_MAX_TARGETS} accounts"}), 400
+    try:
+        max_age = int(data.get("max_age", AUDIENCE_SNAPSHOT_MAX_AGE))
+        mutuals_limit = int(data.get("mutuals_limit", AUDIENCE_MUTUALS_LIMIT))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "max_age and mutuals_limit must be integers"}), 400
 
     try:
         api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        number_of_followers = user_info['user']['follower_count']
-        return jsonify({
-            "status": "success",
-            "follower_count": number_of_followers
-        })
+        targets = []
+        for target_username in target_usernames:
+            pk = int(resolve_user_pk(token, target_username))
+            targets.append((target_username, pk, audience_snapshot(api, pk, max_age)))
+
+        key = (api.authenticated_user_id, tuple(base_path for _, _, base_path in targets), mutuals_limit)
+        with audience_lock:
+            result = audience_cache.get(key)
+            if result is not None:
+                audience_cache.move_to_end(key)
+        cached = result is not None
+        if not cached:
+            result = audience_overlap(targets, mutuals_limit)
+            with audience_lock:
+                audience_cache[key] = result
+                while len(audience_cache) > AUDIENCE_CACHE_SIZE:
+                    audience_cache.popitem(last=False)
+        return jsonify({"status": "success", "cached": cached, **result})
     except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return error_response(e)
 
 
-@app.route("/get_own_number_of_following", methods=["POST"])
-def get_own_number_of_following():
-    data = request.json
-    token = data.get("token", "")
+# -----------------------Follower tracking jobs-----------------------
+# Periodic snapshot + diff jobs, persisted in SQLite so queued work and
+# schedules survive restarts. Every server worker runs a scheduler thread
+# and JOB_WORKERS runner threads; claims are atomic in the database, so
+# several workers (or nodes sharing JOBS_DB) never run the same job twice
+# and never run more than JOB_PER_ACCOUNT_CONCURRENCY jobs per token.
+# Each claim takes a lease with its own owner id; a runner whose lease ran
+# out and was requeued (or failed, after JOB_MAX_ATTEMPTS) can no longer
+# finish or retry the job.
+JOBS_DB = os.environ.get("JOBS_DB", "jobs.db")
+JOBS_ENABLED = os.environ.get("JOBS_ENABLED", "1") == "1"
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_PER_ACCOUNT_CONCURRENCY = int(os.environ.get("JOB_PER_ACCOUNT_CONCURRENCY", "1"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "5"))  # seconds
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "21600"))  # running jobs past this are requeued
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_MIN_INTERVAL = int(os.environ.get("JOB_MIN_INTERVAL", "300"))
+# In cluster mode each node numbers its jobs and schedules from its own base,
+# so a token's rows keep their ids when they are handed to another node.
+JOB_ID_SPAN = 2 ** 32
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
 
-    try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        number_of_following = user_info['user']['following_count']
-        return jsonify({
-            "status": "success",
-            "following_count": number_of_following
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+def job_id_base():
+    return ring_hash(CLUSTER_SELF) % 2 ** 20 * JOB_ID_SPAN if CLUSTER_SELF else 0
 
 
-@app.route("/get_number_of_following", methods=["POST"])
-def get_number_of_following():
-    data = request.json
-    token = data.get("token", "")
-    target_username = data.get("target_username", "")
+def job_snapshot_files(jobs):
+    # the snapshot and diff files a token's jobs point at
+    paths = set()
+    for job in jobs:
+        for base_path in (job["snapshot_path"], job["previous_path"]):
+            if base_path:
+                paths.update((f"{base_path}.pks", f"{base_path}.names"))
+        if job["diff_path"]:
+            paths.add(job["diff_path"])
+    return sorted(path for path in paths if os.path.exists(path))
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
 
-    try:
-        api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        number_of_following = user_info['user']['following_count']
-        return jsonify({
-            "status": "success",
-            "following_count": number_of_following
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+class JobQueue:
+    def __init__(self, path=JOBS_DB, id_base=None):
+        self.path = path
+        self.id_base = job_id_base() if id_base is None else id_base
+        self._pool = SQLitePool(path, self._setup, isolation_level=None)
 
+    @staticmethod
+    def _setup(conn):
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS schedules ("
+            " id INTEGER PRIMARY KEY, token TEXT NOT NULL, user_id TEXT,"
+            " interval_seconds INTEGER NOT NULL, jitter_seconds INTEGER NOT NULL,"
+            " next_run_at REAL NOT NULL, active INTEGER NOT NULL DEFAULT 1);"
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY, schedule_id INTEGER, token TEXT NOT NULL, user_id TEXT,"
+            " status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, run_at REAL NOT NULL,"
+            " created_at REAL NOT NULL, started_at REAL, finished_at REAL, lease_until REAL,"
+            " snapshot_path TEXT, previous_path TEXT, diff_path TEXT, result TEXT, error TEXT,"
+            " lease_owner TEXT);"
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_at);"
+            "CREATE INDEX IF NOT EXISTS jobs_token ON jobs (token, status);")
+        if "lease_owner" not in [column["name"] for column in conn.execute("PRAGMA table_info(jobs)")]:
+            try:
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_owner TEXT")
+            except sqlite3.OperationalError:  # another worker added it first
+                pass
 
-@app.route("/get_own_followers", methods=["POST"])
-def get_own_followers():
-    data = request.json
-    token = data.get("token", "")
+    def _next_id(self, table):
+        # one statement with the INSERT, so two writers never pick the same id
+        return (f"(SELECT COALESCE(MAX(id), {self.id_base}) + 1 FROM {table}"
+                f" WHERE id BETWEEN {self.id_base} AND {self.id_base + JOB_ID_SPAN - 1})")
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
+    def enqueue(self, token, user_id=None, schedule_id=None, run_at=None):
+        now = time.time()
+        with self._pool.connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (id, schedule_id, token, user_id, status, run_at, created_at)"
+                f" VALUES ({self._next_id('jobs')}, ?, ?, ?, 'queued', ?, ?)",
+                (schedule_id, token, user_id, run_at or now, now))
+        return cursor.lastrowid
 
-    try:
-        api = get_api_from_token(token)
-        followers = []
-        results = api.followers(api.authenticated_user_id)
-        for user in results.get('users', []):
-            followers.append(user['username'])
-        return jsonify({
-            "status": "success",
-            "followers": followers
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    def schedule(self, token, user_id, interval_seconds, jitter_seconds):
+        with self._pool.connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO schedules (id, token, user_id, interval_seconds, jitter_seconds, next_run_at)"
+                f" VALUES ({self._next_id('schedules')}, ?, ?, ?, ?, ?)",
+                (token, user_id, interval_seconds, jitter_seconds,
+                 time.time() + random.uniform(0, jitter_seconds)))
+        return cursor.lastrowid
 
+    def unschedule(self, token, schedule_id):
+        with self._pool.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE schedules SET active = 0 WHERE id = ? AND token = ?", (schedule_id, token))
+        return cursor.rowcount > 0
 
-@app.route("/get_followers", methods=["POST"])
-def get_followers():
-    data = request.json
-    token = data.get("token", "")
-    target_username = data.get("target_username", "")
+    def enqueue_due(self):
+        # the conditional UPDATE makes sure only one scheduler enqueues a run
+        now = time.time()
+        with self._pool.connection() as conn:
+            due = conn.execute(
+                "SELECT * FROM schedules WHERE active = 1 AND next_run_at <= ?", (now,)).fetchall()
+            claimed = []
+            for schedule in due:
+                next_run_at = now + schedule["interval_seconds"] + random.uniform(0, schedule["jitter_seconds"])
+                if conn.execute(
+                        "UPDATE schedules SET next_run_at = ? WHERE id = ? AND next_run_at = ?",
+                        (next_run_at, schedule["id"], schedule["next_run_at"])).rowcount:
+                    claimed.append(schedule)
+            # jobs whose runner died: fail the ones out of attempts, requeue the rest
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', lease_until = NULL, lease_owner = NULL, finished_at = ?,"
+                " error = 'Lease expired' WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, JOB_MAX_ATTEMPTS))
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL, lease_owner = NULL"
+                " WHERE status = 'running' AND lease_until < ?", (now,))
+        for schedule in claimed:
+            self.enqueue(schedule["token"], schedule["user_id"], schedule["id"])
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
+    def claim(self):
+        # returns the job as claimed: attempts counts this run, and
+        # lease_owner is what finish and retry_or_fail check against
+        now = time.time()
+        owner = uuid.uuid4().hex
+        with self._pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                job = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' AND run_at <= ? AND"
+                    " (SELECT COUNT(*) FROM jobs AS running WHERE running.token = jobs.token"
+                    "  AND running.status = 'running') < ?"
+                    " ORDER BY run_at LIMIT 1", (now, JOB_PER_ACCOUNT_CONCURRENCY)).fetchone()
+                if job is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1,"
+                        " started_at = ?, lease_until = ?, lease_owner = ? WHERE id = ?",
+                        (now, now + JOB_LEASE_SECONDS, owner, job["id"]))
+                    job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job["id"],)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return job
 
-    try:
-        api = get_api_from_token(token)
-        target_user = api.username_info(target_username)
-        target_user_id = target_user['user']['pk']
+    def finish(self, job, **fields):
+        # False when the lease was lost and the job is someone else's now
+        fields["finished_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._pool.connection() as conn:
+            return conn.execute(
+                f"UPDATE jobs SET {assignments}, lease_until = NULL, lease_owner = NULL"
+                " WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                (*fields.values(), job["id"], job["lease_owner"])).rowcount > 0
 
-        followers = []
-        results = api.followers(target_user_id)
-        for user in results.get('users', []):
-            followers.append(user['username'])
+    def retry_or_fail(self, job, error):
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            return self.finish(job, status="failed", error=error)
+        # back off 1, 2, 4... minutes before the next attempt
+        with self._pool.connection() as conn:
+            return conn.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL, lease_owner = NULL, error = ?, run_at = ?"
+                " WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                (error, time.time() + 60 * 2 ** (job["attempts"] - 1), job["id"], job["lease_owner"])).rowcount > 0
 
-        return jsonify({
-            "status": "success",
-            "followers": followers
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    def get(self, token, job_id):
+        with self._pool.connection() as conn:
+            return conn.execute(
+                "SELECT * FROM jobs WHERE id = ? AND token = ?", (job_id, token)).fetchone()
 
+    def previous_snapshot(self, token, user_id, job_id):
+        with self._pool.connection() as conn:
+            row = conn.execute(
+                "SELECT snapshot_path FROM jobs WHERE token = ? AND user_id IS ? AND status = 'done'"
+                " AND id != ? ORDER BY finished_at DESC LIMIT 1", (token, user_id, job_id)).fetchone()
+        return row["snapshot_path"] if row else None
 
-@app.route("/get_own_bio", methods=["POST"])
-def get_own_bio():
-    data = request.json
-    token = data.get("token", "")
+    def tokens(self):
+        with self._pool.connection() as conn:
+            return [row["token"] for row in conn.execute("SELECT token FROM schedules UNION SELECT token FROM jobs")]
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
+    def export(self, token):
+        # everything of one token, for a cluster handoff
+        with self._pool.connection() as conn:
+            return {
+                "token": token,
+                "schedules": [dict(row) for row in conn.execute("SELECT * FROM schedules WHERE token = ?", (token,))],
+                "jobs": [dict(row) for row in conn.execute("SELECT * FROM jobs WHERE token = ?", (token,))]
+            }
 
-    try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        bio = user_info['user']['biography']
-        return jsonify({
-            "status": "success",
-            "bio": bio
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    def drop(self, entry):
+        # only the exported rows: anything added since stays
+        with self._pool.connection() as conn:
+            conn.executemany("DELETE FROM schedules WHERE id = ? AND token = ?",
+                             [(schedule["id"], entry["token"]) for schedule in entry["schedules"]])
+            conn.executemany("DELETE FROM jobs WHERE id = ? AND token = ?",
+                             [(job["id"], entry["token"]) for job in entry["jobs"]])
 
+    def receive(self, entry):
+        # A job that was running on the old node starts over here; the old
+        # runner's lease went with the old row. Receiving the same entry
+        # twice (a handoff retried after a lost answer) changes nothing.
+        with self._pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                schedule_ids = {schedule["id"]: self._insert(conn, "schedules", entry["token"], schedule)
+                                for schedule in entry["schedules"]}
+                for job in entry["jobs"]:
+                    job = dict(job, schedule_id=schedule_ids.get(job["schedule_id"], job["schedule_id"]))
+                    if job["status"] == "running":
+                        job.update(status="queued", lease_until=None, lease_owner=None)
+                    self._insert(conn, "jobs", entry["token"], job)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
 
-@app.route("/get_bio", methods=["POST"])
-def get_bio():
-    data = request.json
-    token = data.get("token", "")
-    target_username = data.get("target_username", "")
+    @staticmethod
+    def _insert(conn, table, token, row):
+        columns = [column["name"] for column in conn.execute(f"PRAGMA table_info({table})")]
+        row = {name: row[name] for name in columns if name in row}
+        row["token"] = token
+        existing = conn.execute(f"SELECT token FROM {table} WHERE id = ?", (row["id"],)).fetchone()
+        if existing is not None and existing["token"] == token:
+            return row["id"]
+        if existing is not None:
+            # ids from before the per-node bases can clash, that row gets a new one
+            del row["id"]
+        cursor = conn.execute(f"INSERT INTO {table} ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                              tuple(row.values()))
+        return cursor.lastrowid
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        bio = user_info['user']['biography']
-        return jsonify({
-            "status": "success",
-            "bio": bio
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
 
+def run_snapshot_job(job):
+    api = get_api_from_token(job["token"])
+    user_id = job["user_id"] or api.authenticated_user_id
+    label = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}_{job['id']}"
+    base_path = snapshot_base_path(api.authenticated_user_id, user_id, label)
+    count = write_snapshot(iter_followers(api, user_id), base_path)
+    result = {"count": count, "new": 0, "lost": 0}
 
-@app.route("/get_own_post_count", methods=["POST"])
-def get_own_post_count():
-    data = request.json
-    token = data.get("token", "")
+    previous_path = job_queue.previous_snapshot(job["token"], job["user_id"], job["id"])
+    diff_path = None
+    if previous_path and os.path.exists(f"{previous_path}.pks"):
+        diff_path = f"{base_path}.diff.ndjson"
+        with open(diff_path, 'w') as diff_file:
+            for change, pk, username in diff_snapshots(previous_path, base_path):
+                result[change] += 1
+                diff_file.write(json.dumps({"change": change, "pk": pk, "username": username}) + "\n")
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        post_count = user_info['user']['media_count']
-        return jsonify({
-            "status": "success",
-            "post_count": post_count
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    if not job_queue.finish(job, status="done", snapshot_path=base_path, previous_path=previous_path,
+                            diff_path=diff_path, result=json.dumps(result), error=None):
+        print(f"Job {job['id']} lost its lease, result not recorded")
 
 
-@app.route("/get_post_count", methods=["POST"])
-def get_post_count():
-    data = request.json
-    token = data.get("token", "")
-    target_username = data.get("target_username", "")
+def job_runner(stop):
+    while not stop.is_set():
+        try:
+            job = job_queue.claim()
+        except Exception as e:
+            print(f"Error claiming job: {e}")
+            job = None
+        if job is None:
+            stop.wait(JOB_POLL_INTERVAL)
+            continue
+        try:
+            run_snapshot_job(job)
+        except Exception as e:
+            print(f"Error running job {job['id']}: {e}")
+            job_queue.retry_or_fail(job, str(e))
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        post_count = user_info['user']['media_count']
-        return jsonify({
-            "status": "success",
-            "post_count": post_count
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
 
+def job_scheduler(stop):
+    while not stop.is_set():
+        try:
+            job_queue.enqueue_due()
+        except Exception as e:
+            print(f"Error scheduling jobs: {e}")
+        stop.wait(JOB_POLL_INTERVAL)
 
-@app.route("/get_own_profile_pic_url", methods=["POST"])
-def get_own_profile_pic_url():
-    data = request.json
-    token = data.get("token", "")
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        profile_pic_url = user_info['user']['profile_pic_url']
-        return jsonify({
-            "status": "success",
-            "profile_pic_url": profile_pic_url
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+job_queue = None
+job_threads_stop = threading.Event()
 
 
-@app.route("/get_profile_pic_url", methods=["POST"])
-def get_profile_pic_url():
-    data = request.json
-    token = data.get("token", "")
-    target_username = data.get("target_username", "")
+def start_background_workers():
+    global job_queue
+    threading.Thread(target=username_index_flusher, args=(job_threads_stop,), name="username-index-flush",
+                     daemon=True).start()
+    threading.Thread(target=metrics_writer, args=(job_threads_stop,), name="metrics-writer", daemon=True).start()
+    if SESSION_MAINTAINER_ENABLED:
+        threading.Thread(target=session_maintainer.run, args=(job_threads_stop,), name="session-maintainer",
+                         daemon=True).start()
+    if cluster.enabled:
+        threading.Thread(target=cluster.run, args=(job_threads_stop,), name="cluster-sync", daemon=True).start()
+    if not JOBS_ENABLED:
+        return
+    job_queue = JobQueue()
+    threading.Thread(target=job_scheduler, args=(job_threads_stop,), name="job-scheduler", daemon=True).start()
+    for index in range(JOB_WORKERS):
+        threading.Thread(target=job_runner, args=(job_threads_stop,), name=f"job-runner-{index}",
+                         daemon=True).start()
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        profile_pic_url = user_info['user']['profile_pic_url']
-        return jsonify({
-            "status": "success",
-            "profile_pic_url": profile_pic_url
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
 
+def job_to_dict(job):
+    return {
+        "job_id": job["id"],
+        "schedule_id": job["schedule_id"],
+        "user_id": job["user_id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "created_at": datetime.fromtimestamp(job["created_at"]).isoformat(),
+        "finished_at": datetime.fromtimestamp(job["finished_at"]).isoformat() if job["finished_at"] else None,
+        "result": json.loads(job["result"]) if job["result"] else None,
+        "error": job["error"]
+    }
 
-@app.route("/get_own_verified", methods=["POST"])
-def get_own_verified():
-    data = request.json
-    token = data.get("token", "")
 
-    if not token:
-        return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        verified = user_info['user']['is_verified']
-        return jsonify({
-            "status": "success",
-            "verified": verified
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+def job_request_target(data, token):
+    # None for the caller's own account; ValueError when it is not a username
+    target_username = data.get("target_username")
+    if target_username in (None, ""):
+        return None
+    return str(resolve_user_pk(token, target_username))
 
 
-@app.route("/get_verified", methods=["POST"])
-def get_verified():
+@bp.route("/jobs/enqueue", methods=["POST"])
+def enqueue_job():
     data = request.json
     token = data.get("token", "")
-    target_username = data.get("target_username", "")
 
     if not token:
         return jsonify({"status": "error", "message": "Token required"}), 400
+    if job_queue is None:
+        return jsonify({"status": "error", "message": "Background jobs are disabled"}), 503
+
     try:
-        api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        verified = user_info['user']['is_verified']
-        return jsonify({
-            "status": "success",
-            "verified": verified
-        })
+        get_api_from_token(token)
+        try:
+            user_id = job_request_target(data, token)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        job_id = job_queue.enqueue(token, user_id)
+        return jsonify({"status": "success", "job_id": job_id})
     except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return error_response(e)
 
 
-@app.route("/get_own_private", methods=["POST"])
-def get_own_private():
+@bp.route("/jobs/schedule", methods=["POST"])
+def schedule_job():
     data = request.json
     token = data.get("token", "")
 
     if not token:
         return jsonify({"status": "error", "message": "Token required"}), 400
+    if job_queue is None:
+        return jsonify({"status": "error", "message": "Background jobs are disabled"}), 503
     try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        private = user_info['user']['is_private']
-        return jsonify({
-            "status": "success",
-            "private": private
-        })
+        interval_seconds = int(data.get("interval_seconds") or 86400)
+        jitter_seconds = int(data.get("jitter_seconds") or interval_seconds // 10)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if interval_seconds < JOB_MIN_INTERVAL:
+        return jsonify({"status": "error", "message": f"interval_seconds must be at least {JOB_MIN_INTERVAL}"}), 400
+
+    try:
+        get_api_from_token(token)
+        try:
+            user_id = job_request_target(data, token)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        schedule_id = job_queue.schedule(token, user_id, interval_seconds, jitter_seconds)
+        return jsonify({"status": "success", "schedule_id": schedule_id})
     except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return error_response(e)
 
 
-@app.route("/get_private", methods=["POST"])
-def get_private():
+@bp.route("/jobs/unschedule", methods=["POST"])
+def unschedule_job():
     data = request.json
     token = data.get("token", "")
-    target_username = data.get("target_username", "")
 
     if not token:
         return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        private = user_info['user']['is_private']
-        return jsonify({
-            "status": "success",
-            "private": private
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    if job_queue is None:
+        return jsonify({"status": "error", "message": "Background jobs are disabled"}), 503
 
+    if not job_queue.unschedule(token, data.get("schedule_id")):
+        return jsonify({"status": "error", "message": "Schedule not found"}), 404
+    return jsonify({"status": "success"})
 
-@app.route("/get_own_full_name", methods=["POST"])
-def get_own_full_name():
+
+@bp.route("/jobs/status", methods=["POST"])
+def job_status():
     data = request.json
     token = data.get("token", "")
 
     if not token:
         return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.current_user()
-        full_name = user_info['user']['full_name']
-        return jsonify({
-            "status": "success",
-            "full_name": full_name
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    if job_queue is None:
+        return jsonify({"status": "error", "message": "Background jobs are disabled"}), 503
 
+    job = job_queue.get(token, data.get("job_id"))
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "success", "job": job_to_dict(job)})
 
-@app.route("/get_full_name", methods=["POST"])
-def get_full_name():
+
+@bp.route("/jobs/diff", methods=["POST"])
+def job_diff():
     data = request.json
     token = data.get("token", "")
-    target_username = data.get("target_username", "")
 
     if not token:
         return jsonify({"status": "error", "message": "Token required"}), 400
-    try:
-        api = get_api_from_token(token)
-        user_info = api.username_info(target_username)
-        full_name = user_info['user']['full_name']
-        return jsonify({
-            "status": "success",
-            "full_name": full_name
-        })
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    if job_queue is None:
+        return jsonify({"status": "error", "message": "Background jobs are disabled"}), 503
 
+    job = job_queue.get(token, data.get("job_id"))
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    if job["status"] != "done":
+        return jsonify({"status": "error", "message": f"Job is {job['status']}"}), 409
+    if not job["diff_path"]:
+        return jsonify({"status": "error", "message": "No earlier snapshot to diff against"}), 404
 
-# -----------------------Fetch Data Methods-------------------
+    def generate():
+        with open(job["diff_path"]) as diff_file:
+            yield from diff_file
 
+    # {"change": "new" | "lost", "pk", "username"} per line
+    return Response(generate(), mimetype="application/x-ndjson")
 
-def download_profile_picture(url, filename='profile_pic.jpg'):
-    try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
-            print(f"Profile picture saved as '{filename}'")
-        else:
-            print(f"Failed to download image. Status code: {response.status_code}")
-    except Exception as e:
-        print(f"Error downloading profile picture: {e}")
 
+@bp.route("/metrics", methods=["GET"])
+def metrics():
+    # the whole node: every server worker's numbers added up
+    collected = collect_metrics()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render(collected["metrics"].get(metric.name, [])))
+    gauge_names = dict.fromkeys(name for gauges in collected["gauges"].values() for name in gauges)
+    for name in gauge_names:
+        lines.append(f"# TYPE {name} gauge")
+        for pid, gauges in sorted(collected["gauges"].items()):
+            if name in gauges:
+                lines.append(f'{name}{{pid="{pid}"}} {gauges[name]}')
+    classes = collected["rate_governor"]
+    for name, documentation in RATE_GOVERNOR_METRICS.items():
+        lines.append(f"# HELP igapi_rate_governor_{name} {documentation}")
+        lines.append(f"# TYPE igapi_rate_governor_{name} counter")
+        for endpoint_class, values in classes.items():
+            lines.append(f'igapi_rate_governor_{name}{{class="{endpoint_class}"}} {values.get(name, 0)}')
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
 
-def save_followers_snapshot(time_interval):
-    try:
-        followers = get_own_followers()
-        data = {
-            'timestamp': datetime.now().isoformat(),
-            'followers': followers
-        }
-        filename = f"followers_{time_interval}.json"
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=2)
-        print(f"Saved snapshot as '{filename}'")
-    except Exception as e:
-        print(f"Error saving followers snapshot: {e}")
 
+# -----------------------App factory-----------------------
+def init_worker_state():
+    # Called in every server worker after fork (see gunicorn.conf.py) so no
+    # worker inherits pools, locks or executor threads from its parent.
+    # Sessions stay shared through the session store; the pool notices other
+    # workers' writes through the store version. Rate buckets, the username
+    # index, jobs, snapshots and media are shared on disk too. What is reset
+    # here stays per worker: the response and audience caches, the username
+    # hot tier, batch limiters and the /stats counters.
+    global session_store, session_pool, session_maintainer, response_cache, rate_governor, login_manager
+    global batch_executor, token_limiters, token_limiters_lock
+    global media_session, media_transport, media_executor, media_index, media_lock, transport, transport_lock
+    global username_index, username_index_lock, audience_cache, audience_lock, audience_snapshot_locks
+    global timeline_executor, timeline_lock, cluster
+    session_store = create_session_store()
+    session_pool = SessionPool()
+    cluster = Cluster()
+    session_maintainer = SessionMaintainer()
+    response_cache = ResponseCache()
+    rate_governor = RateGovernor()
+    login_manager = LoginManager()
+    batch_executor = None
+    token_limiters = OrderedDict()
+    token_limiters_lock = threading.Lock()
+    media_session = None
+    media_transport = None
+    media_executor = None
+    media_index = None
+    media_lock = threading.Lock()
+    username_index = None
+    username_index_lock = threading.Lock()
+    audience_cache = OrderedDict()
+    audience_lock = threading.Lock()
+    audience_snapshot_locks = KeyedLocks()
+    timeline_executor = None
+    timeline_lock = threading.Lock()
+    transport = None
+    transport_lock = threading.Lock()
 
-def compare_followers(snapshot1_path, snapshot2_path):
-    try:
-        with open(snapshot1_path) as f1, open(snapshot2_path) as f2:
-            data1 = json.load(f1)
-            data2 = json.load(f2)
 
-        followers1 = set(data1['followers'])
-        followers2 = set(data2['followers'])
+def create_app():
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app) if USE_ORJSON else TimedJSONProvider(app)
+    app.register_blueprint(bp)
+    return app
 
-        new_followers = followers2 - followers1
-        lost_followers = followers1 - followers2
 
-        return {
-            'new_followers': list(new_followers),
-            'lost_followers': list(lost_followers)
-        }
-    except Exception as e:
-        print(f"Error comparing snapshots: {e}")
-        return {}
+def __getattr__(name):
+    # "main:app" still works for servers and scripts, but the app is only
+    # built when asked for, so importing main (gunicorn builds its own app
+    # through create_app()) does not pay for registering every route twice
+    global app
+    if name == "app":
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    start_background_workers()
+    # development server only, production runs: gunicorn -c gunicorn.conf.py "main:create_app()"
+    create_app().run(host='0.0.0.0', port=5000)
@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def worker_state(tmp_path, monkeypatch):
+    # every store, index and database path is relative, so each test gets
+    # its own directory and a fresh set of the per-worker objects
+    monkeypatch.chdir(tmp_path)
+    main.init_worker_state()
+    yield
+    main.init_worker_state()
+
+
+@pytest.fixture
+def client():
+    return main.create_app().test_client()
+
+
+def users(*pks):
+    return [{"pk": pk, "username": f"user_{pk}"} for pk in pks]
+
+
+def profile(username):
+    return {"pk": 5, "username": username, "follower_count": 10, "following_count": 2, "biography": "bio",
+            "media_count": 3, "profile_pic_url": "https://x.cdninstagram.com/p.jpg", "is_verified": False,
+            "is_private": False, "full_name": username.title()}
+
+
+class FakeAPI:
+    # stands in for an instagram_private_api client. followers and following
+    # map an account pk to its pks (one page) or to {max_id: (pks,
+    # next_max_id)} pages; feed holds timeline pages the same way, negative
+    # pks being ads. Every upstream call is recorded in calls.
+    def __init__(self, owner_id=1, followers=None, following=None, feed=None):
+        self.authenticated_user_id = owner_id
+        self.followers = followers or {}
+        self.following = following or {}
+        self.feed = feed or {}
+        self.calls = []
+
+    def _friendships(self, table, user_id, max_id):
+        pages = table.get(user_id, [])
+        pks, next_max_id = pages[max_id] if isinstance(pages, dict) else (pages, None)
+        return {"users": users(*pks), "next_max_id": next_max_id}
+
+    def user_followers(self, user_id, rank_token, max_id=None):
+        self.calls.append(("user_followers", user_id, rank_token, max_id))
+        return self._friendships(self.followers, user_id, max_id)
+
+    def user_following(self, user_id, rank_token, max_id=None):
+        self.calls.append(("user_following", user_id, rank_token, max_id))
+        return self._friendships(self.following, user_id, max_id)
+
+    def feed_timeline(self, max_id=None):
+        self.calls.append(("feed_timeline", max_id))
+        pks, next_max_id = self.feed[max_id]
+        items = [{"media_or_ad": {"pk": pk, "injected": pk < 0}} for pk in pks]
+        return {"feed_items": items, "next_max_id": next_max_id, "more_available": next_max_id is not None}
+
+    def username_info(self, username):
+        self.calls.append(("username_info", username))
+        return {"user": profile(username)}
+
+    def current_user(self):
+        self.calls.append(("current_user",))
+        return {"user": profile("me")}
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    # a FakeAPI that every token resolves to
+    api = FakeAPI()
+    monkeypatch.setattr(main, "get_api_from_token", lambda token: api)
+    return api
@@ -0,0 +1,43 @@
+import main
+from conftest import FakeAPI, users
+from main import audience_overlap, audience_snapshot, latest_snapshot, snapshot_base_path, write_snapshot
+
+
+def test_snapshots_are_only_reused_by_the_account_that_took_them():
+    write_snapshot(users(1, 2, 3), snapshot_base_path(100, 7, "a"))
+    assert latest_snapshot(100, 7, 3600) is not None
+    assert latest_snapshot(200, 7, 3600) is None
+
+
+def test_audience_walks_its_own_snapshot_for_another_caller():
+    # 100 can see the private account 7's followers, 200 cannot
+    insider = FakeAPI(100, {7: [1, 2, 3]})
+    outsider = FakeAPI(200, {})
+    insider_path = audience_snapshot(insider, 7, 3600)
+    outsider_path = audience_snapshot(outsider, 7, 3600)
+    assert insider_path != outsider_path
+    assert [call[1] for call in outsider.calls] == [7]
+    assert list(main.iter_snapshot(outsider_path)) == []
+
+    # the same caller reuses its own snapshot without walking again
+    assert audience_snapshot(insider, 7, 3600) == insider_path
+    assert [call[1] for call in insider.calls] == [7]
+
+
+def test_overlap_counts():
+    a = snapshot_base_path(1, 10, "a")
+    b = snapshot_base_path(1, 20, "b")
+    write_snapshot(users(20, 3, 4, 5), a)
+    write_snapshot(users(3, 4, 6), b)
+    result = audience_overlap([("a", 10, a), ("b", 20, b)], mutuals_limit=10)
+    assert result["common_to_all"] == 2
+    assert result["pairs"] == [{"a": "a", "b": "b", "common": 2, "union": 5, "jaccard": 0.4,
+                                "a_follows_b": False, "b_follows_a": True}]
+    assert result["mutuals"] == [{"pk": 3, "username": "user_3"}, {"pk": 4, "username": "user_4"}]
+
+
+def test_snapshot_locks_are_dropped_after_the_walk():
+    api = FakeAPI(100, {7: [1, 2], 8: [3]})
+    audience_snapshot(api, 7, 3600)
+    audience_snapshot(api, 8, 3600)
+    assert len(main.audience_snapshot_locks) == 0
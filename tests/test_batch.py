@@ -0,0 +1,99 @@
+import json
+import threading
+
+import pytest
+
+import main
+from main import token_limiter
+
+
+def test_idle_limiters_are_evicted_lru(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_LIMITERS_MAX_SIZE", 3)
+    for token in ("a", "b", "c"):
+        with token_limiter(token):
+            pass
+    with token_limiter("a"):
+        pass
+    with token_limiter("d"):
+        pass
+    assert list(main.token_limiters) == ["c", "a", "d"]
+
+
+def test_held_limiter_is_never_replaced(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_LIMITERS_MAX_SIZE", 1)
+    with token_limiter("busy") as held:
+        with token_limiter("other"):
+            pass
+        # both over the cap, but "busy" is in use and stays the same limiter
+        assert "busy" in main.token_limiters
+        with token_limiter("busy") as again:
+            assert again is held
+    assert len(main.token_limiters) <= 2
+
+
+def test_batch_respects_per_token_concurrency(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_PER_TOKEN_CONCURRENCY", 2)
+    lock = threading.Lock()
+    running = [0, 0]  # now, most at once
+
+    def fetch(token, target_username, fields):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        threading.Event().wait(0.01)
+        with lock:
+            running[0] -= 1
+        return {"target_username": target_username, "status": "success"}
+
+    monkeypatch.setattr(main, "fetch_profile_entry", fetch)
+    results = main.run_batch("token", [f"user_{i}" for i in range(10)], ["pk"])
+    assert [result["target_username"] for result in results] == [f"user_{i}" for i in range(10)]
+    assert running[1] <= 2
+    assert main.token_limiters["token"][1] == 0
+
+
+def test_closing_the_stream_cancels_the_rest(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_PER_TOKEN_CONCURRENCY", 2)
+    started = []
+
+    def fetch(token, target_username, fields):
+        started.append(target_username)
+        threading.Event().wait(0.01)
+        return {"target_username": target_username, "status": "success"}
+
+    monkeypatch.setattr(main, "fetch_profile_entry", fetch)
+    results = main.run_batch("token", [f"user_{i}" for i in range(100)], ["pk"])
+    assert next(results)["target_username"] == "user_0"
+    results.close()
+    main.get_batch_executor().shutdown(wait=True)
+    assert len(started) < 10
+    assert main.token_limiters["token"][1] == 0
+
+
+def test_batch_route_streams_one_json_document(client, monkeypatch):
+    monkeypatch.setattr(main, "get_api_from_token", lambda token: object())
+    monkeypatch.setattr(main, "fetch_profile_entry", lambda token, name, fields: {
+        "target_username": name, "status": "error" if name == "bad" else "success"})
+    response = client.post("/batch/profile", json={"token": "t", "target_usernames": ["a", "bad", "b"]})
+    assert response.is_streamed
+    body = json.loads(response.get_data())
+    assert body["status"] == "success"
+    assert body["failed"] == 1
+    assert [entry["target_username"] for entry in body["results"]] == ["a", "bad", "b"]
+
+
+def test_empty_batch_is_valid_json(client, monkeypatch):
+    monkeypatch.setattr(main, "get_api_from_token", lambda token: object())
+    response = client.post("/batch/profile", json={"token": "t", "target_usernames": []})
+    assert json.loads(response.get_data()) == {"results": [], "failed": 0, "status": "success"}
+
+
+def test_batch_calls_queue_behind_the_governor(tmp_path):
+    governor = main.RateGovernor({"profile": (20, 1, 1000, 1000)}, max_wait=0,
+                                 state=main.RateState(str(tmp_path / "rate.db")))
+    governor.acquire("account", "profile")
+    with pytest.raises(main.RateLimited):
+        governor.acquire("account", "profile")
+    with governor.patient(1):
+        governor.acquire("account", "profile")
+    assert governor.counters()["profile"]["queued"] == 1
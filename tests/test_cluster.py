@@ -0,0 +1,172 @@
+import hashlib
+import os
+
+import pytest
+
+import main
+from main import HashRing, shard_key
+
+NODES = ["http://node-a:5000", "http://node-b:5000", "http://node-c:5000"]
+
+
+def test_ring_spreads_keys_over_every_node():
+    ring = HashRing(NODES)
+    owners = [ring.owner(f"key{index}") for index in range(3000)]
+    for node in NODES:
+        assert 700 < owners.count(node) < 1300
+
+
+def test_ring_only_moves_keys_of_a_removed_node():
+    before = HashRing(NODES)
+    after = HashRing(NODES[:2])
+    for index in range(2000):
+        key = f"key{index}"
+        if before.owner(key) != NODES[2]:
+            assert after.owner(key) == before.owner(key)
+
+
+def test_empty_ring():
+    assert HashRing([]).owner("key") is None
+
+
+def test_shard_key():
+    assert shard_key("0123abcd.6f3a0c1e-0000-4000-8000-000000000000") == "0123abcd"
+
+
+@pytest.fixture
+def remote_token(monkeypatch):
+    monkeypatch.setattr(main, "CLUSTER_SELF", NODES[0])
+    monkeypatch.setattr(main, "CLUSTER_NODES", NODES)
+    monkeypatch.setattr(main, "CLUSTER_SECRET", "secret")
+    monkeypatch.setattr(main, "CLUSTER_ROUTING", "redirect")
+    monkeypatch.setattr(main, "cluster", main.Cluster())
+    return next(f"{index:016x}.x" for index in range(1000)
+                if main.cluster.owner(shard_key(f"{index:016x}.x")) != NODES[0])
+
+
+def test_requests_are_routed_to_the_owner(client, remote_token):
+    response = client.post("/profile", json={"token": remote_token})
+    assert response.status_code == 307
+    assert response.headers["Location"].startswith(main.cluster.owner(shard_key(remote_token)))
+
+
+def test_hop_header_without_the_secret_is_still_routed(client, remote_token):
+    response = client.post("/profile", json={"token": remote_token}, headers={"X-Cluster-Hop": "http://evil"})
+    assert response.status_code == 307
+    response = client.post("/profile", json={"token": remote_token},
+                           headers={"X-Cluster-Hop": "http://evil", "X-Cluster-Secret": "wrong"})
+    assert response.status_code == 307
+
+
+def test_forwarded_request_is_served_locally(client, remote_token):
+    response = client.post("/profile", json={"token": remote_token},
+                           headers={"X-Cluster-Hop": NODES[1], "X-Cluster-Secret": "secret"})
+    assert response.status_code != 307
+    assert response.get_json()["message"] == "Invalid or expired token"
+
+
+def test_handoff_moves_jobs_and_their_snapshots(monkeypatch, remote_token):
+    queue = main.JobQueue("jobs.db")
+    monkeypatch.setattr(main, "job_queue", queue)
+    job_id = queue.enqueue(remote_token)
+    job = queue.claim()
+    base_path = main.snapshot_base_path(1, 2, "a")
+    os.makedirs(os.path.dirname(base_path))
+    for suffix in (".pks", ".names"):
+        with open(base_path + suffix, 'w') as snapshot_file:
+            snapshot_file.write("data")
+    queue.finish(job, status="done", snapshot_path=base_path)
+    calls = []
+    monkeypatch.setattr(main.cluster, "send_file", lambda node, path: calls.append(("file", node, path)))
+    monkeypatch.setattr(main.cluster, "call", lambda node, method, path, payload=None, **kwargs: calls.append(
+        ("call", node, payload)))
+
+    main.cluster.handoff()
+
+    owner = main.cluster.owner(shard_key(remote_token))
+    assert calls[:2] == [("file", owner, base_path + ".names"), ("file", owner, base_path + ".pks")]
+    assert [job["id"] for job in calls[2][2]["jobs"][0]["jobs"]] == [job_id]
+    assert queue.tokens() == []
+    assert not os.path.exists(base_path + ".pks")
+
+
+def test_handoff_file_stays_inside_the_snapshot_folder(client, remote_token):
+    headers = {"X-Cluster-Secret": "secret"}
+    response = client.post("/cluster/handoff/file?path=../escaped", data=b"x", headers=headers)
+    assert response.status_code == 400
+    response = client.post("/cluster/handoff/file?path=1/2/followers_a.pks", data=b"snapshot", headers=headers)
+    assert response.status_code == 200
+    with open(os.path.join(main.SNAPSHOT_FOLDER, "1", "2", "followers_a.pks"), 'rb') as snapshot_file:
+        assert snapshot_file.read() == b"snapshot"
+
+
+class FakeResponse:
+    def __init__(self, status, data=b""):
+        self.status = status
+        self.data = data
+
+
+class FakeTransport:
+    def __init__(self, responses):
+        self.responses = responses
+        self.urls = []
+
+    def open(self, method, url, **kwargs):
+        self.urls.append(url)
+        return self.responses.get(url.split("/profile_pics/")[0], FakeResponse(404))
+
+
+PICTURE = b"picture bytes"
+PICTURE_SHA = hashlib.sha256(PICTURE).hexdigest()
+
+
+def test_missing_picture_is_copied_from_a_peer(client, monkeypatch, remote_token):
+    transport = FakeTransport({NODES[1]: FakeResponse(404), NODES[2]: FakeResponse(200, PICTURE)})
+    monkeypatch.setattr(main, "get_transport", lambda: transport)
+
+    response = client.get(f"/profile_pics/{PICTURE_SHA}")
+    assert response.status_code == 200
+    assert response.data == PICTURE
+    # kept, the next request is served locally
+    assert client.get(f"/profile_pics/{PICTURE_SHA}").status_code == 200
+    assert len(transport.urls) == 2
+
+
+def test_peer_copy_must_match_its_hash(client, monkeypatch, remote_token):
+    transport = FakeTransport({NODES[1]: FakeResponse(200, b"something else")})
+    monkeypatch.setattr(main, "get_transport", lambda: transport)
+    assert client.get(f"/profile_pics/{PICTURE_SHA}").status_code == 404
+    assert not os.path.exists(main.media_object_path(PICTURE_SHA))
+
+
+def test_peers_asking_for_a_picture_are_not_passed_on(client, monkeypatch, remote_token):
+    transport = FakeTransport({NODES[1]: FakeResponse(200, PICTURE)})
+    monkeypatch.setattr(main, "get_transport", lambda: transport)
+    response = client.get(f"/profile_pics/{PICTURE_SHA}",
+                          headers={"X-Cluster-Hop": NODES[1], "X-Cluster-Secret": "secret"})
+    assert response.status_code == 404
+    assert transport.urls == []
+
+
+def test_handoff_runs_once_per_view_change(monkeypatch, remote_token):
+    monkeypatch.setattr(main, "CLUSTER_HANDOFF_FILE", "cluster.json.handoff")
+    monkeypatch.setattr(main, "CLUSTER_STATE_FILE", "cluster.json")
+    runs = []
+    monkeypatch.setattr(main.cluster, "handoff", lambda: runs.append(main.cluster.epoch))
+
+    main.cluster.handoff_if_changed()
+    main.cluster.handoff_if_changed()
+    assert runs == [0]
+    main.cluster.adopt({"epoch": 1, "nodes": NODES[:2]})
+    main.cluster.handoff_if_changed()
+    main.cluster.handoff_if_changed()
+    assert runs == [0, 1]
+
+
+def test_handoff_is_left_to_the_leader(monkeypatch, remote_token):
+    monkeypatch.setattr(main, "CLUSTER_HANDOFF_FILE", "cluster.json.handoff")
+    monkeypatch.setattr(main.session_maintainer, "lead", lambda: False)
+    runs = []
+    monkeypatch.setattr(main.cluster, "handoff", lambda: runs.append(main.cluster.epoch))
+    main.cluster.handoff_if_changed()
+    assert runs == []
@@ -0,0 +1,76 @@
+import gzip
+import json
+import zlib
+from datetime import datetime
+
+import pytest
+from flask import Response
+
+import main
+from main import FastJSONProvider, compress_response, ndjson_line
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BIG = {"users": [{"pk": pk, "username": f"user_{pk}"} for pk in range(200)]}
+
+
+@pytest.fixture
+def app():
+    return main.create_app()
+
+
+def compress(app, response, encoding):
+    with app.test_request_context(headers={"Accept-Encoding": encoding}):
+        return compress_response(response)
+
+
+def test_large_bodies_are_gzipped(app):
+    with app.app_context():
+        response = compress(app, main.jsonify(BIG), "gzip")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert json.loads(gzip.decompress(response.get_data())) == BIG
+
+
+@pytest.mark.skipif(brotli is None, reason="brotli not installed")
+def test_brotli_is_preferred(app):
+    with app.app_context():
+        response = compress(app, main.jsonify(BIG), "gzip, br")
+    assert response.headers["Content-Encoding"] == "br"
+    assert json.loads(brotli.decompress(response.get_data())) == BIG
+
+
+def test_small_bodies_and_errors_are_left_alone(app):
+    with app.app_context():
+        small = compress(app, main.jsonify({"status": "success"}), "gzip")
+        error = compress(app, Response(json.dumps(BIG), status=400), "gzip")
+    assert "Content-Encoding" not in small.headers
+    assert "Content-Encoding" not in error.headers
+
+
+def test_streamed_chunks_are_flushed_one_by_one(app):
+    lines = [ndjson_line({"pk": pk}) for pk in range(3)]
+    response = compress(app, Response(iter(lines)), "gzip")
+    decompressor = zlib.decompressobj(31)
+    # each chunk decodes on its own, without waiting for the end of the stream
+    for line, chunk in zip(lines, response.response):
+        assert decompressor.decompress(chunk) == line
+
+
+def test_provider_matches_the_stdlib_encoder(app):
+    obj = {"b": 1, "a": [datetime(2024, 1, 2, 3, 4, 5)], "c": {"y": None, "x": 1.5}}
+    with app.app_context():
+        fast = FastJSONProvider(app).dumps(obj)
+        stdlib = main.DefaultJSONProvider(app).dumps(obj)
+    assert json.loads(fast) == json.loads(stdlib)
+    assert list(json.loads(fast)) == ["a", "b", "c"]
+
+
+def test_wide_ints_fall_back_to_the_stdlib_encoder(app):
+    with app.app_context():
+        assert json.loads(FastJSONProvider(app).dumps({"pk": 2 ** 70})) == {"pk": 2 ** 70}
+    assert json.loads(ndjson_line({"pk": 2 ** 70})) == {"pk": 2 ** 70}
+    assert ndjson_line({"pk": 1}) == b'{"pk":1}\n'
@@ -0,0 +1,79 @@
+import json
+import uuid
+
+import pytest
+
+import main
+from conftest import FakeAPI
+from main import iter_follower_pages, parse_friendship_cursor, stream_options, stream_users
+
+
+PAGES = {None: ([1, 2, 3], "p2"), "p2": ([4, 5, 6], "p3"), "p3": ([7], None)}
+
+
+def read_lines(response):
+    return [json.loads(line) for line in b"".join(response.response).splitlines()]
+
+
+def test_new_walk_gets_a_rank_token():
+    rank_token, max_id = parse_friendship_cursor(None)
+    uuid.UUID(rank_token)
+    assert max_id is None
+
+
+def test_cursor_keeps_its_rank_token():
+    rank_token = str(uuid.uuid4())
+    assert parse_friendship_cursor(f"{rank_token}:QVFD:x") == (rank_token, "QVFD:x")
+    assert parse_friendship_cursor(f"{rank_token}:") == (rank_token, None)
+
+
+def test_bare_max_id_starts_a_new_rank_token():
+    rank_token, max_id = parse_friendship_cursor("QVFDabc:123")
+    uuid.UUID(rank_token)
+    assert max_id == "QVFDabc:123"
+
+
+def test_pages_share_one_rank_token_across_resumes():
+    api = FakeAPI(followers={9: PAGES})
+    users, cursor = next(iter_follower_pages(api, 9))
+    assert [user["pk"] for user in users] == [1, 2, 3]
+    resumed = list(iter_follower_pages(api, 9, cursor))
+    assert [[user["pk"] for user in users] for users, _ in resumed] == [[4, 5, 6], [7]]
+    assert resumed[-1][1] is None
+    assert len({rank_token for _, _, rank_token, _ in api.calls}) == 1
+    assert [max_id for _, _, _, max_id in api.calls] == [None, "p2", "p3"]
+
+
+def test_stream_stops_mid_page_and_resumes_with_skip():
+    api = FakeAPI(followers={9: PAGES})
+    lines = read_lines(stream_users(iter_follower_pages(api, 9), max_items=5))
+    first = [line["pk"] for line in lines if "pk" in line]
+    final = lines[-1]
+    assert first == [1, 2, 3, 4, 5]
+    assert final["status"] == "success" and final["skip"] == 2
+
+    pages = iter_follower_pages(api, 9, final["cursor"])
+    lines = read_lines(stream_users(pages, cursor=final["cursor"], skip=final["skip"]))
+    assert [line["pk"] for line in lines if "pk" in line] == [6, 7]
+    assert lines[-1] == {"status": "success", "count": 2, "cursor": None}
+
+
+@pytest.mark.parametrize("name, value", [
+    ("skip", -1), ("skip", "3"), ("skip", 1.5), ("skip", True),
+    ("max_items", -5), ("max_items", "10"),
+    ("page_delay", -1), ("page_delay", "1"), ("page_delay", float("nan")),
+])
+def test_bad_stream_options_are_refused(name, value):
+    with pytest.raises(ValueError, match=name):
+        stream_options({name: value})
+
+
+def test_page_delay_is_capped():
+    assert stream_options({"page_delay": 0.5})["page_delay"] == 0.5
+    assert stream_options({"page_delay": 3600})["page_delay"] == main.FOLLOWERS_MAX_PAGE_DELAY
+    assert stream_options({})["page_delay"] == main.FOLLOWERS_PAGE_DELAY
+
+
+def test_bad_stream_option_is_a_400(client):
+    response = client.post("/get_own_followers", json={"token": "t", "stream": True, "page_delay": -1})
+    assert response.status_code == 400
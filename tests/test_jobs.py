@@ -0,0 +1,176 @@
+import sqlite3
+
+import pytest
+
+import main
+from main import JOB_MAX_ATTEMPTS, JobQueue
+
+
+def expire_leases(queue):
+    with queue._pool.connection() as conn:
+        conn.execute("UPDATE jobs SET lease_until = 0 WHERE status = 'running'")
+
+
+def claim_now(queue):
+    with queue._pool.connection() as conn:
+        conn.execute("UPDATE jobs SET run_at = 0 WHERE status = 'queued'")
+    return queue.claim()
+
+
+def test_claim_returns_the_claimed_row(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    queue.enqueue("token")
+    job = queue.claim()
+    assert job["status"] == "running"
+    assert job["attempts"] == 1
+    assert job["lease_owner"]
+
+
+def test_expired_lease_is_failed_after_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.enqueue("token")
+    for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+        job = claim_now(queue)
+        assert (job["id"], job["attempts"]) == (job_id, attempt)
+        expire_leases(queue)
+        queue.enqueue_due()
+    job = queue.get("token", job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "Lease expired"
+    assert queue.claim() is None
+
+
+def test_runner_that_lost_its_lease_cannot_finish(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.enqueue("token")
+    stale = queue.claim()
+    expire_leases(queue)
+    queue.enqueue_due()
+    current = claim_now(queue)
+
+    assert not queue.finish(stale, status="done")
+    assert not queue.retry_or_fail(stale, "boom")
+    assert queue.get("token", job_id)["status"] == "running"
+    assert queue.finish(current, status="done")
+    assert queue.get("token", job_id)["status"] == "done"
+    # finishing twice is a no-op too
+    assert not queue.finish(current, status="failed")
+
+
+def test_retry_uses_the_claimed_attempt_count(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.enqueue("token")
+    for _ in range(JOB_MAX_ATTEMPTS):
+        assert queue.retry_or_fail(claim_now(queue), "boom")
+    job = queue.get("token", job_id)
+    assert (job["status"], job["attempts"]) == ("failed", JOB_MAX_ATTEMPTS)
+
+
+def test_existing_database_gains_the_lease_owner_column(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE jobs (id INTEGER PRIMARY KEY, schedule_id INTEGER, token TEXT NOT NULL, user_id TEXT,"
+        " status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, run_at REAL NOT NULL,"
+        " created_at REAL NOT NULL, started_at REAL, finished_at REAL, lease_until REAL,"
+        " snapshot_path TEXT, previous_path TEXT, diff_path TEXT, result TEXT, error TEXT)")
+    conn.commit()
+    conn.close()
+    queue = JobQueue(path)
+    queue.enqueue("token")
+    assert queue.claim()["lease_owner"]
+
+
+def test_failed_snapshot_job_is_retried(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(main, "job_queue", queue)
+
+    def broken(job):
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(main, "run_snapshot_job", broken)
+    job_id = queue.enqueue("token")
+
+    class StopAfterOne:
+        calls = 0
+
+        def is_set(self):
+            self.calls += 1
+            return self.calls > 1
+
+    main.job_runner(StopAfterOne())
+    job = queue.get("token", job_id)
+    assert (job["status"], job["error"], job["attempts"]) == ("queued", "upstream down", 1)
+
+
+def test_ids_start_at_the_queues_base(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), id_base=5 * main.JOB_ID_SPAN)
+    assert queue.enqueue("token") == 5 * main.JOB_ID_SPAN + 1
+    assert queue.enqueue("token") == 5 * main.JOB_ID_SPAN + 2
+    assert queue.schedule("token", None, 3600, 0) == 5 * main.JOB_ID_SPAN + 1
+
+
+def test_handed_off_rows_keep_their_ids(tmp_path):
+    old = JobQueue(str(tmp_path / "old.db"), id_base=main.JOB_ID_SPAN)
+    new = JobQueue(str(tmp_path / "new.db"), id_base=2 * main.JOB_ID_SPAN)
+    schedule_id = old.schedule("token", "42", 3600, 0)
+    done_id = old.enqueue("token", "42", schedule_id)
+    claimed = old.claim()
+    old.finish(claimed, status="done", result="{}")
+    running_id = old.enqueue("token", "42", schedule_id)
+    old.claim()
+    other_id = old.enqueue("other")
+
+    entry = old.export("token")
+    new.receive(entry)
+    new.receive(entry)  # a retried handoff
+    old.drop(entry)
+
+    assert new.get("token", done_id)["status"] == "done"
+    # the running job starts over on its new node
+    assert new.get("token", running_id)["status"] == "queued"
+    assert new.get("token", running_id)["lease_owner"] is None
+    assert new.tokens() == ["token"]
+    assert old.tokens() == ["other"]
+    assert old.get("other", other_id) is not None
+
+
+def test_clashing_ids_get_new_ones(tmp_path):
+    old = JobQueue(str(tmp_path / "old.db"), id_base=0)
+    new = JobQueue(str(tmp_path / "new.db"), id_base=0)
+    new.schedule("someone-else", None, 3600, 0)
+    new.enqueue("someone-else")
+    old.enqueue("token", None, old.schedule("token", None, 3600, 0))
+
+    new.receive(old.export("token"))
+
+    moved = new.export("token")
+    assert [schedule["id"] for schedule in moved["schedules"]] == [2]
+    assert [(job["id"], job["schedule_id"]) for job in moved["jobs"]] == [(2, 2)]
+
+
+@pytest.fixture
+def jobs_client(client, monkeypatch):
+    monkeypatch.setattr(main, "job_queue", JobQueue("jobs.db"))
+    monkeypatch.setattr(main, "get_api_from_token", lambda token: object())
+    return client
+
+
+@pytest.mark.parametrize("path", ["/jobs/enqueue", "/jobs/schedule"])
+@pytest.mark.parametrize("target_username", ["  ", 5, ["alice"]])
+def test_bad_target_is_a_400(jobs_client, path, target_username):
+    response = jobs_client.post(path, json={"token": "t", "target_username": target_username})
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "target_username required"
+
+
+@pytest.mark.parametrize("body", [{"interval_seconds": [3600]}, {"interval_seconds": "soon"},
+                                  {"interval_seconds": 3600, "jitter_seconds": {"a": 1}}])
+def test_bad_interval_is_a_400(jobs_client, body):
+    response = jobs_client.post("/jobs/schedule", json={"token": "t", **body})
+    assert response.status_code == 400
+
+
+def test_schedule_without_a_target_is_the_callers_own(jobs_client):
+    response = jobs_client.post("/jobs/schedule", json={"token": "t", "interval_seconds": 3600})
+    assert response.status_code == 200
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+import main
+from main import LOGIN_BUSY_RETRY_AFTER, LoginInProgress
+
+
+def test_store_lock_times_out_with_login_in_progress():
+    with main.session_store.lock_login("alice", 1):
+        with pytest.raises(LoginInProgress):
+            with main.session_store.lock_login("alice", 0.1):
+                pass
+
+
+def test_busy_login_is_a_503_with_retry_after(client, monkeypatch):
+    def busy(username, password):
+        raise LoginInProgress("Another login for this account is still running")
+
+    monkeypatch.setattr(main.login_manager, "login", busy)
+    response = client.post("/login", json={"username": "alice", "password": "secret"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(LOGIN_BUSY_RETRY_AFTER)
+    assert response.get_json()["retry_after"] == LOGIN_BUSY_RETRY_AFTER
+
+
+def test_other_timeouts_are_still_server_errors(client, monkeypatch):
+    def broken(username, password):
+        raise TimeoutError("timed out")
+
+    monkeypatch.setattr(main.login_manager, "login", broken)
+    response = client.post("/login", json={"username": "alice", "password": "secret"})
+    assert response.status_code == 500
+
+
+@pytest.mark.parametrize("body", [
+    {"username": 123, "password": "secret"},
+    {"username": ["alice"], "password": "secret"},
+    {"username": "alice", "password": 123},
+    {"username": "   ", "password": "secret"},
+])
+def test_bad_credentials_are_a_400(client, body):
+    response = client.post("/login", json=body)
+    assert response.status_code == 400
+
+
+def test_keyed_locks_drop_idle_keys():
+    locks = main.KeyedLocks()
+    with locks.hold("alice"):
+        with locks.hold("bob"):
+            assert len(locks) == 2
+        assert len(locks) == 1
+    assert len(locks) == 0
+
+
+def test_keyed_locks_keep_the_lock_while_someone_waits():
+    locks = main.KeyedLocks()
+    inside = []
+    waiting = threading.Event()
+
+    def second():
+        waiting.set()
+        with locks.hold("alice"):
+            inside.append("second")
+
+    with locks.hold("alice"):
+        thread = threading.Thread(target=second)
+        thread.start()
+        waiting.wait(1)
+        thread.join(0.2)
+        assert inside == []  # still excluded, the waiter shares the entry
+        inside.append("first")
+    thread.join(1)
+    assert inside == ["first", "second"]
+    assert len(locks) == 0
@@ -0,0 +1,55 @@
+import pytest
+
+from main import is_public_address, media_url_allowed
+
+
+@pytest.mark.parametrize("url", [
+    "https://scontent.cdninstagram.com/v/t51/pic.jpg",
+    "https://cdninstagram.com/pic.jpg",
+    "https://instagram.fxyz1-1.fna.fbcdn.net/v/pic.jpg?stp=dst",
+    "https://SCONTENT.CDNINSTAGRAM.COM/pic.jpg",
+    "https://scontent.cdninstagram.com:443/pic.jpg",
+])
+def test_allowed_urls(url):
+    assert media_url_allowed(url)
+
+
+@pytest.mark.parametrize("url", [
+    "http://scontent.cdninstagram.com/pic.jpg",  # not https
+    "https://evilcdninstagram.com/pic.jpg",  # not a subdomain
+    "https://cdninstagram.com.evil.com/pic.jpg",
+    "https://user@scontent.cdninstagram.com/pic.jpg",
+    "https://user:pw@scontent.cdninstagram.com/pic.jpg",
+    "https://scontent.cdninstagram.com:8443/pic.jpg",
+    "https://127.0.0.1/pic.jpg",
+    "https://169.254.169.254/latest/meta-data/",
+    "file:///etc/passwd",
+    "",
+    None,
+    ["https://scontent.cdninstagram.com/pic.jpg"],
+])
+def test_refused_urls(url):
+    assert not media_url_allowed(url)
+
+
+@pytest.mark.parametrize("address, public", [
+    ("157.240.1.1", True),
+    ("2a03:2880:f003::1", True),
+    ("127.0.0.1", False),
+    ("10.1.2.3", False),
+    ("192.168.0.10", False),
+    ("169.254.169.254", False),
+    ("::1", False),
+    ("fd00::1", False),
+    ("::ffff:127.0.0.1", False),  # IPv4-mapped, checked as IPv4
+    ("::ffff:157.240.1.1", True),
+])
+def test_public_addresses(address, public):
+    assert is_public_address(address) is public
+
+
+@pytest.mark.parametrize("target_usernames", ["alice", [""], ["  "], ["alice", None], [1], {"alice": 1}])
+def test_fetch_refuses_bad_target_usernames(client, target_usernames):
+    response = client.post("/profile_pics/fetch", json={"token": "t", "target_usernames": target_usernames})
+    assert response.status_code == 400
+    assert "target_usernames" in response.get_json()["message"]
@@ -0,0 +1,102 @@
+import json
+import os
+import subprocess
+import sys
+
+import main
+
+
+def metric_lines(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    return response.get_data(as_text=True).splitlines()
+
+
+def test_rate_governor_lines_have_help_and_type(client):
+    lines = metric_lines(client)
+    for name in main.RATE_GOVERNOR_METRICS:
+        metric = f"igapi_rate_governor_{name}"
+        assert f"# TYPE {metric} counter" in lines
+        help_index = next(index for index, line in enumerate(lines) if line.startswith(f"# HELP {metric} "))
+        assert lines[help_index + 1] == f"# TYPE {metric} counter"
+        assert lines[help_index + 2].startswith(metric + '{class="')
+
+
+def write_worker_file(pid, count):
+    os.makedirs(main.METRICS_DIR, exist_ok=True)
+    snapshot = {
+        "metrics": {"igapi_http_requests_total": [[["other_route", "GET", "200"], count]]},
+        "rate_governor": {"profile": {"calls": count}},
+        "gauges": {str(pid): {"igapi_session_pool_size": 3}}
+    }
+    with open(os.path.join(main.METRICS_DIR, f"{pid}.json"), 'w') as metrics_file:
+        json.dump(snapshot, metrics_file)
+
+
+def test_other_workers_are_added_up(client):
+    own_calls = main.rate_governor.counters()["profile"]["calls"]
+    write_worker_file(os.getppid(), 7)
+    lines = metric_lines(client)
+    assert 'igapi_http_requests_total{route="other_route",method="GET",status="200"} 7' in lines
+    assert f'igapi_rate_governor_calls{{class="profile"}} {own_calls + 7}' in lines
+    # gauges stay per worker
+    assert f'igapi_session_pool_size{{pid="{os.getppid()}"}} 3' in lines
+    assert any(line.startswith(f'igapi_session_pool_size{{pid="{os.getpid()}"}}') for line in lines)
+
+
+def test_dead_workers_files_are_left_out(client):
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    write_worker_file(dead.pid, 7)
+    assert not any("other_route" in line for line in metric_lines(client))
+
+
+def test_retired_worker_keeps_counting(client):
+    main.http_requests_total.inc("retired_route", "GET", "200", amount=2)
+    main.write_metrics()
+    main.retire_metrics()
+    assert sorted(os.listdir(main.METRICS_DIR)) == [".lock", "retired.json"]
+    with open(os.path.join(main.METRICS_DIR, "retired.json")) as metrics_file:
+        retired = json.load(metrics_file)
+    pairs = retired["metrics"]["igapi_http_requests_total"]
+    assert [["retired_route", "GET", "200"], 2] in pairs
+    assert retired["gauges"] == {}
+
+
+def test_merge_adds_histogram_buckets():
+    merged = main.merge_metrics([
+        {"metrics": {"h": [[[], [1, 0, 0.5]]]}},
+        {"metrics": {"h": [[[], [0, 2, 3.0]]]}},
+    ])
+    assert merged["metrics"]["h"] == [[[], [1, 2, 3.5]]]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = main.Histogram("h", "Help.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, "/x")
+    assert histogram.render() == [
+        "# HELP h Help.",
+        "# TYPE h histogram",
+        'h_bucket{route="/x",le="0.1"} 1',
+        'h_bucket{route="/x",le="1.0"} 3',
+        'h_bucket{route="/x",le="+Inf"} 4',
+        'h_sum{route="/x"} 6.05',
+        'h_count{route="/x"} 4',
+    ]
+
+
+def test_requests_and_errors_are_counted_by_route(client):
+    # the counters live for the whole process, so compare against before
+    series = ['igapi_http_requests_total{route="/login",method="POST",status="400"}',
+              'igapi_http_request_errors_total{route="/login",error="http_400"}',
+              'igapi_http_request_seconds_count{route="/login"}']
+
+    def values():
+        lines = metric_lines(client)
+        return [next((float(line.rsplit(" ", 1)[1]) for line in lines if line.startswith(name + " ")), 0)
+                for name in series]
+
+    before = values()
+    client.post("/login", json={"username": 5, "password": "secret"})
+    assert [after - start for after, start in zip(values(), before)] == [1, 1, 1]
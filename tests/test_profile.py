@@ -0,0 +1,51 @@
+import pytest
+
+ROUTES = ["/get_number_of_followers", "/get_number_of_following", "/get_bio", "/get_post_count",
+          "/get_profile_pic_url", "/get_verified", "/get_private", "/get_full_name"]
+
+
+@pytest.mark.parametrize("route", ROUTES)
+@pytest.mark.parametrize("body", [{}, {"target_username": ""}, {"target_username": "  "}, {"target_username": 5}])
+def test_target_routes_require_a_target(client, fake_api, route, body):
+    response = client.post(route, json={"token": "t", **body})
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "target_username required"
+    assert fake_api.calls == []
+
+
+def test_own_routes_answer_for_the_caller(client, fake_api):
+    assert client.post("/get_own_full_name", json={"token": "t"}).get_json()["full_name"] == "Me"
+    assert fake_api.calls == [("current_user",)]
+
+
+def test_field_routes_share_one_fetch(client, fake_api):
+    for route in ROUTES:
+        assert client.post(route, json={"token": "t", "target_username": "alice"}).status_code == 200
+    assert fake_api.calls == [("username_info", "alice")]
+
+
+def test_profile_field_selection(client, fake_api):
+    response = client.post("/profile", json={"token": "t", "target_username": "alice",
+                                             "fields": "bio,follower_count"})
+    assert response.get_json() == {"status": "success", "profile": {"bio": "bio", "follower_count": 10}}
+    response = client.post("/profile", json={"token": "t", "target_username": "alice", "fields": ["nope"]})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("target", ["", "  ", 5, ["a"], {"a": 1}])
+def test_profile_rejects_a_bad_target(client, fake_api, target):
+    response = client.post("/profile", json={"token": "t", "target_username": target})
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "target_username must be a non-empty string"
+    assert fake_api.calls == []
+
+
+def test_profile_without_a_target_is_the_callers_own(client, fake_api):
+    assert client.post("/profile", json={"token": "t"}).get_json()["profile"]["full_name"] == "Me"
+    assert fake_api.calls == [("current_user",)]
+
+
+def test_spellings_of_one_name_share_a_cache_entry(client, fake_api):
+    for target in ("Alice", " alice", "ALICE "):
+        assert client.post("/profile", json={"token": "t", "target_username": target}).status_code == 200
+    assert fake_api.calls == [("username_info", "alice")]
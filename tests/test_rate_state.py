@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+import main
+from main import RateState
+
+LIMIT = (1.0, 3, 100.0, 100)  # per account calls/second, burst, global calls/second, global burst
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def state(tmp_path):
+    return RateState(str(tmp_path / "rate_state.db"))
+
+
+def test_burst_then_wait(state, clock):
+    assert [state.reserve("a", "profile", LIMIT, 10) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert state.reserve("a", "profile", LIMIT, 10) == pytest.approx(1.0)
+    # the reservation above queued a call, the next one waits behind it
+    assert state.reserve("a", "profile", LIMIT, 10) == pytest.approx(2.0)
+
+
+def test_refill_over_time(state, clock):
+    for _ in range(3):
+        state.reserve("a", "profile", LIMIT, 10)
+    clock[0] += 2.5
+    assert state.reserve("a", "profile", LIMIT, 10) == 0.0
+    assert state.reserve("a", "profile", LIMIT, 10) == 0.0
+    assert state.reserve("a", "profile", LIMIT, 10) == pytest.approx(0.5)
+
+
+def test_rejected_reservation_takes_no_tokens(state, clock):
+    for _ in range(3):
+        state.reserve("a", "profile", LIMIT, 10)
+    assert state.reserve("a", "profile", LIMIT, 0.5) == pytest.approx(1.0)
+    assert state.reserve("a", "profile", LIMIT, 0.5) == pytest.approx(1.0)
+
+
+def test_accounts_and_classes_have_their_own_buckets(state, clock):
+    for _ in range(3):
+        state.reserve("a", "profile", LIMIT, 10)
+    assert state.reserve("b", "profile", LIMIT, 10) == 0.0
+    assert state.reserve("a", "followers", LIMIT, 10) == 0.0
+
+
+def test_global_bucket_is_shared_by_accounts(state, clock):
+    limit = (100.0, 100, 1.0, 2)
+    assert state.reserve("a", "profile", limit, 10) == 0.0
+    assert state.reserve("b", "profile", limit, 10) == 0.0
+    assert state.reserve("c", "profile", limit, 10) == pytest.approx(1.0)
+
+
+def test_throttling_blocks_and_slows_the_account(state, clock):
+    assert state.record_throttled("a") == main.RATE_BACKOFF_INITIAL
+    assert state.reserve("a", "profile", LIMIT, 100) == pytest.approx(main.RATE_BACKOFF_INITIAL)
+    assert state.record_throttled("a") == main.RATE_BACKOFF_INITIAL * 2
+    assert state.stats() == {"accounts": 1, "accounts_backing_off": 1, "accounts_slowed": 1}
+
+    clock[0] += main.RATE_BACKOFF_MAX
+    state.record_success("a")
+    # still slowed, but a success resets the backoff
+    assert state.stats() == {"accounts": 1, "accounts_backing_off": 0, "accounts_slowed": 1}
+    assert state.record_throttled("a") == main.RATE_BACKOFF_INITIAL
+
+
+def test_concurrent_reservations_never_overdraw(state, clock):
+    limit = (0.001, 10, 100.0, 100)
+    waits = []
+    lock = threading.Lock()
+
+    def reserve():
+        wait = state.reserve("a", "profile", limit, 0)
+        with lock:
+            waits.append(wait)
+
+    threads = [threading.Thread(target=reserve) for _ in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(1 for wait in waits if wait == 0.0) == 10
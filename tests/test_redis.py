@@ -0,0 +1,103 @@
+import io
+
+import pytest
+
+import main
+from main import RedisConnection, RedisError, RedisSessionStore
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = b""
+        self.closed = False
+
+    def sendall(self, data):
+        self.sent += bytes(data)
+
+    def close(self):
+        self.closed = True
+
+
+def connection(replies):
+    conn = RedisConnection.__new__(RedisConnection)
+    conn.sock = FakeSocket()
+    conn.reader = io.BytesIO(replies)
+    return conn
+
+
+def test_reads_every_reply_type():
+    conn = connection(b"+OK\r\n:42\r\n$5\r\nhe\r\no\r\n$-1\r\n*2\r\n$1\r\na\r\n*1\r\n:1\r\n*-1\r\n$0\r\n\r\n")
+    assert conn._read() == "OK"
+    assert conn._read() == 42
+    assert conn._read() == b"he\r\no"  # bulk strings are read by length, not by line
+    assert conn._read() is None
+    assert conn._read() == [b"a", [1]]
+    assert conn._read() is None
+    assert conn._read() == b""
+
+
+def test_error_reply_is_returned_not_raised():
+    reply = connection(b"-ERR wrong type\r\n")._read()
+    assert isinstance(reply, RedisError)
+    assert str(reply) == "ERR wrong type"
+
+
+def test_closed_connection():
+    with pytest.raises(ConnectionError):
+        connection(b"")._read()
+
+
+def test_unexpected_reply():
+    with pytest.raises(RedisError, match="Unexpected reply"):
+        connection(b"?what\r\n")._read()
+
+
+def test_commands_are_sent_as_resp_arrays():
+    conn = connection(b"+OK\r\n:1\r\n")
+    conn.pipeline(("SET", "k", b"\x00v"), ("INCRBY", "n", 1))
+    assert conn.sock.sent == (b"*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$2\r\n\x00v\r\n"
+                              b"*3\r\n$6\r\nINCRBY\r\n$1\r\nn\r\n$1\r\n1\r\n")
+
+
+def test_pipeline_error_still_reads_every_reply():
+    conn = connection(b"+OK\r\n-ERR bad\r\n:3\r\n*2\r\n-ERR nested\r\n:4\r\n+NEXT\r\n")
+    with pytest.raises(RedisError, match="ERR bad"):
+        conn.pipeline(("SET", "a", 1), ("HSET", "a", "f", 1), ("INCR", "b"), ("EXEC",))
+    # the replies that followed the error were consumed, the next one is in step
+    assert conn._read() == "NEXT"
+
+
+class FakeRedisConnection:
+    opened = []
+
+    def __init__(self, host, port, db=0, password=None):
+        self.replies = []
+        self.closed = False
+        FakeRedisConnection.opened.append(self)
+
+    def pipeline(self, *commands):
+        reply = self.replies.pop(0) if self.replies else [None] * len(commands)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_reuses_healthy_connections_and_drops_failed_ones(monkeypatch):
+    FakeRedisConnection.opened = []
+    monkeypatch.setattr(main, "RedisConnection", FakeRedisConnection)
+    store = RedisSessionStore("redis://127.0.0.1:6379/0", pool_size=2)
+
+    assert store.load("t") is None
+    assert store.load("t") is None
+    assert len(FakeRedisConnection.opened) == 1
+
+    FakeRedisConnection.opened[0].replies.append(RedisError("ERR boom"))
+    with pytest.raises(RedisError):
+        store.load("t")
+    assert FakeRedisConnection.opened[0].closed
+
+    assert store.load("t") is None
+    assert len(FakeRedisConnection.opened) == 2
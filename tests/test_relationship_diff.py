@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import main
+from conftest import FakeAPI, users
+from main import snapshot_base_path, write_snapshot
+
+
+def diff(client, monkeypatch, api, **body):
+    monkeypatch.setattr(main, "get_api_from_token", lambda token: api)
+    monkeypatch.setattr(main, "resolve_user_pk", lambda token, username: 7)
+    response = client.post("/relationship_diff", json={"token": "t", "target_username": "private", **body})
+    return [json.loads(line) for line in response.get_data().splitlines()]
+
+
+def test_diff_lists_both_sides(client, monkeypatch):
+    lines = diff(client, monkeypatch, FakeAPI(100, followers={7: [1, 2, 3]}, following={7: [2, 4]}))
+    assert {(line["relation"], line["pk"]) for line in lines if "relation" in line} == {
+        ("followers_only", 1), ("followers_only", 3), ("following_only", 4)}
+    assert lines[-1]["mutual"] == 1
+
+
+def test_max_age_only_reuses_the_callers_own_snapshot(client, monkeypatch):
+    # account 100 can see the private account's followers and snapshotted them
+    write_snapshot(users(1, 2, 3), snapshot_base_path(100, 7, "a"))
+
+    outsider = FakeAPI(200)
+    lines = diff(client, monkeypatch, outsider, max_age=3600)
+    assert not [line for line in lines if "relation" in line]
+    assert lines[-1]["followers"] == 0
+
+    insider = FakeAPI(100)
+    lines = diff(client, monkeypatch, insider, max_age=3600)
+    assert lines[-1]["followers"] == 3
+
+
+@pytest.mark.parametrize("target_username", ["  ", 5, ["alice"]])
+def test_bad_target_is_a_400(client, monkeypatch, target_username):
+    monkeypatch.setattr(main, "get_api_from_token", lambda token: FakeAPI(100))
+    response = client.post("/relationship_diff", json={"token": "t", "target_username": target_username})
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "target_username required"
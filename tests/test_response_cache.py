@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from main import ResponseCache
+
+
+def test_fresh_entries_are_served_from_the_cache():
+    cache = ResponseCache()
+    loads = []
+    for _ in range(3):
+        assert cache.get(("t", "alice"), 60, lambda: loads.append(1) or "payload") == "payload"
+    assert len(loads) == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_max_age_is_per_read():
+    cache = ResponseCache()
+    cache.get(("t", "alice"), 60, lambda: "old")
+    # a reader that wants fresher data than the entry fetches again
+    assert cache.get(("t", "alice"), -1, lambda: "new") == "new"
+    assert cache.get(("t", "alice"), 60, lambda: "unused") == "new"
+
+
+def test_least_recently_used_is_evicted():
+    cache = ResponseCache(max_size=2)
+    for name in ("a", "b", "a", "c"):
+        cache.get(("t", name), 60, lambda: name)
+    assert cache.evictions == 1
+    assert cache.get(("t", "b"), 60, lambda: "refetched") == "refetched"
+
+
+def test_concurrent_misses_share_one_fetch():
+    cache = ResponseCache()
+    loads = []
+    results = []
+
+    def loader():
+        time.sleep(0.1)
+        loads.append(1)
+        return "payload"
+
+    threads = [threading.Thread(target=lambda: results.append(cache.get(("t", "alice"), 60, loader)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert results == ["payload"] * 4
+    assert cache.coalesced == 3
+
+
+def test_failed_fetch_is_not_cached():
+    cache = ResponseCache()
+
+    def broken():
+        raise ValueError("upstream down")
+
+    with pytest.raises(ValueError):
+        cache.get(("t", "alice"), 60, broken)
+    assert cache.get(("t", "alice"), 60, lambda: "payload") == "payload"
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_invalidate_scope_drops_only_that_token():
+    cache = ResponseCache()
+    cache.get(("t1", "alice"), 60, lambda: "one")
+    cache.get(("t2", "alice"), 60, lambda: "two")
+    cache.invalidate_scope("t1")
+    assert cache.get(("t1", "alice"), 60, lambda: "refetched") == "refetched"
+    assert cache.get(("t2", "alice"), 60, lambda: "unused") == "two"
@@ -0,0 +1,98 @@
+import http.cookiejar
+import time
+
+import pytest
+from instagram_private_api.http import ClientCookieJar
+
+import main
+from main import SESSION_REFRESH_MARGIN, SessionMaintainer
+
+
+def cookie_jar(expires):
+    jar = ClientCookieJar()
+    jar.set_cookie(http.cookiejar.Cookie(
+        0, "ds_user_id", "1", None, False, ".instagram.com", True, True, "/", True, True, int(expires),
+        False, None, None, {}))
+    return jar
+
+
+class FakeClient:
+    authenticated_user_id = 1
+
+    def __init__(self, settings):
+        self.cookie_jar = ClientCookieJar(settings["cookie"])
+        self.calls = 0
+
+    def current_user(self):
+        # Instagram answers with a cookie that lives another 90 days
+        self.calls += 1
+        self.cookie_jar = cookie_jar(time.time() + 90 * 86400)
+        return {"user": {"pk": 1, "username": "me"}}
+
+    @property
+    def settings(self):
+        return {"cookie": self.cookie_jar.dump()}
+
+
+@pytest.fixture
+def hydrated(monkeypatch):
+    clients = []
+
+    def load(settings):
+        clients.append(FakeClient(settings))
+        return clients[-1]
+
+    monkeypatch.setattr(main, "load_api_from_settings", load)
+    return clients
+
+
+def save_session(token, expires):
+    main.session_store.save(token, {"cookie": cookie_jar(expires).dump()})
+
+
+def stored_expiry(token):
+    return main.settings_auth_expires(main.session_store.load(token))
+
+
+def test_scan_refreshes_without_filling_the_pool(hydrated):
+    save_session("expiring", time.time() + SESSION_REFRESH_MARGIN / 2)
+    save_session("fresh", time.time() + SESSION_REFRESH_MARGIN * 2)
+    maintainer = SessionMaintainer()
+    maintainer.scan()
+    assert len(hydrated) == 1 and hydrated[0].calls == 1
+    assert stored_expiry("expiring") > time.time() + SESSION_REFRESH_MARGIN
+    assert maintainer.stats()["refreshed"] == 1
+    assert main.session_pool.stats()["size"] == 0
+
+
+def test_refresh_rereads_the_session_under_the_lock(hydrated):
+    # another worker extended the cookie after this one's scan read it
+    save_session("token", time.time() + SESSION_REFRESH_MARGIN * 2)
+    SessionMaintainer().refresh("token")
+    assert hydrated == []
+
+
+def test_expired_session_is_flagged(hydrated):
+    save_session("token", time.time() - 60)
+    maintainer = SessionMaintainer()
+    maintainer.scan()
+    assert maintainer.stats()["expired"] == 1
+    assert hydrated == []
+
+
+def test_only_one_maintainer_leads():
+    first, second = SessionMaintainer(), SessionMaintainer()
+    assert first.lead() and first.lead()
+    assert not second.lead()
+    first._leader_file.close()  # what the kernel does when the leader dies
+    assert second.lead()
+    second._leader_file.close()
+
+
+def test_every_worker_drops_expired_clients_from_its_pool(hydrated):
+    save_session("expired", time.time() - 60)
+    save_session("live", time.time() + 86400)
+    main.session_pool.get("expired")
+    main.session_pool.get("live")
+    assert main.session_pool.drop_expired() == 1
+    assert main.session_pool.hot_tokens(10) == ["live"]
@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+import pytest
+
+import main
+from main import SessionPool
+
+
+class FakeClient:
+    def __init__(self, settings):
+        self.settings = settings
+
+
+@pytest.fixture
+def hydrations(monkeypatch):
+    built = []
+
+    def load_api_from_settings(settings):
+        built.append(settings)
+        return FakeClient(settings)
+
+    monkeypatch.setattr(main, "load_api_from_settings", load_api_from_settings)
+    return built
+
+
+def bump_version(token):
+    # a rewrite inside one mtime tick would keep the version, so move it on
+    path = main.session_store.path(token)
+    mtime_ns = os.stat(path).st_mtime_ns + 10 ** 9
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_second_get_reuses_the_client(hydrations):
+    main.session_store.save("t", {"n": 1})
+    pool = SessionPool()
+    assert pool.get("t") is pool.get("t")
+    assert len(hydrations) == 1
+    assert (pool.hits, pool.misses) == (1, 1)
+
+
+def test_changed_settings_are_hydrated_again(hydrations):
+    main.session_store.save("t", {"n": 1})
+    pool = SessionPool()
+    pool.get("t")
+    main.session_store.save("t", {"n": 2})
+    bump_version("t")
+    assert pool.get("t").settings == {"n": 2}
+    assert pool.invalidations == 1
+
+
+def test_entries_expire_after_the_ttl(hydrations):
+    main.session_store.save("t", {"n": 1})
+    pool = SessionPool(ttl=-1)
+    pool.get("t")
+    pool.get("t")
+    assert len(hydrations) == 2
+
+
+def test_least_recently_used_is_evicted(hydrations):
+    for token in ("a", "b", "c"):
+        main.session_store.save(token, {"token": token})
+    pool = SessionPool(max_size=2)
+    pool.get("a")
+    pool.get("b")
+    pool.get("a")
+    pool.get("c")
+    assert pool.evictions == 1
+    assert pool.hot_tokens(10) == ["c", "a"]
+
+
+def test_unknown_token_is_refused(hydrations):
+    with pytest.raises(Exception, match="Invalid or expired token"):
+        SessionPool().get("missing")
+    assert hydrations == []
+
+
+def test_concurrent_misses_hydrate_once(monkeypatch):
+    main.session_store.save("t", {"n": 1})
+    built = []
+
+    def slow_load(settings):
+        time.sleep(0.1)
+        built.append(settings)
+        return FakeClient(settings)
+
+    monkeypatch.setattr(main, "load_api_from_settings", slow_load)
+    pool = SessionPool()
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(pool.get("t"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(built) == 1
+    assert len({id(client) for client in clients}) == 1
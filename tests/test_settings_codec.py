@@ -0,0 +1,55 @@
+import json
+import os
+
+import pytest
+
+from main import SETTINGS_MAGIC, decode_settings, encode_settings, from_json
+
+
+def test_round_trip_keeps_every_type():
+    settings = {
+        "uuid": "6f3a0c1e-0000-4000-8000-000000000000",
+        "created_ts": 1700000000,
+        "negative": -(2 ** 63),
+        "ratio": 0.25,
+        "cookie": b"\x00\x01binary\xff",
+        "flags": [True, False, None],
+        "nested": {"list": [1, "two", [3.5]], "empty": {}},
+        "unicode": "café \U0001f600",
+    }
+    assert decode_settings(encode_settings(settings)) == settings
+
+
+def test_non_string_keys_come_back_as_strings():
+    assert decode_settings(encode_settings({1: "a"})) == {"1": "a"}
+
+
+def test_tuples_come_back_as_lists():
+    assert decode_settings(encode_settings({"t": (1, 2)})) == {"t": [1, 2]}
+
+
+def test_legacy_json_settings_round_trip():
+    # the settings.json checked in at the repo root, bytes and all
+    with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "settings.json")) as file_data:
+        settings = json.load(file_data, object_hook=from_json)
+    assert decode_settings(encode_settings(settings)) == settings
+
+
+def test_unserializable_value_is_rejected():
+    with pytest.raises(TypeError):
+        encode_settings({"when": object()})
+
+
+def test_bad_magic_is_rejected():
+    with pytest.raises(ValueError, match="Not an encoded settings blob"):
+        decode_settings(b"JSN\x01N")
+
+
+def test_unknown_version_is_rejected():
+    with pytest.raises(ValueError, match="Unsupported settings format version"):
+        decode_settings(SETTINGS_MAGIC + b"\x63N")
+
+
+def test_unknown_tag_is_rejected():
+    with pytest.raises(ValueError, match="Unknown settings tag"):
+        decode_settings(encode_settings(None)[:4] + b"?")
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import main
+from main import diff_snapshots, iter_snapshot, read_snapshot_header, write_snapshot
+
+
+def users(*pks):
+    return [{"pk": pk, "username": f"user_{pk}"} for pk in pks]
+
+
+def test_snapshot_is_sorted_and_unique(tmp_path):
+    base_path = str(tmp_path / "followers_a")
+    # pages can overlap, the same pk shows up twice
+    count = write_snapshot(users(30, 10, 20, 10, 5), base_path)
+    assert count == 4
+    assert list(iter_snapshot(base_path)) == [(5, "user_5"), (10, "user_10"), (20, "user_20"), (30, "user_30")]
+    assert read_snapshot_header(base_path)["count"] == 4
+
+
+def test_external_merge_matches_in_memory_sort(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SNAPSHOT_RUN_SIZE", 3)
+    pks = [17, 3, 99, 42, 8, 3, 64, 1, 23, 56, 8]
+    base_path = str(tmp_path / "followers_runs")
+    assert write_snapshot(users(*pks), base_path) == len(set(pks))
+    assert [pk for pk, _ in iter_snapshot(base_path)] == sorted(set(pks))
+    # the sorted runs are removed once merged
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".run")]
+
+
+def test_empty_snapshot(tmp_path):
+    base_path = str(tmp_path / "followers_empty")
+    assert write_snapshot([], base_path) == 0
+    assert list(iter_snapshot(base_path)) == []
+
+
+def test_diff_reports_new_and_lost(tmp_path):
+    old_path = str(tmp_path / "followers_old")
+    new_path = str(tmp_path / "followers_new")
+    write_snapshot(users(1, 2, 3, 5), old_path)
+    write_snapshot(users(2, 4, 5, 6), new_path)
+    assert list(diff_snapshots(old_path, new_path)) == [
+        ("lost", 1, "user_1"), ("lost", 3, "user_3"), ("new", 4, "user_4"), ("new", 6, "user_6")]
+
+
+def test_diff_against_empty_snapshot(tmp_path):
+    old_path = str(tmp_path / "followers_old")
+    new_path = str(tmp_path / "followers_new")
+    write_snapshot([], old_path)
+    write_snapshot(users(7, 3), new_path)
+    assert list(diff_snapshots(old_path, new_path)) == [("new", 3, "user_3"), ("new", 7, "user_7")]
+    assert list(diff_snapshots(new_path, old_path)) == [("lost", 3, "user_3"), ("lost", 7, "user_7")]
+
+
+def test_identical_snapshots_have_no_diff(tmp_path):
+    old_path = str(tmp_path / "followers_old")
+    new_path = str(tmp_path / "followers_new")
+    write_snapshot(users(1, 2, 3), old_path)
+    write_snapshot(users(3, 2, 1), new_path)
+    assert list(diff_snapshots(old_path, new_path)) == []
+
+
+
+def test_failed_snapshot_leaves_no_temporary_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SNAPSHOT_RUN_SIZE", 2)
+
+    def broken_walk():
+        yield from users(3, 1, 2)
+        raise RuntimeError("page failed")
+
+    with pytest.raises(RuntimeError):
+        write_snapshot(broken_walk(), str(tmp_path / "followers_walk"))
+    assert os.listdir(tmp_path) == []
+
+    # fails while the .pks.tmp and .names.tmp files are being written
+    with pytest.raises(TypeError):
+        write_snapshot(users(3, 1) + [{"pk": 2, "username": None}], str(tmp_path / "followers_write"))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,123 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import main
+from main import JobQueue, SQLitePool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_connections_are_shared_across_threads(tmp_path):
+    opened = []
+    pool = SQLitePool(str(tmp_path / "pool.db"), opened.append, pool_size=2)
+    barrier = threading.Barrier(8)
+
+    def work():
+        barrier.wait()
+        for _ in range(20):
+            with pool.connection() as conn:
+                conn.execute("SELECT 1").fetchone()
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 1 <= len(opened) <= 2
+
+
+def test_open_transaction_is_rolled_back_on_release(tmp_path):
+    pool = SQLitePool(str(tmp_path / "pool.db"), lambda conn: None, pool_size=1, isolation_level=None)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+    try:
+        with pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO t VALUES (1)")
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    with pool.connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+
+
+def test_job_queue_works_from_another_thread(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.enqueue("token")
+    claimed = []
+    thread = threading.Thread(target=lambda: claimed.append(queue.claim()))
+    thread.start()
+    thread.join()
+    assert claimed[0]["id"] == job_id
+    assert queue.get("token", job_id)["status"] == "running"
+
+
+def hold_write_lock(path, seconds):
+    holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")
+    release = threading.Timer(seconds, lambda: holder.execute("COMMIT"))
+    release.start()
+    return release
+
+
+def test_busy_write_waits_for_the_lock(tmp_path):
+    path = str(tmp_path / "pool.db")
+    pool = SQLitePool(path, lambda conn: conn.execute("PRAGMA journal_mode=WAL"), isolation_level=None)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+    hold_write_lock(path, 0.2)
+    started = time.monotonic()
+    with pool.connection() as conn, conn:
+        conn.execute("INSERT INTO t VALUES (1)")
+    assert time.monotonic() - started >= 0.15
+
+
+def test_busy_write_gives_up_after_the_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SQLITE_BUSY_TIMEOUT", 0.1)
+    path = str(tmp_path / "pool.db")
+    pool = SQLitePool(path, lambda conn: None, isolation_level=None)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+    release = hold_write_lock(path, 1)
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        with pool.connection() as conn:
+            conn.execute("INSERT INTO t VALUES (1)")
+    release.cancel()
+
+
+GEVENT_CHECK = """
+from gevent import monkey
+monkey.patch_all()
+import sqlite3, sys, time
+import gevent
+import main
+
+path = sys.argv[1]
+state = main.RateState(path)
+state.reserve("account", "profile", (1, 10, 50, 100), 10)
+holder = sqlite3.connect(path, isolation_level=None)
+holder.execute("BEGIN IMMEDIATE")
+ticks = []
+ticker = gevent.spawn(lambda: [ticks.append(gevent.sleep(0.01)) for _ in range(1000)])
+writer = gevent.spawn(state.reserve, "account", "profile", (1, 10, 50, 100), 10)
+gevent.sleep(0.3)
+holder.execute("COMMIT")
+writer.join()
+ticker.kill()
+print(len(ticks))
+"""
+
+
+def test_waiting_for_a_lock_leaves_other_greenlets_running(tmp_path):
+    pytest.importorskip("gevent")
+    output = subprocess.run([sys.executable, "-c", GEVENT_CHECK, str(tmp_path / "rate.db")], cwd=tmp_path,
+                            env=dict(os.environ, PYTHONPATH=ROOT), capture_output=True, text=True, check=True)
+    # about 30 ticks in 0.3 seconds; a wait inside SQLite would allow none
+    assert int(output.stdout.split()[-1]) >= 10
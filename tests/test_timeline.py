@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import main
+from conftest import FakeAPI
+from main import stream_timeline
+
+
+# negative pks are ads, dropped by the filter
+PAGES = {None: ([1, -1, 2, 3], "c2"), "c2": ([4, 5, -2, 6], "c3"), "c3": ([7], None)}
+
+
+@pytest.fixture(autouse=True)
+def plain_projection(monkeypatch):
+    monkeypatch.setattr(main, "patch_and_project", lambda media: ({"pk": media["pk"]}, 0.0, 0.0))
+
+
+def read(cursor=None, **kwargs):
+    response = stream_timeline(FakeAPI(feed=PAGES), cursor, **kwargs)
+    lines = [json.loads(line) for line in b"".join(response.response).splitlines()]
+    return [line["pk"] for line in lines if "pk" in line], lines[-1]
+
+
+def test_full_walk():
+    pks, final = read()
+    assert pks == [1, 2, 3, 4, 5, 6, 7]
+    assert final["status"] == "success" and final["cursor"] is None and "skip" not in final
+
+
+def test_page_boundary_stop_resumes_from_next_page():
+    pks, final = read(max_items=3)
+    assert pks == [1, 2, 3]
+    assert final["cursor"] == "c2" and "skip" not in final
+
+
+def test_mid_page_stop_resumes_without_losing_posts():
+    seen = []
+    cursor, skip = None, 0
+    for _ in range(10):
+        pks, final = read(cursor, max_items=2, skip=skip)
+        seen += pks
+        if final["cursor"] is None and "skip" not in final:
+            break
+        cursor, skip = final["cursor"], final.get("skip", 0)
+    assert seen == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_mid_page_stop_reports_the_pages_own_cursor():
+    pks, final = read("c2", max_items=1)
+    assert pks == [4]
+    assert final["cursor"] == "c2" and final["skip"] == 1
+    pks, final = read("c2", max_items=1, skip=1)
+    assert pks == [5]
+    assert final["skip"] == 2
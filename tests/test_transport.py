@@ -0,0 +1,133 @@
+import http.client
+import http.server
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from instagram_private_api import ClientConnectionError
+from instagram_private_api.http import ClientCookieJar
+
+import main
+from main import PooledHTTPHandler, SharedTransport, load_api_from_settings
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    seen = []
+
+    def do_GET(self):
+        Handler.seen.append(self.path)
+        if self.path.endswith("/slow"):
+            time.sleep(1)
+        if self.path.endswith("/drop"):
+            self.close_connection = True
+            return
+        body = json.dumps({"status": "ok", "path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "csrftoken=abc; Path=/")
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.seen = []
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def opener(transport, *handlers):
+    built = urllib.request.build_opener(urllib.request.ProxyHandler({}), *handlers)
+    built.add_handler(PooledHTTPHandler(transport))
+    return built
+
+
+def test_requests_reuse_pooled_connections(server):
+    transport = SharedTransport()
+    built = opener(transport)
+    for _ in range(3):
+        with built.open(server + "/a", timeout=5) as response:
+            assert json.load(response)["path"] == "/a"
+    stats = transport.stats_dict()
+    assert stats["requests"] == 3
+    assert stats["new_connections"] == 1
+
+
+def test_cookie_processor_still_runs(server):
+    jar = urllib.request.HTTPCookieProcessor()
+    opener(SharedTransport(), jar).open(server + "/a", timeout=5).read()
+    assert [cookie.name for cookie in jar.cookiejar] == ["csrftoken"]
+
+
+def test_proxied_requests_fall_through_to_the_stock_handler(server):
+    transport = SharedTransport()
+    built = urllib.request.build_opener(urllib.request.ProxyHandler({"http": server}))
+    built.add_handler(PooledHTTPHandler(transport))
+    built.open("http://upstream.invalid/b", timeout=5).read()
+    assert Handler.seen == ["http://upstream.invalid/b"]  # absolute form, sent to the proxy
+    assert transport.stats_dict()["requests"] == 0
+
+
+def test_http_errors_still_raise_httperror(server):
+    request = urllib.request.Request(server + "/a", method="PUT")  # no do_PUT: 501
+    with pytest.raises(urllib.error.HTTPError) as raised:
+        opener(SharedTransport()).open(request, timeout=5)
+    assert raised.value.code == 501
+
+
+def test_connection_refused_is_a_urlerror():
+    with pytest.raises(urllib.error.URLError):
+        opener(SharedTransport()).open(f"http://127.0.0.1:{closed_port()}/a", timeout=5)
+
+
+def test_read_timeout_is_a_socket_timeout(server):
+    with pytest.raises(socket.timeout):
+        opener(SharedTransport()).open(server + "/slow", timeout=0.2)
+
+
+def test_dropped_connection_is_an_http_client_error(server):
+    with pytest.raises((OSError, http.client.HTTPException)) as raised:
+        opener(SharedTransport()).open(server + "/drop", timeout=5)
+    assert not isinstance(raised.value, urllib.error.URLError)
+
+
+def test_client_keeps_its_handlers_and_maps_connection_errors(monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_API_URL", f"http://127.0.0.1:{closed_port()}/api/{{version!s}}/")
+    api = load_api_from_settings({"cookie": ClientCookieJar().dump()})
+    kinds = [type(handler) for handler in api.opener.handlers]
+    assert PooledHTTPHandler in kinds
+    assert urllib.request.HTTPSHandler in kinds and urllib.request.HTTPCookieProcessor in kinds
+    with pytest.raises(ClientConnectionError):
+        api.current_user()
+
+
+def test_stats_report_the_media_pool(client, monkeypatch):
+    assert client.get("/stats/transport").get_json()["media_transport"] is None
+    monkeypatch.setattr(main, "MEDIA_ALLOWED_HOSTS", ("localhost",))
+    # the media pool refuses non-public addresses, so this fails and counts as an error
+    result = main.fetch_profile_picture("https://localhost/pic.jpg")
+    assert result["status"] == "error"
+    stats = client.get("/stats/transport").get_json()
+    assert stats["media_transport"]["requests"] == 1
+    assert stats["media_transport"]["errors"] == 1
+    assert stats["transport"]["requests"] == 0
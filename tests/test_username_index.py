@@ -0,0 +1,99 @@
+import pytest
+
+import main
+from main import UsernameIndex
+
+
+def user(pk, username):
+    return {"pk": pk, "username": username}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "usernames.db")
+
+
+def test_lookup_and_record_normalise_the_same_way(path):
+    index = UsernameIndex(path)
+    index.record([user(1, " Alice ")], hot=True)
+    assert index.lookup("alice") == 1
+    assert index.lookup("ALICE ") == 1
+    index.flush()
+    assert UsernameIndex(path).lookup(" aLiCe") == 1
+
+
+def test_writes_are_batched(path):
+    index = UsernameIndex(path, batch_size=3)
+    index.record([user(1, "a"), user(2, "b")])
+    # buffered: this worker sees them, the database does not yet
+    assert index.lookup("a") == 1
+    assert UsernameIndex(path).lookup("a") is None
+    index.record([user(3, "c")])
+    assert index.stats()["pending"] == 0
+    assert UsernameIndex(path).lookup("c") == 3
+
+
+def test_rename_seen_by_another_worker_expires_the_hot_entry(path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: clock[0])
+    worker_a = UsernameIndex(path, hot_ttl=60)
+    worker_b = UsernameIndex(path, hot_ttl=60)
+    worker_a.record([user(1, "alice")], hot=True)
+    worker_a.flush()
+    assert worker_a.lookup("alice") == 1
+
+    worker_b.record([user(1, "alice2")])
+    worker_b.flush()
+    assert worker_a.lookup("alice") == 1  # still within the hot TTL
+    clock[0] += 61
+    assert worker_a.lookup("alice") is None
+    assert worker_a.lookup("alice2") == 1
+
+
+def test_rename_within_a_batch_drops_the_old_name(path):
+    index = UsernameIndex(path)
+    index.record([user(1, "alice")], hot=True)
+    index.record([user(1, "alice2")])
+    assert index.lookup("alice") is None
+    index.flush()
+    assert UsernameIndex(path).lookup("alice") is None
+    assert UsernameIndex(path).lookup("alice2") == 1
+
+
+def test_flush_records_renames_already_on_disk(path):
+    index = UsernameIndex(path)
+    index.record([user(1, "alice")])
+    index.flush()
+    index.record([user(1, "alice2")])
+    index.flush()
+    assert index.stats()["renames"] == 1
+    assert index.lookup("alice") is None
+
+
+def test_blank_usernames_are_ignored(path):
+    index = UsernameIndex(path)
+    index.record([user(1, "  "), user(2, None), {"username": "nopk"}])
+    assert index.stats()["pending"] == 0
+
+
+def test_empty_target_never_resolves_to_the_caller():
+    with pytest.raises(ValueError):
+        main.resolve_user_pk("token", " ")
+
+
+@pytest.mark.parametrize("route", ["/get_followers", "/get_following"])
+@pytest.mark.parametrize("target", [None, "", "  ", 5])
+def test_follower_routes_require_a_target(client, route, target):
+    body = {"token": "t"}
+    if target is not None:
+        body["target_username"] = target
+    response = client.post(route, json=body)
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "target_username required"
+
+
+def test_audience_targets_are_normalised_before_counting(client):
+    response = client.post("/audience/overlap", json={"token": "t", "target_usernames": ["Alice", "alice "]})
+    assert response.status_code == 400
+    response = client.post("/audience/overlap", json={"token": "t", "target_usernames": ["alice", ""]})
+    assert response.get_json()["message"] == "target_usernames must be a list of usernames"